@@ -0,0 +1,32 @@
+import os
+import sys
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from yate import yatetransport
+
+PEER = ('127.0.0.1',1234) # the transport fixture already knows this one, as if it had connected
+
+class RecordingTransport(yatetransport.YATETransport):
+   """ A YATETransport with no socket behind it, that just remembers every message that got queued up and every datagram
+       it would have sent
+   """
+   def __init__(self):
+       yatetransport.YATETransport.__init__(self)
+       self.got  = []
+       self.sent = []
+   def queue_msg(self,msg_type,msg_tuple):
+       self.send_msg(msg_type,*msg_tuple)
+   def queue_incoming(self,msg_type,msg_tuple):
+       self.got.append((msg_type,msg_tuple))
+   def transmit(self,dgram,addr):
+       self.sent.append((dgram,addr))
+   def schedule_flush(self,delay):
+       pass # the tests call flush_batches() themselves
+
+@pytest.fixture
+def transport():
+    t = RecordingTransport()
+    t.known_peers.add(PEER)
+    return t
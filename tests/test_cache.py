@@ -0,0 +1,58 @@
+from yate.yateproto import *
+from yate.yatecache import YATELRUCache
+from conftest import PEER
+
+def test_least_recently_used_goes_first():
+    c = YATELRUCache(30)
+    for k in 'abc': c.put(k,k.upper(),10)
+    assert c.get('a') == 'A' # so b is now the oldest
+    c.put('d','D',10)
+    assert not ('b' in c)
+    assert [c.get(k) for k in 'acd'] == ['A','C','D']
+    assert c.get_stats() == {'entries':3,'bytes':30,'hits':4,'misses':0,'evictions':1}
+
+def test_big_one_evicts_several():
+    c = YATELRUCache(30)
+    for k in 'abc': c.put(k,k,10)
+    c.put('d','d',25)
+    assert list(c.entries.keys()) == ['d']
+    assert c.size == 25
+
+def test_too_big_is_not_cached():
+    c = YATELRUCache(30)
+    c.put('a','a',10)
+    c.put('huge','huge',31)
+    assert not ('huge' in c)
+    assert 'a' in c
+
+def test_max_entries():
+    c = YATELRUCache(1000,max_entries=2)
+    for k in 'abc': c.put(k,k,1)
+    assert sorted(c.entries.keys()) == ['b','c']
+
+def test_replacing_fixes_the_size():
+    c = YATELRUCache(30)
+    c.put('a','a',10)
+    c.put('a','aa',20)
+    assert (len(c),c.size,c.get('a')) == (1,20,'aa')
+    c.discard('a')
+    c.discard('a')
+    assert c.size == 0
+
+def test_none_can_be_cached():
+    c = YATELRUCache(30)
+    c.put('a',None,1)
+    assert c.get('a',False) is None
+    assert c.get('b',False) is False
+    assert (c.hits,c.misses) == (1,1)
+
+def test_send_cached_only_encodes_once(transport):
+    made = []
+    def make_params():
+        made.append(1)
+        return ('x'*100,)
+    for i in xrange(3): transport.send_cached(MSGTYPE_STATS,'key',make_params,to_addr=PEER)
+    transport.flush_batches(force=True)
+    assert made == [1]
+    assert len(transport.sent) > 0
+    assert transport.encode_cache.hits == 2
@@ -0,0 +1,55 @@
+import time
+
+from yate.yateproto import *
+from yate.yateclock import YATEClock
+from conftest import PEER
+
+def sample(clock,t1,delay_there,delay_back,offset,turnaround=0.001):
+    """ Add the sample a peer with its clock offset seconds ahead of ours would give us
+    """
+    t2 = t1 + delay_there + offset
+    t3 = t2 + turnaround
+    t4 = t3 - offset + delay_back
+    clock.add_sample(t1,t2,t3,t4)
+
+def test_no_samples():
+    c = YATEClock()
+    assert (c.get_offset(),c.get_delay()) == (None,None)
+    assert c.to_local(1234.5) == 1234.5
+
+def test_symmetric_delay_gives_the_exact_offset():
+    c = YATEClock()
+    sample(c,100.0,0.01,0.01,-3.5)
+    assert abs(c.get_offset() + 3.5) < 1e-6
+    assert abs(c.get_delay() - 0.02) < 1e-6
+    assert abs(c.to_local(200.0) - 203.5) < 1e-6
+
+def test_trusts_the_quickest_sample():
+    c = YATEClock()
+    sample(c,100.0,0.2,0.01,2.0)  # slow on the way there, so the offset comes out wrong
+    sample(c,101.0,0.01,0.01,2.0)
+    sample(c,102.0,0.01,0.3,2.0)
+    assert abs(c.get_offset() - 2.0) < 1e-6
+    assert len(c) == 3
+
+def test_old_samples_are_forgotten():
+    c = YATEClock(max_samples=2)
+    sample(c,100.0,0.001,0.001,1.0)
+    sample(c,101.0,0.05,0.05,5.0)
+    sample(c,102.0,0.05,0.05,5.0)
+    assert abs(c.get_offset() - 5.0) < 1e-6
+
+def test_delay_is_never_negative():
+    c = YATEClock()
+    c.add_sample(100.0,100.0,100.0,99.9999)
+    assert c.get_delay() == 0.0
+
+def test_timed_handlers_get_our_time(transport):
+    now = time.time()
+    transport.add_clock_sample(PEER,now - 0.02,now + 59.99,now + 59.99,now)
+    assert abs(transport.get_clock_offset(PEER) - 60.0) < 0.001
+    got = []
+    transport.spawn_handler = lambda handler,msg_type,msg_params,from_addr,msg_id,msg_time=None,recv_time=None: got.append(msg_time)
+    transport.handlers[MSGTYPE_AVATAR_POS] = lambda *args: None
+    transport.dispatch_msg(MSGTYPE_AVATAR_POS,(1,2,3),1,PEER,msg_time=now + 60.0)
+    assert abs(got[0] - now) < 0.001
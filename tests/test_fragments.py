@@ -0,0 +1,82 @@
+import os
+import time
+import random
+import struct
+import msgpack
+import pytest
+
+from yate.yateproto import *
+from conftest import PEER
+
+def encode(size,msg_id=1):
+    return msgpack.packb((MSGTYPE_STATS,(os.urandom(size),msg_id),msg_id),use_bin_type=True)
+
+def test_small_message_is_not_fragmented(transport):
+    assert len(transport.frame_msg(0,1,encode(100))) == 1
+
+def test_reassembles_out_of_order(transport):
+    body      = encode(100000)
+    datagrams = transport.frame_msg(0,1,body)
+    assert len(datagrams) > 1
+    assert all([len(d) <= YATE_MAX_DATAGRAM for d in datagrams])
+    random.shuffle(datagrams)
+    for d in datagrams[:-1]:
+        transport.got_datagram(d,PEER)
+        assert transport.got == []
+    transport.got_datagram(datagrams[-1],PEER)
+    assert len(transport.got) == 1
+    msg_type,(msg_params,msg_id,msg_time,recv_time,addr) = transport.got[0]
+    assert (msg_type,msg_id,addr) == (MSGTYPE_STATS,1,PEER)
+    assert msgpack.packb((msg_type,msg_params,msg_id),use_bin_type=True) == body
+    assert transport.fragments == {}
+    assert transport.fragment_bytes == 0
+
+def test_duplicate_fragments_are_ignored(transport):
+    datagrams = transport.frame_msg(0,1,encode(30000))
+    for d in datagrams[:-1] + datagrams[:-1]: transport.got_datagram(d,PEER)
+    assert transport.got == []
+    transport.got_datagram(datagrams[-1],PEER)
+    assert len(transport.got) == 1
+    assert transport.fragment_bytes == 0
+
+def test_bogus_fragment_is_dropped(transport):
+    header = struct.pack(YATE_FRAGMENT_HEADER,YATE_FLAG_FRAGMENT,1,5,5) # index past the end
+    assert transport.defragment(header + 'x'*100,PEER) is None
+    assert transport.fragments == {}
+
+def test_too_big_to_send(transport):
+    with pytest.raises(ValueError):
+       transport.frame_msg(0,1,'x'*(YATE_MAX_FRAGMENTS*YATE_FRAGMENT_SIZE + 1))
+
+def test_biggest_message_gets_through_with_others_pending(transport):
+    biggest = YATE_MAX_FRAGMENTS*YATE_FRAGMENT_SIZE - 200
+    for i in xrange(2): # incomplete ones from before, so the budget is already mostly used up
+        for d in transport.frame_msg(0,1,encode(biggest))[:-1]: transport.got_datagram(d,PEER)
+    for d in transport.frame_msg(0,1,encode(biggest)): transport.got_datagram(d,PEER)
+    assert len(transport.got) == 1
+    assert transport.fragment_bytes <= YATE_MAX_PENDING_FRAGMENTS
+
+def test_pending_limit_drops_the_stalest(transport):
+    big = YATE_MAX_FRAGMENTS*YATE_FRAGMENT_SIZE*3/4 # only two of these fit at once
+    old = transport.frame_msg(0,1,encode(big))
+    for d in old[:-1]: transport.got_datagram(d,PEER)
+    newer = [transport.frame_msg(0,1,encode(big)) for i in xrange(3)]
+    for datagrams in newer:
+        for d in datagrams[:-1]:
+            transport.got_datagram(d,PEER)
+            assert transport.fragment_bytes <= YATE_MAX_PENDING_FRAGMENTS
+    transport.got_datagram(old[-1],PEER) # the oldest was thrown away, so this can't finish it
+    transport.got_datagram(newer[-1][-1],PEER)
+    assert len(transport.got) == 1
+
+def test_incomplete_messages_expire(transport):
+    for d in transport.frame_msg(0,1,encode(30000))[:-1]: transport.got_datagram(d,PEER)
+    assert transport.fragment_bytes > 0
+    transport.expire_fragments(time.time() + YATE_FRAGMENT_TIMEOUT + 1)
+    assert transport.fragments == {}
+    assert transport.fragment_bytes == 0
+
+def test_strangers_cannot_send_fragments(transport):
+    for d in transport.frame_msg(0,1,encode(30000)): transport.got_datagram(d,('127.0.0.1',9999))
+    assert transport.got == []
+    assert transport.fragments == {}
@@ -0,0 +1,139 @@
+import zlib
+import struct
+import msgpack
+
+from yate import yatezdict
+from yate.yateproto import *
+from conftest import PEER
+
+STRANGER = ('127.0.0.1',9999)
+PARAMS   = ('testing testing testing testing testing testing testing testing',1,2,3)
+
+def encode(msg_type=MSGTYPE_STATS,params=PARAMS,msg_id=7):
+    return msgpack.packb((msg_type,params,msg_id),use_bin_type=True)
+
+def frame(flags,body,seq=1):
+    return struct.pack(YATE_FRAME_HEADER,flags,seq) + body
+
+def parse_one(transport,dgram,addr=PEER):
+    transport.got_datagram(dgram,addr)
+    assert len(transport.got) == 1
+    return transport.got.pop()
+
+def test_plain(transport):
+    msg_type,(msg_params,msg_id,msg_time,recv_time,addr) = parse_one(transport,frame(0,encode()))
+    assert (msg_type,msg_params,msg_id,msg_time,addr) == (MSGTYPE_STATS,PARAMS,7,None,PEER)
+
+def test_zlib(transport):
+    msgdata    = encode(params=('a'*2000,))
+    flags,body = transport.compress_msg(MSGTYPE_STATS,msgdata)
+    assert flags == YATE_FLAG_ZLIB
+    assert len(body) < len(msgdata)
+    msg_type,msg_tuple = parse_one(transport,frame(flags,body))
+    assert msg_tuple[0] == ('a'*2000,)
+
+def test_small_messages_are_not_compressed(transport):
+    assert transport.compress_msg(MSGTYPE_STATS,encode(params=()))[0] == 0
+
+def test_zlib_bomb_is_rejected(transport):
+    body = zlib.compress(encode(params=('a'*(YATE_MAX_MSG_SIZE+1),)),9)
+    assert len(body) < YATE_MAX_DATAGRAM
+    transport.got_datagram(frame(YATE_FLAG_ZLIB,body),PEER)
+    assert transport.got == []
+
+def test_zdict(transport):
+    body = chr(2) + yatezdict.get_zdict(2).compress(encode(),6)
+    msg_type,msg_tuple = parse_one(transport,frame(YATE_FLAG_ZDICT,body))
+    assert msg_tuple[0] == PARAMS
+
+def test_zdict_bomb_is_rejected(transport):
+    body = chr(2) + yatezdict.get_zdict(2).compress(encode(params=('a'*(YATE_MAX_MSG_SIZE+1),)),9)
+    transport.got_datagram(frame(YATE_FLAG_ZDICT,body),PEER)
+    assert transport.got == []
+
+def test_zdict_only_when_smaller(transport):
+    msgdata    = encode(params=('a'*2000,))
+    flags,body = transport.compress_msg(MSGTYPE_STATS,msgdata,2)
+    assert len(body) <= len(zlib.compress(msgdata,YATE_ZLIB_LEVEL_DEFAULT))
+    msg_type,msg_tuple = parse_one(transport,frame(flags,body))
+    assert msg_tuple[0] == ('a'*2000,)
+
+def test_one_codec_per_type(transport):
+    zlib_calls = []
+    transport.offload = lambda size,fn,*args: zlib_calls.append(size) or fn(*args)
+    msgdata = encode(params=PARAMS*4)
+    assert len(msgdata) >= YATE_COMPRESS_MIN_SIZE
+    for i in xrange(YATE_COMPRESS_RETRY*2):
+        flags,body = transport.compress_msg(MSGTYPE_STATS,msgdata,2)
+        assert flags == YATE_FLAG_ZDICT
+    assert len(zlib_calls) == 3 # the first one, then every YATE_COMPRESS_RETRY messages
+
+def test_time(transport):
+    body = struct.pack(YATE_FRAME_TIME,1234.5) + encode()
+    msg_type,(msg_params,msg_id,msg_time,recv_time,addr) = parse_one(transport,frame(YATE_FLAG_TIME,body))
+    assert (msg_params,msg_time) == (PARAMS,1234.5) # it's only turned into our time by dispatch_msg()
+
+def test_time_and_zlib(transport):
+    msgdata    = encode(params=('a'*2000,))
+    flags,body = transport.compress_msg(MSGTYPE_STATS,msgdata)
+    body       = struct.pack(YATE_FRAME_TIME,1234.5) + body
+    msg_type,(msg_params,msg_id,msg_time,recv_time,addr) = parse_one(transport,frame(flags | YATE_FLAG_TIME,body))
+    assert (msg_params,msg_time) == (('a'*2000,),1234.5)
+
+def test_timestamps_only_go_to_peers_that_understand_them(transport):
+    other = ('127.0.0.1',4321)
+    transport.known_peers.add(other)
+    transport.peer_caps[PEER] = {'time':True}
+    transport.send_avatar_pos(1,2,3,timestamp=1234.5)
+    transport.flush_batches(force=True)
+    sent = dict([(addr,dgram) for dgram,addr in transport.sent])
+    assert ord(sent[PEER][0]) & YATE_FLAG_TIME
+    assert not (ord(sent[other][0]) & YATE_FLAG_TIME)
+    msg_type,(msg_params,msg_id,msg_time,recv_time,addr) = parse_one(transport,sent[PEER])
+    assert (msg_params,msg_time) == ((1,2,3),1234.5)
+
+def test_batch(transport):
+    frames = [frame(0,encode(msg_id=i),seq=i) for i in xrange(1,4)]
+    transport.got_datagram(chr(YATE_FLAG_BATCH) + ''.join([struct.pack(YATE_BATCH_LENGTH,len(f)) + f for f in frames]),PEER)
+    assert [msg_tuple[1] for msg_type,msg_tuple in transport.got] == [1,2,3]
+
+def test_batch_with_bad_length(transport):
+    good = frame(0,encode())
+    transport.got_datagram(chr(YATE_FLAG_BATCH) + struct.pack(YATE_BATCH_LENGTH,len(good)) + good + struct.pack(YATE_BATCH_LENGTH,500) + good[:10],PEER)
+    assert len(transport.got) == 1
+
+def test_small_messages_get_coalesced(transport):
+    for i in xrange(1,4): transport.send_datagrams(PEER,[frame(0,encode(msg_id=i),seq=i)])
+    assert transport.sent == []
+    transport.flush_batches(force=True)
+    assert len(transport.sent) == 1
+    transport.got_datagram(transport.sent[0][0],PEER)
+    assert [msg_tuple[1] for msg_type,msg_tuple in transport.got] == [1,2,3]
+
+def test_single_message_is_not_wrapped(transport):
+    transport.send_datagrams(PEER,[frame(0,encode())])
+    transport.flush_batches(force=True)
+    assert transport.sent == [(frame(0,encode()),PEER)]
+
+def test_batches_never_get_too_big(transport):
+    big = frame(0,encode(params=('x'*3000,)))
+    for i in xrange(5): transport.send_datagrams(PEER,[big])
+    transport.flush_batches(force=True)
+    assert len(transport.sent) == 3
+    assert all([len(dgram) <= YATE_MAX_DATAGRAM for dgram,addr in transport.sent])
+
+def test_fragments_go_after_whats_batched(transport):
+    transport.send_datagrams(PEER,[frame(0,encode(msg_id=1))])
+    transport.send_datagrams(PEER,transport.frame_msg(0,2,encode(params=('x'*20000,),msg_id=2)))
+    for dgram,addr in transport.sent: transport.got_datagram(dgram,addr)
+    assert [msg_tuple[1] for msg_type,msg_tuple in transport.got] == [1,2]
+
+def test_strangers_only_get_plain_frames_decoded(transport):
+    transport.got_datagram(frame(YATE_FLAG_ZLIB,zlib.compress(encode(MSGTYPE_CONNECT,({},)))),STRANGER)
+    assert transport.got == []
+    msg_type,msg_tuple = parse_one(transport,frame(0,encode(MSGTYPE_CONNECT,({},))),STRANGER)
+    assert (msg_type,msg_tuple[-1]) == (MSGTYPE_CONNECT,STRANGER)
+
+def test_unknown_msg_type(transport):
+    transport.got_datagram(frame(0,msgpack.packb((9999,(),1),use_bin_type=True)),PEER)
+    assert transport.got == []
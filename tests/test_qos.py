@@ -0,0 +1,70 @@
+from yate.yateproto import *
+from yate.yateqos import YATETokenBucket
+from conftest import PEER
+
+def test_take_is_all_or_nothing():
+    b = YATETokenBucket(10,5,100.0)
+    assert b.take(3,100.0)
+    assert not b.take(3,100.0)
+    assert b.take(2,100.0)
+    assert not b.take(1,100.0)
+
+def test_refills_up_to_burst():
+    b = YATETokenBucket(10,5,100.0)
+    assert b.take(5,100.0)
+    assert not b.take(3,100.2)
+    assert b.take(2,100.25)
+    assert not b.take(6,200.0) # an hour of quiet is still only worth the burst
+    assert b.take(5,200.0)
+
+def test_spend_goes_into_debt():
+    b = YATETokenBucket(10,5,100.0)
+    b.spend(25,100.0)
+    assert not b.ready(100.0)
+    assert abs(b.wait_time(100.0) - 2.0) < 0.01
+    assert not b.ready(101.9)
+    assert b.ready(102.01)
+
+def test_reserve():
+    b = YATETokenBucket(10,5,100.0)
+    assert b.ready(100.0,reserve=4)
+    assert not b.ready(100.0,reserve=5)
+    b.spend(5,100.0)
+    assert abs(b.wait_time(100.0,reserve=3) - 0.3) < 0.01
+
+def test_no_rate_means_no_limit():
+    b = YATETokenBucket(0,0,100.0)
+    b.spend(1000000,100.0)
+    assert b.take(1000000,100.0)
+    assert b.ready(100.0)
+    assert b.wait_time(100.0) == 0.0
+
+def test_admit_msg_throttles_each_peer(transport):
+    other = ('127.0.0.1',4321)
+    for i in xrange(YATE_PEER_MSG_BURST): assert transport.admit_msg(PEER,MSGTYPE_VISIBLE_VOXEL_REQ,100.0)
+    assert not transport.admit_msg(PEER,MSGTYPE_VISIBLE_VOXEL_REQ,100.0)
+    assert transport.admit_msg(PEER,MSGTYPE_KEEPALIVE,100.0)  # control and realtime messages always get in
+    assert transport.admit_msg(PEER,MSGTYPE_MOVE_VECTOR,100.0)
+    assert transport.admit_msg(other,MSGTYPE_VISIBLE_VOXEL_REQ,100.0)
+    assert transport.admit_msg(PEER,MSGTYPE_VISIBLE_VOXEL_REQ,100.0 + 2.0/YATE_PEER_MSG_RATE)
+
+class HeldHandlers(object):
+    """ Collects the handlers dispatch_msg() would start, so the test decides when they finish
+    """
+    def __init__(self,transport):
+        self.running = []
+        transport.spawn_handler = lambda handler,msg_type,msg_params,from_addr,msg_id,msg_time=None,recv_time=None: \
+                                         self.running.append((msg_type,from_addr))
+        transport.handlers[MSGTYPE_REQ_NEAREST_VOXEL] = lambda *args: None
+
+def test_admission_limit(transport):
+    held  = HeldHandlers(transport)
+    limit = YATE_ADMISSION_LIMITS[MSGTYPE_REQ_NEAREST_VOXEL]
+    for i in xrange(limit + 2): transport.dispatch_msg(MSGTYPE_REQ_NEAREST_VOXEL,(1,None),i,PEER)
+    assert len(held.running) == limit
+    assert transport.stats.peer_counters(PEER)['rejected'] == 2
+    transport.release_msg(PEER,MSGTYPE_REQ_NEAREST_VOXEL)
+    transport.dispatch_msg(MSGTYPE_REQ_NEAREST_VOXEL,(1,None),99,PEER)
+    assert len(held.running) == limit + 1
+    for i in xrange(limit): transport.release_msg(PEER,MSGTYPE_REQ_NEAREST_VOXEL)
+    assert transport.in_flight == {}
@@ -0,0 +1,61 @@
+from yate.yateproto import *
+from yate.yatesock import YATERunQueue
+
+A = ('127.0.0.1',1111)
+B = ('127.0.0.1',2222)
+
+def drain(q):
+    retval = []
+    while True:
+       got = q.get(timeout=0)
+       if got is None: return retval
+       retval.append(got)
+
+def test_priority_order():
+    q = YATERunQueue()
+    q.put(MSGTYPE_BULK_VOXEL_UPDATE,('box',A))
+    q.put(MSGTYPE_STATS,('stats',A))
+    q.put(MSGTYPE_AVATAR_POS,('pos',A))
+    q.put(MSGTYPE_KEEPALIVE,('ping',A))
+    assert [item[0] for msg_type,item in drain(q)] == ['ping','pos','stats','box']
+
+def test_keep_never_drops():
+    dropped = []
+    q = YATERunQueue(policies={MSGTYPE_STATS:(YATE_QUEUE_KEEP,0)},dropped_cb=lambda t,item: dropped.append(item))
+    for i in xrange(5000): q.put(MSGTYPE_STATS,(i,A))
+    assert [item[0] for msg_type,item in drain(q)] == range(5000)
+    assert dropped == []
+
+def test_latest_replaces_per_peer():
+    dropped = []
+    q = YATERunQueue(dropped_cb=lambda t,item: dropped.append(item))
+    q.put(MSGTYPE_AVATAR_POS,(1,A))
+    q.put(MSGTYPE_AVATAR_POS,(1,B))
+    q.put(MSGTYPE_AVATAR_POS,(2,A))
+    q.put(MSGTYPE_AVATAR_POS,(3,A))
+    assert [item for msg_type,item in drain(q)] == [(3,A),(1,B)] # the replacement keeps its place in line
+    assert dropped == [(1,A),(2,A)]
+    stats = q.get_stats()['MSGTYPE_AVATAR_POS']
+    assert (stats['queued'],stats['conflated'],stats['depth']) == (4,2,0)
+
+def test_drop_oldest():
+    dropped = []
+    q = YATERunQueue(policies={MSGTYPE_STATS:(YATE_QUEUE_DROP_OLDEST,3)},dropped_cb=lambda t,item: dropped.append(item))
+    for i in xrange(5): q.put(MSGTYPE_STATS,(i,A))
+    assert q.qsize() == 3
+    assert q.get_stats()['MSGTYPE_STATS']['dropped'] == 2
+    assert [item[0] for msg_type,item in drain(q)] == [2,3,4]
+    assert [item[0] for item in dropped] == [0,1]
+
+def test_peer_oldest_is_per_peer():
+    q = YATERunQueue(policies={MSGTYPE_BULK_VOXEL_UPDATE:(YATE_QUEUE_PEER_OLDEST,2)})
+    for i in xrange(4): q.put(MSGTYPE_BULK_VOXEL_UPDATE,(i,A))
+    q.put(MSGTYPE_BULK_VOXEL_UPDATE,(0,B))
+    q.put(MSGTYPE_BULK_VOXEL_UPDATE,(1,B))
+    assert [item for msg_type,item in drain(q)] == [(2,A),(3,A),(0,B),(1,B)]
+
+def test_wake_returns_nothing():
+    q = YATERunQueue()
+    q.wake()
+    assert q.get(timeout=0) is None
+    assert q.get(timeout=0) is None
@@ -0,0 +1,33 @@
+from yate.yateproto import *
+from conftest import PEER
+
+def track(transport,seqs):
+    for seq in seqs: transport.track_seq(PEER,seq)
+    return transport.get_seq_stats()[PEER]
+
+def test_in_order(transport):
+    assert track(transport,xrange(1,11)) == {'received':10,'lost':0,'duplicates':0,'reordered':0}
+
+def test_gap_is_lost(transport):
+    assert track(transport,[1,2,5,6]) == {'received':4,'lost':2,'duplicates':0,'reordered':0}
+
+def test_late_message_fills_the_gap(transport):
+    assert track(transport,[1,2,4,3,5]) == {'received':5,'lost':0,'duplicates':0,'reordered':1}
+
+def test_duplicates(transport):
+    assert track(transport,[1,2,2,3,1,3]) == {'received':6,'lost':0,'duplicates':3,'reordered':0}
+
+def test_late_duplicate(transport):
+    assert track(transport,[1,3,2,2]) == {'received':4,'lost':0,'duplicates':1,'reordered':1}
+
+def test_wraps_around(transport):
+    assert track(transport,[0xFFFFFFFE,0xFFFFFFFF,0,1,3]) == {'received':5,'lost':1,'duplicates':0,'reordered':0}
+
+def test_very_late_message(transport):
+    stats = track(transport,[1] + range(3,YATE_SEQ_WINDOW+10) + [2])
+    assert (stats['lost'],stats['reordered']) == (0,1)
+
+def test_next_seq_wraps(transport):
+    transport.peer_seq_out[PEER] = 0xFFFFFFFF
+    assert transport.next_seq(PEER) == 0
+    assert transport.next_seq(PEER) == 1
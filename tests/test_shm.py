@@ -0,0 +1,73 @@
+import struct
+import pytest
+
+from yate import yateshm, voxelbox, utils
+
+@pytest.fixture
+def shm(tmpdir):
+    path   = str(tmpdir.join('yate.shm'))
+    writer = yateshm.YATEShmWriter(path,layout=((4,64),(4,1024)))
+    reader = yateshm.YATEShmReader(path)
+    yield writer,reader
+    reader.close()
+    writer.close()
+
+def test_empty(shm):
+    writer,reader = shm
+    assert reader.get_head(yateshm.YATE_SHM_AVATAR_POS) == 0
+    assert reader.get_latest(yateshm.YATE_SHM_AVATAR_POS) is None
+
+def test_write_read(shm):
+    writer,reader = shm
+    writer.publish_avatar_pos((1.5,2.0,-3.25),timestamp=123.0)
+    frame = reader.get_latest(yateshm.YATE_SHM_AVATAR_POS)
+    assert (frame.frame_no,frame.timestamp) == (1,123.0)
+    assert frame.decode_avatar_pos() == (1.5,2.0,-3.25)
+    assert frame.is_valid()
+
+def test_ring_wraps(shm):
+    writer,reader = shm
+    for i in xrange(10): writer.publish_avatar_pos((i,0,0))
+    assert reader.get_head(yateshm.YATE_SHM_AVATAR_POS) == 10
+    assert reader.get_latest(yateshm.YATE_SHM_AVATAR_POS).decode_avatar_pos() == (9,0,0)
+    assert reader.get_frame(yateshm.YATE_SHM_AVATAR_POS,7).decode_avatar_pos() == (6,0,0)
+    assert reader.get_frame(yateshm.YATE_SHM_AVATAR_POS,6) is None # lapped
+
+def test_lapped_while_reading(shm):
+    writer,reader = shm
+    writer.publish_avatar_pos((1,2,3))
+    frame = reader.get_latest(yateshm.YATE_SHM_AVATAR_POS)
+    for i in xrange(4): writer.publish_avatar_pos((0,0,0))
+    assert not frame.is_valid()
+
+def test_half_written_frame_is_skipped(shm):
+    writer,reader = shm
+    writer.publish_avatar_pos((1,2,3))
+    frame = reader.get_latest(yateshm.YATE_SHM_AVATAR_POS)
+    struct.pack_into('<Q',writer.mm,frame.slot,frame.seq+1) # what the writer leaves there while it's in the middle of one
+    assert reader.get_frame(yateshm.YATE_SHM_AVATAR_POS,1) is None
+    assert not frame.is_valid()
+
+def test_voxel_box(shm):
+    writer,reader = shm
+    start,end = (0,0,0),(4,3,2)
+    states    = [(i % 3,0,0,0) for i in xrange(4*3*2)]
+    writer.publish_voxel_box(start,end,states)
+    box = reader.get_latest(yateshm.YATE_SHM_VOXEL_BOX).decode_voxel_box()
+    assert box[0] == start
+    assert [tuple(v[1:]) for v in voxelbox.iter_box(box)] == states
+    assert writer.get_stats()['cropped'] == 0
+
+def test_voxel_box_too_big_is_cropped(shm):
+    writer,reader = shm
+    start,end = (-20,-20,-20),(20,20,20)
+    positions = list(utils.iter_within(start,end))
+    truth     = dict([(pos,(sum(pos) % 7,0,0,0)) for pos in positions])
+    writer.publish_voxel_box(start,end,[truth[pos] for pos in positions])
+    box    = reader.get_latest(yateshm.YATE_SHM_VOXEL_BOX).decode_voxel_box()
+    voxels = list(voxelbox.iter_box(box))
+    assert 0 < len(voxels) < len(positions)
+    assert all([truth[v[0]] == tuple(v[1:]) for v in voxels])
+    stats = writer.get_stats()
+    assert stats['cropped'] == 1
+    assert stats['cropped_voxels'] == len(positions) - len(voxels)
@@ -0,0 +1,48 @@
+from yate.yateproto import *
+from conftest import PEER
+
+def subscribe(transport,msg_types=None,region=None,max_rate=0):
+    transport.handle_subscribe((msg_types,region,max_rate),PEER,1)
+
+def test_no_subscription_wants_everything(transport):
+    assert transport.wants(PEER,MSGTYPE_AVATAR_POS)
+    assert transport.wants(PEER,MSGTYPE_VOXEL_UPDATE,pos=(1000,1000,1000))
+
+def test_types(transport):
+    subscribe(transport,msg_types=[MSGTYPE_AVATAR_POS])
+    assert transport.wants(PEER,MSGTYPE_AVATAR_POS)
+    assert not transport.wants(PEER,MSGTYPE_BULK_VOXEL_UPDATE)
+    assert transport.wants(PEER,MSGTYPE_KEEPALIVE) # control messages always get through
+
+def test_region(transport):
+    subscribe(transport,region=[[0,0,0],[10,10,10]])
+    assert transport.wants(PEER,MSGTYPE_VOXEL_UPDATE,pos=(0,5,9))
+    assert not transport.wants(PEER,MSGTYPE_VOXEL_UPDATE,pos=(0,5,10))
+    assert not transport.wants(PEER,MSGTYPE_VOXEL_UPDATE,pos=(-1,5,5))
+    assert transport.wants(PEER,MSGTYPE_AVATAR_POS) # not about anywhere in particular
+    assert transport.get_region(PEER) == ((0,0,0),(10,10,10))
+
+def test_rate(transport):
+    subscribe(transport,max_rate=1)
+    assert transport.wants(PEER,MSGTYPE_AVATAR_POS)
+    assert transport.wants(PEER,MSGTYPE_AVATAR_POS) # asking doesn't use anything up
+    transport.send_avatar_pos(1,2,3,to_addr=PEER)
+    assert not transport.wants(PEER,MSGTYPE_AVATAR_POS)
+    assert transport.wants(PEER,MSGTYPE_VOXEL_UPDATE) # each type has its own rate
+    transport.peer_subs[PEER]['last_sent'][MSGTYPE_AVATAR_POS] -= 1.0
+    assert transport.wants(PEER,MSGTYPE_AVATAR_POS)
+
+def test_nothing_sent_uses_up_nothing(transport):
+    subscribe(transport,max_rate=1)
+    transport.send_cached(MSGTYPE_BULK_VOXEL_UPDATE,'empty',lambda: None,to_addr=PEER)
+    transport.flush_batches(force=True)
+    assert transport.sent == []
+    assert transport.wants(PEER,MSGTYPE_BULK_VOXEL_UPDATE)
+
+def test_broadcast_skips_unwanted(transport):
+    other = ('127.0.0.1',4321)
+    transport.known_peers.add(other)
+    subscribe(transport,msg_types=[MSGTYPE_VOXEL_UPDATE])
+    transport.send_avatar_pos(1,2,3)
+    transport.flush_batches(force=True)
+    assert [addr for dgram,addr in transport.sent] == [other]
@@ -0,0 +1,50 @@
+from yate.yatetimer import YATETimerWheel
+
+def wheel():
+    return YATETimerWheel(100.0,tick=0.25,slots=8)
+
+def test_fires_once_due():
+    w = wheel()
+    w.schedule('a',100.6)
+    assert w.advance(100.5) == []
+    assert w.advance(100.6) == []  # still in the same tick
+    assert w.advance(100.75) == ['a']
+    assert len(w) == 0
+    assert w.advance(101.0) == []
+
+def test_past_times_fire_next_tick():
+    w = wheel()
+    w.schedule('a',50.0)
+    assert w.advance(100.1) == []
+    assert w.advance(100.25) == ['a']
+
+def test_reschedule_moves():
+    w = wheel()
+    w.schedule('a',100.5)
+    w.schedule('a',101.0)
+    assert len(w) == 1
+    assert w.advance(100.5) == []
+    assert w.advance(101.0) == ['a']
+
+def test_cancel():
+    w = wheel()
+    w.schedule('a',100.5)
+    w.cancel('a')
+    w.cancel('never scheduled')
+    assert not ('a' in w)
+    assert w.advance(101.0) == []
+
+def test_later_lap_waits():
+    w = wheel() # one lap is 2 seconds
+    w.schedule('a',100.5)
+    w.schedule('b',102.5) # same slot, next lap
+    assert w.advance(100.5) == ['a']
+    assert 'b' in w
+    assert w.advance(102.25) == []
+    assert w.advance(102.5) == ['b']
+
+def test_falling_behind_gets_everything():
+    w = wheel()
+    for i in xrange(20): w.schedule(i,100.0 + i*0.3)
+    assert sorted(w.advance(110.0)) == range(20)
+    assert len(w) == 0
@@ -0,0 +1,93 @@
+import random
+import pytest
+
+from yate import voxelbox, utils
+
+AIR   = (0,0,0,0)
+STONE = (1,0,0,0)
+DIRT  = (3,0,0,0)
+
+def roundtrip(start,end,states):
+    params = voxelbox.encode_box(start,end,states)
+    return params,list(voxelbox.iter_box(params))
+
+def test_roundtrip():
+    start,end = (-2,0,5),(3,4,8)
+    positions = list(utils.iter_within(start,end))
+    states    = [random.choice((AIR,STONE,DIRT)) for pos in positions]
+    params,voxels = roundtrip(start,end,states)
+    origin,dims,palette,flags,data = params
+    assert (origin,dims) == ((-2,0,5),(5,4,3))
+    assert len(palette) <= 3
+    assert voxels == [(pos,) + state for pos,state in zip(positions,states)]
+
+def test_start_and_end_get_rounded():
+    params,voxels = roundtrip((0.4,0.6,-0.4),(2.2,2,1),[STONE]*2)
+    assert params[:2] == ((0,1,0),(2,1,1))
+    assert len(voxels) == 2
+
+def test_runs_use_rle():
+    states = [AIR]*500 + [STONE]*500
+    params,voxels = roundtrip((0,0,0),(10,10,10),states)
+    origin,dims,palette,flags,data = params
+    assert flags & voxelbox.YATE_BOX_RLE
+    assert len(data) == 8 # two (run length,index) pairs
+    assert [v[1:] for v in voxels] == states
+
+def test_long_runs_get_split():
+    states = [AIR]*(voxelbox.YATE_BOX_MAX_RUN + 10)
+    params,voxels = roundtrip((0,0,0),(1,1,len(states)),states)
+    assert params[3] & voxelbox.YATE_BOX_RLE
+    assert len(voxels) == len(states)
+
+def test_noisy_box_is_not_rle():
+    states = [(i % 2,0,0,0) for i in xrange(1000)]
+    params,voxels = roundtrip((0,0,0),(10,10,10),states)
+    assert not (params[3] & voxelbox.YATE_BOX_RLE)
+    assert [v[1:] for v in voxels] == states
+
+def test_big_palette_is_wide():
+    states = [(i,0,0,0) for i in xrange(300)]
+    params,voxels = roundtrip((0,0,0),(1,1,300),states)
+    assert params[3] & voxelbox.YATE_BOX_WIDE
+    assert [v[1:] for v in voxels] == states
+
+def test_wrong_size_data_is_rejected():
+    origin,dims,palette,flags,data = voxelbox.encode_box((0,0,0),(2,2,2),[AIR,STONE]*4)
+    with pytest.raises(ValueError):
+       list(voxelbox.iter_box((origin,(2,2,3),palette,flags,data)))
+
+def apply(known,params):
+    for voxel in voxelbox.iter_box(params): known[voxel[0]] = voxel[1:]
+
+def test_keyframe_has_no_delta_flag():
+    assert not (voxelbox.encode_box((0,0,0),(2,2,2),[AIR]*8)[3] & voxelbox.YATE_BOX_DELTA)
+
+def test_delta_skips_unchanged():
+    start,end = (0,0,0),(4,4,4)
+    positions = list(utils.iter_within(start,end))
+    before    = [random.choice((AIR,STONE)) for pos in positions]
+    after     = list(before)
+    for i in (3,17,40): after[i] = DIRT
+    known = {}
+    apply(known,voxelbox.encode_box(start,end,before))
+    params = voxelbox.encode_box(start,end,[None if a==b else b for a,b in zip(before,after)])
+    assert params[3] & voxelbox.YATE_BOX_DELTA
+    assert [v[0] for v in voxelbox.iter_box(params)] == [positions[i] for i in (3,17,40)]
+    apply(known,params)
+    assert [known[pos] for pos in positions] == after
+
+def test_mostly_unchanged_delta_is_small():
+    states = [None]*4096
+    states[100] = STONE
+    params = voxelbox.encode_box((0,0,0),(16,16,16),states)
+    assert params[3] & voxelbox.YATE_BOX_RLE
+    assert len(params[4]) == 12 # unchanged, changed, unchanged
+    assert list(voxelbox.iter_box(params)) == [((0,6,4),) + STONE]
+
+def test_pause_does_not_change_the_encoding():
+    states = [random.choice((AIR,STONE,DIRT,None)) for i in xrange(voxelbox.YATE_BOX_CHUNK*3 + 5)]
+    end    = (1,1,len(states))
+    paused = []
+    assert voxelbox.encode_box((0,0,0),end,states,pause=lambda: paused.append(1)) == voxelbox.encode_box((0,0,0),end,states)
+    assert len(paused) == 6 # three times between the four chunks, for each of the two passes
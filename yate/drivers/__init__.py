@@ -1,5 +1,11 @@
-import minecraft
-import mockdriver
+import importlib
 
-available_drivers = {'minecraft':minecraft,
-                     'mock':     mockdriver}
+# maps driver names to modules in this package - they're only imported when asked for, so importing yate.drivers.base
+# doesn't drag in every driver (and the minecraft driver monkey patches everything with eventlet)
+available_drivers = {'minecraft':'minecraft',
+                     'mock':     'mockdriver'}
+
+def load_driver(name):
+    """ Import and return the module for the named driver
+    """
+    return importlib.import_module('.%s' % available_drivers[name],__name__)
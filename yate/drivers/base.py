@@ -10,7 +10,7 @@ import time
 class YateBaseVoxel:
    """ This class may either be used directly or inherited from and extended for game-specific mechanics etc
    """
-   def __init__(self,spatial_pos=(64,64,64),basic_type=YATE_VOXEL_EMPTY,specific_type=0,active_state=YATE_VOXEL_INACTIVE,intact_state=YATE_VOXEL_INTACT,from_params=None):
+   def __init__(self,spatial_pos=(64,64,64),basic_type=YATE_VOXEL_EMPTY,specific_type=0,active_state=YATE_VOXEL_INACTIVE,intact_state=YATE_VOXEL_INTACT,from_params=None,observed_at=None):
        """ spatial_pos   is obvious
            basic_type    is the basic voxel type as defined in yateproto.py
            specific_type is optional and specifies the game-specific extended type
@@ -19,7 +19,9 @@ class YateBaseVoxel:
                partly destroyed voxels are not intact
            from_params   is a tuple of params from a MSGTYPE_VOXEL_UPDATE message and defaults to None
                          if specified, from_params overrides other params
+           observed_at   is the time.time() this voxel was seen like this, if known - clients set it from the server's timestamps
        """
+       self.observed_at = observed_at
        if from_params is None:
           self.spatial_pos   = (spatial_pos[0],spatial_pos[1],spatial_pos[2])
           self.basic_type    = basic_type
@@ -48,10 +50,19 @@ class YateBaseVoxel:
        """ return a tuple representing the 3D spatial coordinates of this voxel
        """
        return self.spatial_pos
+   def get_age(self):
+       """ return how many seconds ago this voxel was seen like this, or None if we don't know
+       """
+       if self.observed_at is None: return None
+       return time.time() - self.observed_at
    def as_msgparams(self):
        """ return a tuple representing this voxel as message params for MSGTYPE_VOXEL_UPDATE
        """
        return ((self.spatial_pos[0],self.spatial_pos[1],self.spatial_pos[2]),self.basic_type,self.specific_type,self.active_state,self.intact_state)
+   def get_state(self):
+       """ return a tuple representing the state of this voxel without the position - this is what goes in the palette of a bulk voxel update
+       """
+       return (self.basic_type,self.specific_type,self.active_state,self.intact_state)
    def is_intact(self):
        """" return a boolean value indicating whether or not this voxel is fully intact
             if it's partly destroyed, this will return false
@@ -121,7 +132,7 @@ class YateBaseDriver(object):
        """
    def get_vision_range(self):
        """ Returns an (x,y,z) tuple representing how many voxels can be perceived by the in-game avatar
-           This must always be an even number on each axis, even if that means losing data, also needs to fit into a single bulk update
+           This must always be an even number on each axis, even if that means losing data
            z is height
        """
        pass
@@ -170,6 +181,12 @@ class YateBaseDriver(object):
            see the coordinates this method should return None
        """
        pass
+   def get_world_version(self):
+       """ This method should return a number that goes up whenever any voxel the avatar can see might have changed (a chunk
+           arriving, a block being broken etc) - YATE uses it to tell when it can reuse what it read last time
+           Return None if the driver can't tell, then YATE just assumes the world changes all the time
+       """
+       return None
    def get_voxel_strings(self):
        """ This method should return a dict that maps extended voxel type integers to strings
        """
@@ -41,6 +41,7 @@ class MinecraftDriver(base.YateBaseDriver):
        self.av_yaw           = None
        self.on_ground        = True
        self.world            = smpmap.Dimension(smpmap.DIMENSION_OVERWORLD)
+       self.world_version    = 0    # bumped every time terrain data comes in
        self.sock.blocking_handlers = False
        yatelog.info('minecraft','Awaiting download of avatar position and terrain data')
        while self.av_pos is None:
@@ -79,10 +80,9 @@ class MinecraftDriver(base.YateBaseDriver):
        vox = base.YateBaseVoxel(spatial_pos=tuple(spatial_pos),basic_type=yate_type,specific_type=blockid)
        return vox
    def get_vision_range(self):
-       """ Minecraft chunk sections are 16*16*16 - this would probably be the ideal if it could fit into a single bulk voxel update
-           Sadly it can't, so we return half of that on the (X,Y) plane and a quarter on the Z axis or 8*8*4
+       """ Minecraft chunk sections are 16*16*16 - now that bulk voxel updates are box-encoded with a palette, a whole section fits easily
        """
-       return (8,8,4)
+       return (16,16,16)
    def minecraft_client_tick(self):
        """ This is called 20 times per second and does per-tick things
        """
@@ -98,6 +98,9 @@ class MinecraftDriver(base.YateBaseDriver):
        data['data_size']      = buff.unpack_varint()
        data['data']           = buff.read()
        self.world.unpack_column(data)
+       self.world_version += 1
+   def get_world_version(self):
+       return self.world_version
    def handle_join_game(self,buff):
        self.avatar_eid = buff.unpack_int()
        yatelog.info('minecraft','We are entity ID %s' % self.avatar_eid)
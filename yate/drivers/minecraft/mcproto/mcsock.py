@@ -9,6 +9,7 @@ import crypto
 import packets
 import buffer
 import yatelog
+import yateoffload
 
 
 protocol_modes = {
@@ -166,7 +167,8 @@ class MCSocket:
        if self.compression_enabled:
           uncompressed_len = pack_buff.unpack_varint()
           if uncompressed_len > 0:
-             data = zlib.decompress(pack_buff.read())
+             data = pack_buff.read()
+             data = yateoffload.offload(len(data),zlib.decompress,data) # chunk data at login comes in big lumps
              pack_buff = buffer.Buffer()
              pack_buff.add(data)
        try:
@@ -199,7 +201,7 @@ class MCSocket:
        rawpack = buffer.Buffer.pack_varint(ident) + data
        if self.compression_enabled:
           if len(rawpack) >= self.compression_threshold:
-             rawpack = buffer.Buffer.pack_varint(len(rawpack)) + zlib_compress(rawpack)
+             rawpack = buffer.Buffer.pack_varint(len(rawpack)) + yateoffload.offload(len(rawpack),zlib.compress,rawpack)
           else:
              rawpack = buffer.Buffer.pack_varint(0) + rawpack
 
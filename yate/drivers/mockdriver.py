@@ -31,6 +31,7 @@ class MockDriver(base.YateBaseDriver):
        self.username    = username
        self.password    = password
        self.server_addr = server
+       self.world_version = 0
        self.setup_env()
    def setup_env(self):
        self.env = {}
@@ -50,6 +51,7 @@ class MockDriver(base.YateBaseDriver):
                   x += 1
            y += 1
        self.visual_range = (x/2,y/2,2)
+       self.world_version += 1
 
    def get_pos(self):
        return self.spatial_pos
@@ -77,11 +79,14 @@ class MockDriver(base.YateBaseDriver):
           self.spatial_pos = (new_x,new_y,new_z)
    def get_vision_range(self):
        return self.visual_range
+   def get_world_version(self):
+       return self.world_version
    def destroy_voxel(self,voxel_pos):
        old_vox = self.get_voxel(voxel_pos)
        if not old_vox.can_destroy(): return
        new_vox = base.YateBaseVoxel(spatial_pos=voxel_pos,basic_type=YATE_VOXEL_EMPTY)
        self.env[voxel_pos] = new_vox
+       self.world_version += 1
    def interact_voxel(self,voxel_pos):
        old_vox = self.get_voxel(voxel_pos)
        if not old_vox.can_open(): return
@@ -90,6 +95,7 @@ class MockDriver(base.YateBaseDriver):
        elif old_vox.active_state == YATE_VOXEL_INACTIVE:
           new_vox = base.YateBaseVoxel(spatial_pos=voxel_pos,basic_type=old_vox.basic_type,specific_type=old_vox.specific_type,active_state=YATE_VOXEL_ACTIVE)
        self.env[voxel_pos] = new_vox
+       self.world_version += 1
 
    def get_voxel(self,voxel_pos):
        if self.env.has_key(voxel_pos):
@@ -36,6 +36,16 @@ def iter_within(start,end):
             for z in xrange(start[2],end[2],1):
                 yield (x,y,z)
 
+def clip_range(start,end,clip_start,clip_end):
+    """ Returns the part of the range from start to end that is also inside the range from clip_start to clip_end
+        Returns None if they don't overlap at all
+    """
+    new_start = tuple([max(start[i],clip_start[i]) for i in xrange(3)])
+    new_end   = tuple([min(end[i],clip_end[i]) for i in xrange(3)])
+    for i in xrange(3):
+        if new_start[i] >= new_end[i]: return None
+    return new_start,new_end
+
 def diff(a,b):
     """ Returns the difference between 2 scalars
     """
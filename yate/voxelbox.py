@@ -0,0 +1,127 @@
+""" This file implements the dense box encoding used for MSGTYPE_BULK_VOXEL_UPDATE
+    Instead of sending the coordinates of every single voxel, a bulk update describes a box:
+     origin  is the (x,y,z) coordinate of the lowest corner of the box
+     dims    is the (width,depth,height) of the box
+     palette is a list of (basic_type,specific_type,active_state,intact_state) tuples - each distinct voxel state appears only once
+     flags   is a bitmask of the YATE_BOX_ flags below
+     data    is a msgpack bin field containing one little-endian palette index per voxel
+    Voxels are stored in the same order utils.iter_within() walks them: x is the outer loop and z changes fastest
+    If YATE_BOX_RLE is set, data instead contains (run_length,palette_index) pairs of 16 bit integers
+    A palette entry of None means "unchanged since the last update sent to you" - this is how delta updates are sent, and such voxels are skipped when decoding
+"""
+import array
+import itertools
+import sys
+
+import utils
+
+YATE_BOX_RLE   = 1 # data is run-length encoded
+YATE_BOX_WIDE  = 2 # palette indices are 16 bit instead of 8 bit
+YATE_BOX_DELTA = 4 # palette contains None, so this is a delta against the previous update rather than a full keyframe
+
+YATE_BOX_MAX_RUN     = 0xFFFF # longest run we can fit into a single RLE pair
+YATE_BOX_MAX_PALETTE = 0xFFFF # if you somehow manage to see more distinct voxel states than this, congratulations
+YATE_BOX_CHUNK       = 16*1024 # if encode_box() is given a pause function, it calls it after every this many voxels
+
+def pack_array(a):
+    """ Return the contents of an array as little-endian bytes, which is what goes on the wire
+    """
+    if sys.byteorder != 'little':
+       a = array.array(a.typecode,a)
+       a.byteswap()
+    return a.tostring()
+
+def unpack_array(typecode,data):
+    """ Reverse of pack_array()
+    """
+    a = array.array(typecode)
+    a.fromstring(data)
+    if sys.byteorder != 'little': a.byteswap()
+    return a
+
+def in_chunks(seq,pause):
+    """ Yield seq in slices of YATE_BOX_CHUNK, calling pause() in between - or all of it in one go if pause is None
+    """
+    if pause is None:
+       yield seq
+       return
+    for i in xrange(0,len(seq),YATE_BOX_CHUNK):
+        if i > 0: pause()
+        yield seq[i:i+YATE_BOX_CHUNK]
+
+def encode_box(start,end,states,pause=None):
+    """ Encode a box of voxel states into params for MSGTYPE_BULK_VOXEL_UPDATE
+         start and end are the same as the params to utils.iter_within()
+         states is a sequence of voxel state tuples (see YateBaseVoxel.get_state()) in utils.iter_within() order
+         any state may be None to indicate that voxel is unchanged
+         pause is called every YATE_BOX_CHUNK voxels if it's set, so a big box can let everything else have a go now and then
+    """
+    origin  = utils.round_vector(start)
+    end     = utils.round_vector(end)
+    dims    = (end[0]-origin[0],end[1]-origin[1],end[2]-origin[2])
+    palette = []
+    lookup  = {}
+    indices = []
+    for chunk in in_chunks(states,pause):
+        for state in chunk:
+            index = lookup.get(state)
+            if index is None:
+               index = len(palette)
+               if index > YATE_BOX_MAX_PALETTE: raise ValueError('Too many distinct voxel states for a single box')
+               lookup[state] = index
+               palette.append(state)
+            indices.append(index)
+
+    flags = 0
+    if None in lookup: flags |= YATE_BOX_DELTA
+    if len(palette) > 0x100:
+       flags   |= YATE_BOX_WIDE
+       raw_data = array.array('H')
+    else:
+       raw_data = array.array('B')
+
+    runs     = array.array('H')
+    last     = None
+    run_len  = 0
+    for chunk in in_chunks(indices,pause):
+        raw_data.extend(chunk)
+        for index in chunk:
+            if index == last and run_len < YATE_BOX_MAX_RUN:
+               run_len += 1
+            else:
+               if run_len > 0: runs.extend((run_len,last))
+               last    = index
+               run_len = 1
+    if run_len > 0: runs.extend((run_len,last))
+
+    if (runs.itemsize*len(runs)) < (raw_data.itemsize*len(raw_data)):
+       flags |= YATE_BOX_RLE
+       data   = pack_array(runs)
+    else:
+       data   = pack_array(raw_data)
+    return (origin,dims,tuple(palette),flags,data)
+
+def decode_indices(flags,data):
+    """ Decode the data field of a box into a flat array of palette indices
+    """
+    if flags & YATE_BOX_RLE:
+       runs    = unpack_array('H',data)
+       indices = array.array('H')
+       for i in xrange(0,len(runs),2):
+           indices.extend([runs[i+1]]*runs[i])
+       return indices
+    if flags & YATE_BOX_WIDE: return unpack_array('H',data)
+    return unpack_array('B',data)
+
+def iter_box(msg_params):
+    """ Iterates through a MSGTYPE_BULK_VOXEL_UPDATE box - yields params in the same format as MSGTYPE_VOXEL_UPDATE
+        Unchanged voxels in a delta update are skipped
+    """
+    origin,dims,palette,flags,data = msg_params
+    indices = decode_indices(flags,data)
+    if len(indices) != dims[0]*dims[1]*dims[2]: raise ValueError('Voxel box data does not match dimensions')
+    end = (origin[0]+dims[0],origin[1]+dims[1],origin[2]+dims[2])
+    for vox_pos,index in itertools.izip(utils.iter_within(origin,end),indices):
+        state = palette[index]
+        if state is None: continue
+        yield (vox_pos,) + tuple(state)
@@ -0,0 +1,363 @@
+""" This file implements YATESocket and YATEClient on top of asyncio instead of eventlet
+    Use this if your AI already runs an asyncio event loop - nothing in here monkey patches anything, and everything runs
+    as callbacks on the loop you pass in (or the default one) so there's only ever one event loop
+    Like the rest of yate this is python 2 code, so in practice that's the trollius backport of asyncio - nothing in here
+    relies on trollius' yield From() syntax though, so it's all plain callbacks and futures
+
+    Handlers have the same (msg_params,from_addr,msg_id) signature as with YATESocket, if a handler returns a coroutine
+    or future it gets scheduled on the loop
+"""
+try:
+   import asyncio
+except ImportError:
+   import trollius as asyncio
+
+import time
+import yatelog
+import yatetimer
+import yatestats
+import voxelbox
+from drivers import base
+from yateproto import *
+from yatetransport import YATETransport,timed_handler,arrival_handler
+
+UPDATE_DELAY           = 0.1
+STREAM_RATE            = 10   # updates per second we ask the server to push us, instead of polling every UPDATE_DELAY
+OBSERVATION_QUEUE_SIZE = 4096 # once this many observations are waiting, the oldest get dropped to make room
+
+class YATEAsyncSocket(YATETransport,asyncio.DatagramProtocol):
+   """ implements a YATE UDP socket as an asyncio datagram protocol
+       Unlike YATESocket, nothing happens until start() is called and the future it returns is done
+   """
+   def __init__(self,bind_ip='127.0.0.1',bind_port=0,handlers={},enable_null_handle=True,compression=True,compress_levels={},batch_delay=YATE_BATCH_DELAY,capture=None,loop=None,
+                rcvbuf=YATE_SOCK_RCVBUF,sndbuf=YATE_SOCK_SNDBUF):
+       """ bind_ip and bind_port are where to listen, the default port of 0 picks any free port
+           rcvbuf and sndbuf are the kernel socket buffer sizes to ask for, None leaves the OS default
+           loop is the event loop to run on, if not specified the default one is used
+           everything else is passed to YATETransport, see there for details
+       """
+       self.loop           = loop or asyncio.get_event_loop()
+       self.bind_addr      = (bind_ip,bind_port)
+       self.transport      = None
+       self.timeout_handle = None
+       self.flush_handle   = None
+       self.sock_bufs      = (rcvbuf,sndbuf)
+       YATETransport.__init__(self,handlers,enable_null_handle,compression,compress_levels,batch_delay,capture)
+   def start(self):
+       """ Bind the socket - returns a future that's done once we're ready to go
+       """
+       return asyncio.ensure_future(self.loop.create_datagram_endpoint(lambda: self,local_addr=self.bind_addr),loop=self.loop)
+   def stop(self):
+       """ cancel all our timers and close cleanly
+       """
+       self.active = False
+       if self.transport is None: return
+       self.flush_batches(force=True)
+       for handle in [self.timeout_handle,self.flush_handle]:
+           if handle != None: handle.cancel()
+       self.transport.close()
+       self.close_capture()
+   def connection_made(self,transport):
+       self.transport = transport
+       self.setup_sock_bufs(transport.get_extra_info('socket'),*self.sock_bufs)
+       yatelog.info('YATESock','Bound %s:%s' % self.get_endpoint()[:2])
+       self.timeout_handle = self.loop.call_later(yatetimer.YATE_TIMER_TICK,self.do_timeouts) # keepalives and timeouts all in one place, same as YATESocket
+   def datagram_received(self,data,addr):
+       self.got_datagram(data,addr)
+   def error_received(self,exc):
+       yatelog.warn('YATESock','Error receiving packet: %s' % exc)
+   def get_endpoint(self):
+       """ Return the IP endpoint this socket is bound to
+       """
+       return self.transport.get_extra_info('sockname')
+   def get_recv_stats(self):
+       """ asyncio does the reading for us, so all we've got is what the OS says - see YATESocket.get_recv_stats()
+       """
+       return yatestats.udp_kernel_stats(self.transport.get_extra_info('socket'))
+   def transmit(self,dgram,addr):
+       self.transport.sendto(dgram,addr)
+   def queue_msg(self,msg_type,msg_tuple):
+       """ There's no sender thread to queue things up for, so just send right away - batching still happens in send_datagrams()
+       """
+       if self.transport is None:
+          yatelog.warn('YATESock','Tried to send %s before the socket was started' % msgtype_str[msg_type])
+          return
+       self.send_msg(msg_type,*msg_tuple)
+   def queue_incoming(self,msg_type,msg_tuple):
+       msg_params,msg_id,msg_time,recv_time,from_addr = msg_tuple
+       self.dispatch_msg(msg_type,msg_params,msg_id,from_addr,msg_time,recv_time)
+   def spawn_handler(self,handler,msg_type,msg_params,from_addr,msg_id,msg_time=None,recv_time=None):
+       retval = self.run_handler(handler,msg_type,msg_params,from_addr,msg_id,msg_time,recv_time)
+       if self.still_running(retval):
+          task = asyncio.ensure_future(retval,loop=self.loop)
+          task.add_done_callback(lambda t: self.handler_done(t,msg_type,from_addr))
+   def still_running(self,retval):
+       return asyncio.iscoroutine(retval) or isinstance(retval,asyncio.Future)
+   def handler_done(self,task,msg_type,from_addr):
+       # the handler only counts as finished for YATE_ADMISSION_LIMITS now, not when the coroutine was handed back
+       if msg_type in YATE_ADMISSION_LIMITS: self.release_msg(from_addr,msg_type)
+       if task.cancelled(): return
+       if task.exception() != None:
+          yatelog.warn('YATESock','Error handling message %s: %s' % (msgtype_str[msg_type],task.exception()))
+   def do_timeouts(self):
+       try:
+          self.run_timers()
+       except:
+          yatelog.minor_exception('YATESock','Error running timers')
+       if self.active: self.timeout_handle = self.loop.call_later(yatetimer.YATE_TIMER_TICK,self.do_timeouts)
+   def schedule_flush(self,delay):
+       if self.flush_handle is None: self.flush_handle = self.loop.call_later(delay,self.do_flush)
+   def do_flush(self):
+       self.flush_handle = None
+       self.flush_batches()
+       delay = self.next_flush_delay()
+       if delay != None: self.schedule_flush(delay)
+
+class YATEAsyncClient:
+   """ This class is used to connect to a YATE proxy server from an asyncio event loop
+       It works the same as YATEClient, but as well as the callbacks every observation also goes into a queue so you can
+       await them with next_observation()
+   """
+   def __init__(self,server_addr=None,connect_cb=None,disconnect_cb=None,voxel_update_cb=None,avatar_pos_cb=None,stream_rate=STREAM_RATE,loop=None):
+       """ server_addr is a tuple of (ip,port) - this should usually be something on localhost for security reasons
+           the callbacks and stream_rate are the same as for YATEClient
+           loop is the event loop to run on, if not specified the default one is used
+           Nothing happens until you call start()
+       """
+       self.loop            = loop or asyncio.get_event_loop()
+       self.server_addr     = server_addr
+       self.connected       = False
+       self.ready           = False
+       self.connect_cb      = connect_cb
+       self.disconnect_cb   = disconnect_cb
+       self.voxel_update_cb = voxel_update_cb
+       self.avatar_pos_cb   = avatar_pos_cb
+       self.avatar_pos      = None
+       self.avatar_pos_time = None          # when avatar_pos was read from the game by our clock, if the server said
+       self.voxels_time     = None          # and the same for the latest voxel update
+       self.subscription    = (None,None,0) # (msg_types,region,max_rate) that we sent with MSGTYPE_SUBSCRIBE
+       self.stream_rate     = stream_rate
+       self.streaming       = 0             # the push rate the server agreed to, while this is 0 we poll
+       self.visual_range    = None
+       self.connect_future  = None
+       self.update_handle   = None
+       self.timeout_handle  = None
+       self.observations    = asyncio.Queue(maxsize=OBSERVATION_QUEUE_SIZE)
+       self.pending         = {} # maps msg_ids of requests to the future waiting on a reply
+       self.handlers = {MSGTYPE_CONNECT_ACK:       self.handle_connect_ack,
+                        MSGTYPE_VISUAL_RANGE:      self.handle_visual_range,
+                        MSGTYPE_VOXEL_UPDATE:      self.handle_voxel_update,
+                        MSGTYPE_BULK_VOXEL_UPDATE: self.handle_bulk_voxel,
+                        MSGTYPE_AVATAR_POS:        self.handle_avatar_pos}
+       for msg_type in YATE_REPLY_TYPES: self.handlers[msg_type] = self.handle_reply
+       self.sock = YATEAsyncSocket(handlers=self.handlers,loop=self.loop)
+   def start(self):
+       """ Start the socket and connect to server_addr if we have one - returns a future that's done once the server lets us in
+       """
+       self.connect_future = asyncio.Future(loop=self.loop)
+       self.sock.start().add_done_callback(self.sock_started)
+       return self.connect_future
+   def sock_started(self,started):
+       if started.exception() != None:
+          self.connect_future.set_exception(started.exception())
+          return
+       if self.server_addr != None: self.connect_to(self.server_addr)
+   def next_observation(self):
+       """ Returns an awaitable for the next observation, which is a tuple of (msg_type,value):
+            (MSGTYPE_AVATAR_POS,(x,y,z)) when the avatar moves
+            (MSGTYPE_VOXEL_UPDATE,voxel) when a visible voxel is updated, voxel is a YateBaseVoxel
+       """
+       return self.observations.get()
+   def add_observation(self,msg_type,value):
+       if self.observations.full(): self.observations.get_nowait() # you fell behind, fresh state beats a backlog
+       self.observations.put_nowait((msg_type,value))
+   def subscribe(self,msg_types=None,region=None,max_rate=0):
+       """ Tell the server what we want it to push to us, by default it pushes everything as fast as it can
+           msg_types is a list of message types, or None for all of them
+           region is a tuple of (start,end) coordinates - only voxels inside it get sent - or None for everywhere
+           max_rate is the most messages of each type per second we want, 0 for no limit
+       """
+       self.subscription = (msg_types,region,max_rate)
+       if self.sock.is_connected(self.server_addr): self.sock.send_subscribe(msg_types,region,max_rate,to_addr=self.server_addr)
+   def wants(self,msg_type):
+       """ Check if our subscription includes the specified message type, so we don't ask for stuff we don't want
+       """
+       return (self.subscription[0] is None) or (msg_type in self.subscription[0])
+   def request(self,msg_type,msg_params,retries=0,timeout=YATE_REQUEST_TIMEOUT,result_fn=None):
+       """ Send a request to the server and return a future for the reply - see YATE_REPLY_TYPES for what gets replies
+           retries is how many times to send it again if no reply turns up within timeout seconds, only use this for idempotent queries
+           result_fn is called with the reply params to work out the result, by default the result is the reply params without the msg_id
+           If there's still no reply after retrying, the future raises YATERequestTimeout
+       """
+       req = asyncio.Future(loop=self.loop)
+       req.msg_type   = msg_type
+       req.msg_params = msg_params
+       req.retries    = retries
+       req.timeout    = timeout
+       req.result_fn  = result_fn or (lambda p: p[:-1])
+       req.msg_ids    = [] # every msg_id we've sent this request with, a reply to any of them will do
+       req.timer      = None
+       self.send_request(req)
+       return req
+   def send_request(self,req):
+       send_method = getattr(self.sock,'send_%s' % msgtype_str[req.msg_type][8:].lower())
+       msg_id      = send_method(*req.msg_params,to_addr=self.server_addr)
+       req.msg_ids.append(msg_id)
+       self.pending[msg_id] = req
+       req.timer = self.loop.call_later(req.timeout,self.request_timed_out,req)
+   def request_timed_out(self,req):
+       if req.done(): return
+       if req.retries > 0:
+          req.retries -= 1
+          yatelog.debug('YATEClient','No reply to %s, trying again' % msgtype_str[req.msg_type])
+          self.send_request(req)
+          return
+       for msg_id in req.msg_ids: self.pending.pop(msg_id,None)
+       req.set_exception(YATERequestTimeout('No reply to %s after %s tries' % (msgtype_str[req.msg_type],len(req.msg_ids))))
+   def handle_reply(self,msg_params,from_addr,msg_id):
+       """ Handles all of YATE_REPLY_TYPES - the msg_id of the request is always the last param
+       """
+       req = self.pending.get(msg_params[-1])
+       if req is None: return # a reply to a retry we already got an answer for, or something we never asked
+       for req_id in req.msg_ids: self.pending.pop(req_id,None)
+       req.timer.cancel()
+       if req.done(): return # cancelled by whoever was waiting on it
+       try:
+          req.set_result(req.result_fn(msg_params))
+       except Exception as e:
+          req.set_exception(e)
+   def dist_to(self,pos):
+       """ Ask for the distance from the avatar to pos, returns a future that gives the distance
+       """
+       return self.request(MSGTYPE_REQ_DIST_TO,tuple(pos),retries=YATE_REQUEST_RETRIES,result_fn=lambda p: p[3])
+   def nearest_voxel(self,basic_type,extended_type=None):
+       """ Ask for the position of the nearest visible voxel of the specified type, returns a future that gives (x,y,z) or None
+       """
+       return self.request(MSGTYPE_REQ_NEAREST_VOXEL,(basic_type,extended_type),retries=YATE_REQUEST_RETRIES,result_fn=lambda p: p[2])
+   def get_server_stats(self):
+       """ Ask the server for its transport stats, returns a future that gives a dict - see YATETransport.get_stats()
+       """
+       return self.request(MSGTYPE_REQUEST_STATS,(),result_fn=lambda p: p[0])
+   def move_vector(self,v):
+       """ Send a request to move in the specified vector if possible
+       """
+       self.sock.send_move_vector(*v,to_addr = self.server_addr)
+   def get_port(self):
+       return self.sock.get_endpoint()[1]
+   def get_visual_range(self):
+       """ Return the current visual range or (0,0,0) if unknown
+       """
+       if self.visual_range != None: return self.visual_range
+       self.sock.send_request_range()
+       return (0,0,0)
+   @timed_handler
+   def handle_bulk_voxel(self,msg_params,from_addr,msg_id,msg_time):
+       """ bulk voxel updates are preferred for performance reasons - see voxelbox.py for the format
+       """
+       self.voxels_time = msg_time
+       for vox_params in voxelbox.iter_box(msg_params):
+           new_vox = base.YateBaseVoxel(from_params = vox_params,observed_at = msg_time)
+           self.add_observation(MSGTYPE_VOXEL_UPDATE,new_vox)
+           if self.voxel_update_cb != None: self.voxel_update_cb(new_vox)
+   def handle_visual_range(self,msg_params,from_addr,msg_id):
+       """ update the visual range so we can limit queries appropriately
+       """
+       self.visual_range = msg_params
+   @timed_handler
+   def handle_voxel_update(self,msg_params,from_addr,msg_id,msg_time):
+       """ handle single voxel updates
+       """
+       self.voxels_time = msg_time
+       new_vox = base.YateBaseVoxel(from_params = msg_params,observed_at = msg_time)
+       yatelog.debug('YATEClient','Updating voxel: %s' % str(new_vox))
+       self.add_observation(MSGTYPE_VOXEL_UPDATE,new_vox)
+       if self.voxel_update_cb != None: self.voxel_update_cb(new_vox)
+   @timed_handler
+   def handle_avatar_pos(self,msg_params,from_addr,msg_id,msg_time):
+       """ handle avatar position updates
+       """
+       self.avatar_pos      = msg_params
+       self.avatar_pos_time = msg_time
+       self.add_observation(MSGTYPE_AVATAR_POS,msg_params)
+       if self.avatar_pos_cb != None: self.avatar_pos_cb(self.avatar_pos)
+   def handle_connect_ack(self,msg_params,from_addr,msg_id):
+       if self.connected: return # a late or duplicate ACK, the update and keepalive timers are already going
+       yatelog.info('YATEClient','Successfully connected to server')
+       self.ready     = True
+       self.connected = True
+       if self.subscription != (None,None,0): self.sock.send_subscribe(*self.subscription,to_addr=self.server_addr)
+       self.streaming = 0
+       if self.stream_rate > 0: self.request_stream()
+       self.do_updates()
+       self.timeout_handle = self.loop.call_later(YATE_KEEPALIVE_TIMEOUT+1,self.do_keepalive)
+       if self.connect_future != None and not self.connect_future.done(): self.connect_future.set_result(True)
+       if self.connect_cb != None: self.connect_cb()
+   def set_stream_rate(self,rate):
+       """ Change how many updates per second the server pushes to us, 0 goes back to polling
+       """
+       self.stream_rate = rate
+       if self.ready: self.request_stream()
+   def request_stream(self):
+       self.request(MSGTYPE_STREAM,(self.stream_rate,),retries=YATE_REQUEST_RETRIES,result_fn=lambda p: p[0]).add_done_callback(self.stream_started)
+   def stream_started(self,req):
+       if req.cancelled(): return
+       if req.exception() != None:
+          if self.ready: yatelog.warn('YATEClient','Server did not agree to push updates, polling instead')
+          self.streaming = 0
+          return
+       self.streaming = req.result()
+   def do_updates(self):
+       """ Poll for updates, unless the server is pushing them to us anyway
+       """
+       if not self.ready: return
+       if not self.streaming:
+          if self.wants(MSGTYPE_BULK_VOXEL_UPDATE): self.sock.send_visible_voxel_req(to_addr=self.server_addr)
+          if self.wants(MSGTYPE_AVATAR_POS):        self.sock.send_request_pos(to_addr=self.server_addr)
+       self.update_handle = self.loop.call_later(UPDATE_DELAY,self.do_updates)
+   def do_keepalive(self):
+       if not self.ready: return
+       if not self.sock.is_connected(self.server_addr):
+          yatelog.info('YATEClient','Timed out server')
+          self.ready     = False
+          self.connected = False
+          if self.disconnect_cb != None: self.disconnect_cb()
+          return
+       self.timeout_handle = self.loop.call_later(YATE_KEEPALIVE_TIMEOUT+1,self.do_keepalive)
+   def stop(self):
+       """ Stop the client - cancel any timers and close the socket cleanly
+           Any futures still waiting on a reply to a request raise YATERequestTimeout
+       """
+       self.ready = False
+       for handle in [self.update_handle,self.timeout_handle]:
+           if handle != None: handle.cancel()
+       for req in set(self.pending.values()):
+           if req.timer != None: req.timer.cancel()
+           if not req.done(): req.set_exception(YATERequestTimeout('Client stopped before %s got a reply' % msgtype_str[req.msg_type]))
+       self.pending.clear()
+       self.sock.stop()
+       self.server_addr = None
+   def get_avatar_pos_age(self):
+       """ Same as YATEClient.get_avatar_pos_age()
+       """
+       if self.avatar_pos_time is None: return None
+       return time.time() - self.avatar_pos_time
+   def get_voxels_age(self):
+       """ Same as YATEClient.get_voxels_age()
+       """
+       if self.voxels_time is None: return None
+       return time.time() - self.voxels_time
+   def get_clock_offset(self):
+       return self.sock.get_clock_offset(self.server_addr)
+   def is_connected(self):
+       """ returns a boolean value indicating whether or not we're connected AND ready to talk to the proxy
+       """
+       if self.server_addr == None: return False
+       if not self.sock.is_connected(self.server_addr): return False
+       if not self.ready: return False
+       return True
+   def connect_to(self,server_addr):
+       """ if a server address was not passed into __init__, use this to connect - the socket must already be started
+       """
+       yatelog.info('YATEClient','Connecting to server at %s:%s' % server_addr)
+       self.server_addr = server_addr
+       self.sock.connect_to(server_addr)
@@ -0,0 +1,220 @@
+""" This file implements the TCP side channel for big transfers that don't belong on UDP - string tables, region snapshots etc
+    A server with the channel turned on advertises the TCP port in the caps it sends with MSGTYPE_CONNECT_ACK as 'tcp',
+    and only peers it knows over UDP are allowed to use it - each one also gets a random 'tcp_token' in its caps, which
+    only it and the server know, so nobody else on the machine can pretend to be it just by knowing its UDP port
+    Everything on the stream is a msgpack frame prefixed with its length as YATE_BULK_LENGTH:
+     client: (peer_port,token,name,args,transfer_id,offset) asks for the named transfer, or to resume transfer_id from offset
+                                                            peer_port is the client's UDP port so the server knows who's asking
+                                                            and token is the 'tcp_token' the server gave that UDP port
+     server: (transfer_id,size,offset,error)                followed by the payload from offset up to size, unless error is set
+    The payload is the zlib compressed msgpack encoding of whatever the transfer function returned, and the server keeps it
+    around for a while after sending so a transfer that got cut off can carry on where it left off
+"""
+import eventlet
+import os
+import hmac
+import socket
+import struct
+import time
+import zlib
+import itertools
+import msgpack
+
+import yatelog
+import yateoffload
+from yateproto import *
+
+YATE_BULK_LENGTH     = '!I'             # length prefix of each frame
+YATE_BULK_MAX_FRAME  = 64*1024          # no request or response header is ever this big, anything that claims to be is garbage
+YATE_BULK_ZLIB_LEVEL = 6
+YATE_BULK_KEEP_TIME  = 30.0             # seconds to keep a payload after it was last asked for, so it can be resumed
+YATE_BULK_KEEP_BYTES = 64*1024*1024     # most payload bytes to keep, the least recently used get thrown away first
+YATE_BULK_TIMEOUT    = 10.0             # seconds a client waits on a stalled connection before reconnecting
+YATE_BULK_RETRIES    = 3                # how many times a client reconnects and resumes before giving up
+YATE_BULK_MAX_CONNS  = 64
+YATE_BULK_IDLE_TIME  = 60.0             # seconds before the server hangs up on a client that isn't asking for anything
+YATE_BULK_MAX_VOXELS = 4*1024*1024      # biggest region snapshot YATEServer will put together
+YATE_BULK_TOKEN_SIZE = 16               # random bytes in each peer's token
+
+def send_frame(conn,obj):
+    data = msgpack.packb(obj,use_bin_type=True)
+    conn.sendall(struct.pack(YATE_BULK_LENGTH,len(data)) + data)
+
+def recv_into_exactly(conn,view):
+    """ Fill a memoryview from the socket, returns how many bytes we got - less than asked for means the other end hung up
+    """
+    got = 0
+    while got < len(view):
+       n = conn.recv_into(view[got:])
+       if n==0: break
+       got += n
+    return got
+
+def recv_frame(conn):
+    """ Read a frame, returns None if the connection was closed cleanly before it started
+    """
+    length_size = struct.calcsize(YATE_BULK_LENGTH)
+    buf         = bytearray(length_size)
+    got         = recv_into_exactly(conn,memoryview(buf))
+    if got==0: return None
+    if got < length_size: raise socket.error('Connection closed in the middle of a frame')
+    length = struct.unpack(YATE_BULK_LENGTH,str(buf))[0]
+    if length > YATE_BULK_MAX_FRAME: raise ValueError('Frame too big: %s bytes' % length)
+    buf = bytearray(length)
+    if recv_into_exactly(conn,memoryview(buf)) < length: raise socket.error('Connection closed in the middle of a frame')
+    return msgpack.unpackb(str(buf),use_list=False)
+
+class YATEBulkServer:
+   """ Serves transfers over TCP to peers of a YATESocket
+   """
+   def __init__(self,sock,transfers,bind_ip='127.0.0.1',bind_port=0):
+       """ sock is the YATESocket whose peers we serve, the port we end up on gets added to its caps
+           transfers maps names to functions, their return value is what gets sent - it must be something msgpack can encode
+       """
+       self.sock         = sock
+       self.transfers    = transfers
+       self.kept         = {} # maps transfer IDs to [last asked for,payload]
+       self.tokens       = {} # maps peers to the token they have to send with every request
+       self.kept_bytes   = 0
+       self.transfer_ids = itertools.count(1)
+       self.active       = True
+       self.listener     = eventlet.listen((bind_ip,bind_port))
+       self.pool         = eventlet.GreenPool(YATE_BULK_MAX_CONNS)
+       self.sock.caps['tcp'] = self.get_port()
+       self.sock.peer_cap_fns['tcp_token'] = self.get_token
+       yatelog.info('YATEBulk','Serving bulk transfers on TCP %s:%s' % self.listener.getsockname())
+       eventlet.spawn_n(self.accept_thread)
+   def get_port(self):
+       return self.listener.getsockname()[1]
+   def stop(self):
+       self.active = False
+       self.sock.caps.pop('tcp',None)
+       self.sock.peer_cap_fns.pop('tcp_token',None)
+       self.listener.close()
+   def get_token(self,addr):
+       """ Return the token a peer has to send with its requests, making one up if it doesn't have one yet
+       """
+       for peer in self.tokens.keys():
+           if not self.sock.is_connected(peer): del self.tokens[peer]
+       if not (addr in self.tokens): self.tokens[addr] = os.urandom(YATE_BULK_TOKEN_SIZE).encode('hex')
+       return self.tokens[addr]
+   def accept_thread(self):
+       while self.active:
+          try:
+             conn,addr = self.listener.accept()
+          except:
+             if not self.active: return
+             yatelog.minor_exception('YATEBulk','Error accepting connection')
+             continue
+          self.pool.spawn_n(self.serve_conn,conn,addr)
+   def serve_conn(self,conn,addr):
+       """ Answer requests on a connection one after another until the client hangs up
+       """
+       conn.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+       conn.settimeout(YATE_BULK_IDLE_TIME)
+       try:
+          while self.active:
+             req = recv_frame(conn)
+             if req is None: break
+             if not self.handle_request(conn,addr,req): break
+       except socket.error,e:
+          yatelog.debug('YATEBulk','Lost connection from %s:%s: %s' % (addr[0],addr[1],e))
+       except:
+          yatelog.minor_exception('YATEBulk','Error serving %s:%s' % addr)
+       finally:
+          conn.close()
+   def handle_request(self,conn,addr,req):
+       """ Send whatever was asked for, returns False if the connection should be closed
+       """
+       peer_port,token,name,args,transfer_id,offset = req
+       peer = (addr[0],peer_port)
+       if not (self.sock.is_connected(peer) and peer in self.tokens and hmac.compare_digest(str(token),self.tokens[peer])):
+          yatelog.warn('YATEBulk','Bulk transfer request from unknown peer %s:%s' % peer)
+          send_frame(conn,(None,0,0,'Unknown peer'))
+          return False
+       payload = self.get_kept(transfer_id)
+       if payload is None:
+          if not (name in self.transfers):
+             send_frame(conn,(None,0,0,'No such transfer: %s' % name))
+             return True
+          try:
+             result = self.transfers[name](*args)
+          except Exception,e:
+             yatelog.warn('YATEBulk','Transfer %s failed: %s' % (name,e))
+             send_frame(conn,(None,0,0,'Transfer %s failed: %s' % (name,e)))
+             return True
+          payload     = msgpack.packb(result,use_bin_type=True)
+          payload     = yateoffload.offload(len(payload),zlib.compress,payload,YATE_BULK_ZLIB_LEVEL)
+          transfer_id = self.keep(payload)
+          offset      = 0
+       offset = max(0,min(offset,len(payload)))
+       yatelog.debug('YATEBulk','Sending transfer %s (%s) to %s:%s from %s of %s bytes' % (transfer_id,name,addr[0],peer_port,offset,len(payload)))
+       send_frame(conn,(transfer_id,len(payload),offset,None))
+       conn.sendall(buffer(payload,offset))
+       return True
+   def get_kept(self,transfer_id):
+       if transfer_id is None: return None
+       kept = self.kept.get(transfer_id)
+       if kept is None: return None
+       kept[0] = time.time()
+       return kept[1]
+   def keep(self,payload):
+       """ Hang onto a payload in case the client needs to resume it and return its transfer ID
+       """
+       cur_time = time.time()
+       for k,v in self.kept.items():
+           if cur_time - v[0] > YATE_BULK_KEEP_TIME: self.forget(k)
+       while self.kept and self.kept_bytes + len(payload) > YATE_BULK_KEEP_BYTES:
+           self.forget(min(self.kept.keys(),key=lambda k: self.kept[k][0]))
+       transfer_id = self.transfer_ids.next()
+       self.kept[transfer_id] = [cur_time,payload]
+       self.kept_bytes       += len(payload)
+       return transfer_id
+   def forget(self,transfer_id):
+       self.kept_bytes -= len(self.kept.pop(transfer_id)[1])
+
+class YATEBulkClient:
+   """ Fetches transfers from a YATEBulkServer, reconnecting and resuming if the connection drops
+   """
+   def __init__(self,server_addr,peer_port,token):
+       """ server_addr is the (ip,port) of the TCP channel, peer_port is our UDP port that the server knows us by
+           token is the 'tcp_token' the server sent in its caps
+       """
+       self.server_addr = server_addr
+       self.peer_port   = peer_port
+       self.token       = token
+       self.conn        = None
+   def close(self):
+       if self.conn is None: return
+       self.conn.close()
+       self.conn = None
+   def connect(self):
+       self.conn = socket.create_connection(self.server_addr,YATE_BULK_TIMEOUT)
+       self.conn.setsockopt(socket.IPPROTO_TCP,socket.TCP_NODELAY,1)
+   def fetch(self,name,*args):
+       """ Fetch the named transfer and return the result, raises YATEBulkError if it can't be done
+       """
+       transfer_id = None
+       payload     = None
+       got         = 0
+       for attempt in xrange(YATE_BULK_RETRIES+1):
+           try:
+              if self.conn is None: self.connect()
+              send_frame(self.conn,(self.peer_port,self.token,name,args,transfer_id,got))
+              resp = recv_frame(self.conn)
+              if resp is None: raise socket.error('Connection closed')
+              new_id,size,offset,error = resp
+              if error != None: raise YATEBulkError(error)
+              if new_id != transfer_id or offset != got: # the server lost track of it and started again
+                 payload,got = bytearray(size),offset
+              transfer_id = new_id
+              view = memoryview(payload)
+              while got < size: # not recv_into_exactly(), so we know how far we got if the connection dies
+                 n = self.conn.recv_into(view[got:])
+                 if n==0: raise socket.error('Connection closed after %s of %s bytes' % (got,size))
+                 got += n
+              return msgpack.unpackb(yateoffload.offload(size,zlib.decompress,buffer(payload)),use_list=False)
+           except (socket.error,socket.timeout),e:
+              yatelog.warn('YATEBulk','Transfer of %s interrupted at %s bytes: %s' % (name,got,e))
+              self.close()
+       raise YATEBulkError('Transfer of %s failed after %s tries' % (name,YATE_BULK_RETRIES+1))
@@ -0,0 +1,55 @@
+""" This file implements a least recently used cache with a limit on how many bytes it holds, used by YATE sockets to keep
+    messages that get sent over and over again (see YATETransport.send_cached()) in their final encoded and compressed form
+    The cache doesn't know how big anything is, whoever puts something in tells it
+"""
+import collections
+
+class YATELRUCache:
+   def __init__(self,max_bytes,max_entries=None):
+       """ max_bytes is the most the sizes of everything in the cache may add up to, max_entries is the most things it may
+           hold, None for no limit - when either limit is hit, the least recently used things get thrown away to make room
+       """
+       self.max_bytes   = max_bytes
+       self.max_entries = max_entries
+       self.entries     = collections.OrderedDict() # maps keys to (size,value), least recently used first
+       self.size        = 0
+       self.hits        = 0
+       self.misses      = 0
+       self.evictions   = 0
+   def __len__(self):
+       return len(self.entries)
+   def __contains__(self,key):
+       return key in self.entries
+   def get(self,key,default=None):
+       """ Return what's cached for key, or default if there isn't anything
+       """
+       entry = self.entries.pop(key,None)
+       if entry is None:
+          self.misses += 1
+          return default
+       self.entries[key] = entry # move it to the most recently used end
+       self.hits += 1
+       return entry[1]
+   def put(self,key,value,size):
+       """ Cache value under key, size is how many bytes it counts as - anything bigger than max_bytes is just not cached
+       """
+       self.discard(key)
+       if size > self.max_bytes: return
+       while self.entries and ((self.size + size > self.max_bytes) or (self.max_entries != None and len(self.entries) >= self.max_entries)):
+          old_key,old_entry = self.entries.popitem(last=False)
+          self.size      -= old_entry[0]
+          self.evictions += 1
+       self.entries[key] = (size,value)
+       self.size        += size
+   def discard(self,key):
+       entry = self.entries.pop(key,None)
+       if entry != None: self.size -= entry[0]
+   def clear(self):
+       self.entries.clear()
+       self.size = 0
+   def get_stats(self):
+       return {'entries':   len(self.entries),
+               'bytes':     self.size,
+               'hits':      self.hits,
+               'misses':    self.misses,
+               'evictions': self.evictions}
@@ -0,0 +1,38 @@
+""" This file implements capture files for recording YATE traffic, see yate_replay.py for playing them back
+    A capture file is just a stream of msgpack-encoded records, appended to as messages go in and out:
+     (timestamp,direction,peer,msg_type,msg_params,msg_id)
+    direction is YATE_CAPTURE_IN or YATE_CAPTURE_OUT, peer is the (ip,port) the message came from or went to - or None for
+    broadcasts - and the rest is the message exactly as it went over the wire
+    Every time a socket opens a capture file it first writes a YATE_CAPTURE_MAGIC record, so files can be appended to safely
+"""
+import time
+import msgpack
+
+YATE_CAPTURE_MAGIC = ('YATECAP',1) # (magic,version)
+YATE_CAPTURE_IN    = 0
+YATE_CAPTURE_OUT   = 1
+
+class YATECaptureWriter:
+   def __init__(self,filename):
+       self.fd     = open(filename,'ab')
+       self.packer = msgpack.Packer(use_bin_type=True)
+       self.fd.write(self.packer.pack(YATE_CAPTURE_MAGIC))
+   def write(self,direction,peer,msg_type,msg_params,msg_id):
+       self.fd.write(self.packer.pack((time.time(),direction,peer,msg_type,msg_params,msg_id)))
+   def flush(self):
+       self.fd.flush()
+   def close(self):
+       self.fd.close()
+
+def read_capture(filename,direction=None):
+    """ Iterate through the records in a capture file, only yielding records going in the specified direction if there is one
+    """
+    with open(filename,'rb') as fd:
+       for record in msgpack.Unpacker(fd,use_list=False):
+           if len(record)==len(YATE_CAPTURE_MAGIC):
+              if record[0] != YATE_CAPTURE_MAGIC[0]: raise ValueError('%s is not a YATE capture file' % filename)
+              continue
+           if direction != None and record[1] != direction: continue
+           timestamp,record_dir,peer,msg_type,msg_params,msg_id = record
+           if peer != None: peer = tuple(peer)
+           yield (timestamp,record_dir,peer,msg_type,msg_params,msg_id)
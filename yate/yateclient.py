@@ -5,6 +5,9 @@ import yatesock
 import yatelog
 
 import yateproto
+import voxelbox
+import yateshm
+import yatebulk
 from drivers import base
 from yateproto import *
 
@@ -12,16 +15,41 @@ import time
 import utils
 
 UPDATE_DELAY=0.1
+STREAM_RATE=10      # updates per second we ask the server to push us, instead of polling every UPDATE_DELAY
+SHM_POLL_DELAY=0.01 # polling shared memory costs next to nothing, so we can do it much more often
+
+class YATERequest:
+   """ A reply we're waiting on, returned by YATEClient.request()
+   """
+   def __init__(self,msg_type,msg_params,retries,timeout,result_fn):
+       self.msg_type   = msg_type
+       self.msg_params = msg_params
+       self.retries    = retries
+       self.timeout    = timeout
+       self.result_fn  = result_fn or (lambda p: p[:-1])
+       self.msg_ids    = [] # every msg_id we've sent this request with, a reply to any of them will do
+       self.timer      = None
+       self.event      = eventlet.event.Event()
+   def ready(self):
+       """ Returns True once the reply is in or we gave up
+       """
+       return self.event.ready()
+   def wait(self):
+       """ Block until the reply turns up and return the result, raises YATERequestTimeout if it never does
+       """
+       return self.event.wait()
 
 class YATEClient:
    """ This class is used to connect to a YATE proxy server
    """
 
-   def __init__(self,server_addr=None,connect_cb=None,disconnect_cb=None,voxel_update_cb=None,avatar_pos_cb=None):
+   def __init__(self,server_addr=None,connect_cb=None,disconnect_cb=None,voxel_update_cb=None,avatar_pos_cb=None,stream_rate=STREAM_RATE):
        """ server_addr is a tuple of (ip,port) - this should usually be something on localhost for security reasons
            connect_cb and disconnect_cb are callback functions that will be invoked upon successful connect/disconnect - they have no params
            voxel_update_cb is called when a visible voxel is updated and is passed a voxel object as the only parameter
            avatar_pos_cb   is called when the AI avatar moves and is passed a tuple representing the new coordinates
+           stream_rate     is how many updates per second to ask the server to push to us, 0 means poll for them instead
+                           if the server doesn't do streaming we fall back to polling anyway
 
        """
        self.server_addr     = server_addr
@@ -33,15 +61,109 @@ class YATEClient:
        self.voxel_update_cb = voxel_update_cb
        self.avatar_pos_cb   = avatar_pos_cb
        self.avatar_pos      = None
+       self.avatar_pos_time = None          # when avatar_pos was read from the game by our clock, if the server said
+       self.voxels_time     = None          # and the same for the latest voxel update
+       self.subscription    = (None,None,0) # (msg_types,region,max_rate) that we sent with MSGTYPE_SUBSCRIBE
+       self.stream_rate     = stream_rate
+       self.streaming       = 0             # the push rate the server agreed to, while this is 0 we poll
+       self.pending         = {} # maps msg_ids of requests to the YATERequest waiting on a reply
+       self.bulk            = None # YATEBulkClient for the server's TCP side channel, set up the first time we need it
        self.pool = eventlet.GreenPool(1000)
        self.handlers = {MSGTYPE_CONNECT_ACK:       self.handle_connect_ack,
                         MSGTYPE_VISUAL_RANGE:      self.handle_visual_range,
                         MSGTYPE_VOXEL_UPDATE:      self.handle_voxel_update,
                         MSGTYPE_BULK_VOXEL_UPDATE: self.handle_bulk_voxel,
                         MSGTYPE_AVATAR_POS:        self.handle_avatar_pos}
+       for msg_type in YATE_REPLY_TYPES: self.handlers[msg_type] = self.handle_reply
        self.sock         = yatesock.YATESocket(handlers=self.handlers)
        self.visual_range = None
        if self.server_addr != None: self.connect_to(self.server_addr)
+   def subscribe(self,msg_types=None,region=None,max_rate=0):
+       """ Tell the server what we want it to push to us, by default it pushes everything as fast as it can
+           msg_types is a list of message types, or None for all of them
+           region is a tuple of (start,end) coordinates - only voxels inside it get sent - or None for everywhere
+           max_rate is the most messages of each type per second we want, 0 for no limit
+       """
+       self.subscription = (msg_types,region,max_rate)
+       if self.sock.is_connected(self.server_addr): self.sock.send_subscribe(msg_types,region,max_rate,to_addr=self.server_addr)
+   def wants(self,msg_type):
+       """ Check if our subscription includes the specified message type, so we don't ask for stuff we don't want
+       """
+       return (self.subscription[0] is None) or (msg_type in self.subscription[0])
+   def request(self,msg_type,msg_params,retries=0,timeout=YATE_REQUEST_TIMEOUT,result_fn=None):
+       """ Send a request to the server and return a YATERequest for the reply - see YATE_REPLY_TYPES for what gets replies
+           retries is how many times to send it again if no reply turns up within timeout seconds, only use this for idempotent queries
+           result_fn is called with the reply params to work out the result, by default the result is the reply params without the msg_id
+           You can send as many requests as you like before waiting on any of them
+       """
+       req = YATERequest(msg_type,msg_params,retries,timeout,result_fn)
+       self.send_request(req)
+       return req
+   def send_request(self,req):
+       send_method = getattr(self.sock,'send_%s' % msgtype_str[req.msg_type][8:].lower())
+       msg_id      = send_method(*req.msg_params,to_addr=self.server_addr)
+       req.msg_ids.append(msg_id)
+       self.pending[msg_id] = req
+       req.timer = eventlet.spawn_after(req.timeout,self.request_timed_out,req)
+   def request_timed_out(self,req):
+       if req.ready(): return
+       if req.retries > 0:
+          req.retries -= 1
+          yatelog.debug('YATEClient','No reply to %s, trying again' % msgtype_str[req.msg_type])
+          self.send_request(req)
+          return
+       for msg_id in req.msg_ids: self.pending.pop(msg_id,None)
+       req.event.send_exception(YATERequestTimeout('No reply to %s after %s tries' % (msgtype_str[req.msg_type],len(req.msg_ids))))
+   def handle_reply(self,msg_params,from_addr,msg_id):
+       """ Handles all of YATE_REPLY_TYPES - the msg_id of the request is always the last param
+       """
+       req = self.pending.get(msg_params[-1])
+       if req is None: return # a reply to a retry we already got an answer for, or something we never asked
+       for req_id in req.msg_ids: self.pending.pop(req_id,None)
+       if req.timer != None: req.timer.cancel()
+       try:
+          req.event.send(req.result_fn(msg_params))
+       except Exception,e:
+          req.event.send_exception(e)
+   def dist_to(self,pos):
+       """ Ask for the distance from the avatar to pos, returns a YATERequest that gives the distance
+       """
+       return self.request(MSGTYPE_REQ_DIST_TO,tuple(pos),retries=YATE_REQUEST_RETRIES,result_fn=lambda p: p[3])
+   def nearest_voxel(self,basic_type,extended_type=None):
+       """ Ask for the position of the nearest visible voxel of the specified type, returns a YATERequest that gives (x,y,z) or None
+       """
+       return self.request(MSGTYPE_REQ_NEAREST_VOXEL,(basic_type,extended_type),retries=YATE_REQUEST_RETRIES,result_fn=lambda p: p[2])
+   def get_server_stats(self):
+       """ Ask the server for its transport stats, returns a YATERequest that gives a dict - see YATETransport.get_stats()
+       """
+       return self.request(MSGTYPE_REQUEST_STATS,(),result_fn=lambda p: p[0])
+   def get_bulk(self,name,*args):
+       """ Fetch something big over the server's TCP side channel and return it, see yatebulk.py - this blocks until it's all here
+           Raises YATEBulkError if the server doesn't have the channel or the transfer fails
+       """
+       caps     = self.sock.peer_caps.get(self.server_addr,{})
+       tcp_port = caps.get('tcp')
+       if not tcp_port: raise YATEBulkError('Server does not do bulk transfers')
+       if self.bulk is None or self.bulk.server_addr != (self.server_addr[0],tcp_port) or self.bulk.token != caps.get('tcp_token'):
+          if self.bulk != None: self.bulk.close()
+          self.bulk = yatebulk.YATEBulkClient((self.server_addr[0],tcp_port),self.get_port(),caps.get('tcp_token'))
+       return self.bulk.fetch(name,*args)
+   def get_voxel_strings(self):
+       """ Return a dict that maps extended voxel type integers to strings
+       """
+       return self.get_bulk('voxel_strings')
+   def get_entity_strings(self):
+       """ Return a dict that maps entity type integers to strings
+       """
+       return self.get_bulk('entity_strings')
+   def get_item_strings(self):
+       """ Return a dict that maps item type integers to strings
+       """
+       return self.get_bulk('item_strings')
+   def get_region(self,start,end):
+       """ Return a list of voxel objects for every voxel in the box from start to end, as far as the server knows
+       """
+       return [base.YateBaseVoxel(from_params = vox_params) for vox_params in voxelbox.iter_box(self.get_bulk('region',start,end))]
    def move_vector(self,v):
        """ Send a request to move in the specified vector if possible
        """
@@ -54,37 +176,65 @@ class YATEClient:
        if self.visual_range != None: return self.visual_range
        self.sock.send_request_range()
        return (0,0,0)
-   def handle_bulk_voxel(self,msg_params,from_addr,msg_id):
-       """ bulk voxel updates are preferred for performance reasons
+   @yatesock.timed_handler
+   def handle_bulk_voxel(self,msg_params,from_addr,msg_id,msg_time):
+       """ bulk voxel updates are preferred for performance reasons - see voxelbox.py for the format
        """
-       for voxel in msg_params:
-           self.handle_voxel_update(voxel,from_addr,msg_id)
+       self.voxels_time = msg_time
+       if self.voxel_update_cb is None: return
+       for vox_params in voxelbox.iter_box(msg_params):
+           self.voxel_update_cb(base.YateBaseVoxel(from_params = vox_params,observed_at = msg_time))
    def handle_visual_range(self,msg_params,from_addr,msg_id):
        """ update the visual range so we can limit queries appropriately
        """
        self.visual_range = msg_params
-   def handle_voxel_update(self,msg_params,from_addr,msg_id):
+   @yatesock.timed_handler
+   def handle_voxel_update(self,msg_params,from_addr,msg_id,msg_time):
        """ handle single voxel updates
        """
-       new_vox = base.YateBaseVoxel(from_params = msg_params)
+       self.voxels_time = msg_time
+       new_vox = base.YateBaseVoxel(from_params = msg_params,observed_at = msg_time)
        yatelog.debug('YATEClient','Updating voxel: %s' % str(new_vox))
        if self.voxel_update_cb != None: self.voxel_update_cb(new_vox)
-   def handle_avatar_pos(self,msg_params,from_addr,msg_id):
+   @yatesock.timed_handler
+   def handle_avatar_pos(self,msg_params,from_addr,msg_id,msg_time):
        """ handle avatar position updates
        """
-       self.avatar_pos = msg_params
+       self.avatar_pos      = msg_params
+       self.avatar_pos_time = msg_time
        if self.avatar_pos_cb != None: self.avatar_pos_cb(self.avatar_pos)
    def handle_connect_ack(self,msg_params,from_addr,msg_id):
+       if self.connected: return # a late or duplicate ACK, don't spawn a second set of update and keepalive threads
        yatelog.info('YATEClient','Successfully connected to server')
-       self.ready = True
+       self.ready     = True
+       self.connected = True
+       if self.subscription != (None,None,0): self.sock.send_subscribe(*self.subscription,to_addr=self.server_addr)
+       self.streaming = 0
+       if self.stream_rate > 0: self.pool.spawn_n(self.request_stream)
        self.pool.spawn_n(self.do_keepalive)
        self.pool.spawn_n(self.do_updates)
        if self.connect_cb != None: self.connect_cb()
 
+   def set_stream_rate(self,rate):
+       """ Change how many updates per second the server pushes to us, 0 goes back to polling
+       """
+       self.stream_rate = rate
+       if self.ready: self.pool.spawn_n(self.request_stream)
+   def request_stream(self):
+       try:
+          self.streaming = self.request(MSGTYPE_STREAM,(self.stream_rate,),retries=YATE_REQUEST_RETRIES,result_fn=lambda p: p[0]).wait()
+       except YATERequestTimeout:
+          if self.ready: yatelog.warn('YATEClient','Server did not agree to push updates, polling instead')
+          self.streaming = 0
    def do_updates(self):
+       """ Poll for updates, unless the server is pushing them to us anyway
+       """
        while self.ready:
-          self.sock.send_visible_voxel_req(to_addr=self.server_addr)
-          self.sock.send_request_pos(to_addr=self.server_addr)
+          if self.streaming:
+             eventlet.greenthread.sleep(UPDATE_DELAY)
+             continue
+          if self.wants(MSGTYPE_BULK_VOXEL_UPDATE): self.sock.send_visible_voxel_req(to_addr=self.server_addr)
+          if self.wants(MSGTYPE_AVATAR_POS):        self.sock.send_request_pos(to_addr=self.server_addr)
           eventlet.greenthread.sleep(UPDATE_DELAY)
    def do_keepalive(self):
        while self.ready:
@@ -96,11 +246,34 @@ class YATEClient:
              if self.disconnect_cb != None: self.disconnect_cb()
    def stop(self):
        """ Stop the client - terminate any threads and close the socket cleanly
+           Anything still waiting on a reply to a request gets YATERequestTimeout
        """
        self.ready = False
+       for req in set(self.pending.values()):
+           if req.timer != None: req.timer.cancel()
+           if not req.ready(): req.event.send_exception(YATERequestTimeout('Client stopped before %s got a reply' % msgtype_str[req.msg_type]))
+       self.pending.clear()
+       if self.bulk != None: self.bulk.close()
        self.sock.stop()
        self.pool.waitall()
        self.server_addr = None
+   def get_avatar_pos_age(self):
+       """ Return how many seconds ago the avatar position we've got was read from the game, or None if the server didn't say
+       """
+       if self.avatar_pos_time is None: return None
+       return time.time() - self.avatar_pos_time
+   def get_voxels_age(self):
+       """ Return how many seconds ago the latest voxel update we got was read from the game, or None if the server didn't say
+           The server only sends voxels that changed (and a full set every few seconds), so this is an upper bound
+           Each voxel passed to voxel_update_cb also knows its own age, see YateBaseVoxel.get_age()
+       """
+       if self.voxels_time is None: return None
+       return time.time() - self.voxels_time
+   def get_clock_offset(self):
+       """ Return how many seconds the server's clock is ahead of ours, or None if we haven't synced with it yet
+           Observation times are already corrected for this, it's here so you can see how far apart the clocks are
+       """
+       return self.sock.get_clock_offset(self.server_addr)
    def is_connected(self):
        """ returns a boolean value indicating whether or not we're connected AND ready to talk to the proxy
        """
@@ -114,3 +287,71 @@ class YATEClient:
        yatelog.info('YATEClient','Connecting to server at %s:%s' % server_addr)
        self.server_addr = server_addr
        self.sock.connect_to(server_addr)
+
+class YATEShmClient:
+   """ This class reads observations straight out of shared memory published by a YATE proxy on the same machine
+       It's an alternative to YATEClient for perception only - there's no serialisation or syscalls involved, but you still need
+       a YATEClient to actually do anything in the world
+   """
+   def __init__(self,shm_path,voxel_update_cb=None,avatar_pos_cb=None):
+       """ shm_path is the path the proxy was told to publish to with --shm
+           voxel_update_cb and avatar_pos_cb work the same as in YATEClient
+       """
+       self.reader          = yateshm.YATEShmReader(shm_path)
+       self.voxel_update_cb = voxel_update_cb
+       self.avatar_pos_cb   = avatar_pos_cb
+       self.avatar_pos      = None
+       self.avatar_pos_time = None # when the avatar position and voxels we last passed on were read from the game
+       self.voxels_time     = None
+       self.last_frames     = {yateshm.YATE_SHM_AVATAR_POS: 0,
+                               yateshm.YATE_SHM_VOXEL_BOX:  0}
+       self.active          = True
+       self.pool            = eventlet.GreenPool(10)
+       self.pool.spawn_n(self.do_updates)
+   def get_avatar_pos(self):
+       """ Return the most recently published avatar position, or None if nothing was published yet
+       """
+       frame = self.reader.get_latest(yateshm.YATE_SHM_AVATAR_POS)
+       if frame is None: return None
+       pos = frame.decode_avatar_pos()
+       if not frame.is_valid(): return self.avatar_pos
+       return pos
+   def check_avatar_pos(self):
+       frame = self.reader.get_latest(yateshm.YATE_SHM_AVATAR_POS)
+       if frame is None or frame.frame_no == self.last_frames[yateshm.YATE_SHM_AVATAR_POS]: return
+       pos = frame.decode_avatar_pos()
+       if not frame.is_valid(): return
+       self.last_frames[yateshm.YATE_SHM_AVATAR_POS] = frame.frame_no
+       self.avatar_pos_time = frame.timestamp
+       if pos == self.avatar_pos: return
+       self.avatar_pos = pos
+       if self.avatar_pos_cb != None: self.avatar_pos_cb(pos)
+   def check_voxels(self):
+       frame = self.reader.get_latest(yateshm.YATE_SHM_VOXEL_BOX)
+       if frame is None or frame.frame_no == self.last_frames[yateshm.YATE_SHM_VOXEL_BOX]: return
+       voxels = [base.YateBaseVoxel(from_params = vox_params,observed_at = frame.timestamp) for vox_params in voxelbox.iter_box(frame.decode_voxel_box())]
+       if not frame.is_valid(): return # lapped by the writer, we'll get the next one
+       self.last_frames[yateshm.YATE_SHM_VOXEL_BOX] = frame.frame_no
+       self.voxels_time = frame.timestamp
+       if self.voxel_update_cb is None: return
+       for voxel in voxels: self.voxel_update_cb(voxel)
+   def get_avatar_pos_age(self):
+       """ Same as YATEClient.get_avatar_pos_age(), the proxy is on the same machine so there's no clocks to sync
+       """
+       if self.avatar_pos_time is None: return None
+       return time.time() - self.avatar_pos_time
+   def get_voxels_age(self):
+       if self.voxels_time is None: return None
+       return time.time() - self.voxels_time
+   def do_updates(self):
+       while self.active:
+          eventlet.greenthread.sleep(SHM_POLL_DELAY)
+          try:
+             self.check_avatar_pos()
+             self.check_voxels()
+          except:
+             yatelog.minor_exception('YATEShmClient','Error reading shared memory')
+   def stop(self):
+       self.active = False
+       self.pool.waitall()
+       self.reader.close()
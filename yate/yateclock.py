@@ -0,0 +1,46 @@
+""" This file implements NTP-style clock offset estimation, so timestamps a peer puts on messages can be turned into our own time
+    Every keepalive we send and get an ACK for gives us four times:
+     t1 - when we sent the keepalive, by our clock
+     t2 - when the peer got it, by its clock
+     t3 - when the peer sent the ACK, by its clock
+     t4 - when we got the ACK, by our clock
+    From these the round trip delay is (t4-t1)-(t3-t2) and the peer's clock is ((t2-t1)+(t3-t4))/2 ahead of ours
+    That offset is only right if the trip there took as long as the trip back, and the less time a sample spent in flight the
+    less room there is for that to be wrong - so like NTP's clock filter we keep the last few samples and trust the quickest one
+"""
+import collections
+
+from yateproto import *
+
+class YATEClock:
+   def __init__(self,max_samples=YATE_CLOCK_SAMPLES):
+       self.samples = collections.deque(maxlen=max_samples) # (delay,offset) tuples, oldest first
+       self.best    = None                                  # the sample with the lowest delay out of self.samples
+   def __len__(self):
+       return len(self.samples)
+   def add_sample(self,t1,t2,t3,t4):
+       """ Add a sample from a keepalive exchange, see the top of this file for what the params are
+       """
+       delay  = max(0.0,(t4-t1)-(t3-t2)) # clocks with poor resolution can make this come out slightly negative
+       offset = ((t2-t1)+(t3-t4))/2.0
+       self.samples.append((delay,offset))
+       self.best = min(self.samples)
+   def get_offset(self):
+       """ Return how many seconds the peer's clock is ahead of ours, or None if we've got no samples yet
+       """
+       if self.best is None: return None
+       return self.best[1]
+   def get_delay(self):
+       """ Return the round trip delay of the sample we're trusting, the offset can't be wrong by more than half of this
+       """
+       if self.best is None: return None
+       return self.best[0]
+   def to_local(self,timestamp):
+       """ Turn a time by the peer's clock into one by ours - until we've got a sample we assume the clocks agree
+       """
+       if self.best is None: return timestamp
+       return timestamp - self.best[1]
+   def as_dict(self):
+       return {'offset':  self.get_offset(),
+               'delay':   self.get_delay(),
+               'samples': len(self.samples)}
@@ -0,0 +1,22 @@
+""" This file implements handing big chunks of CPU work (zlib mostly) to a pool of real OS threads
+    zlib releases the GIL while it works, so doing it in eventlet's tpool lets the hub carry on with keepalives and movement
+    instead of everything stalling until the compressor's done - but getting a thread involved costs about 100us, so
+    anything smaller than YATE_OFFLOAD_MIN_SIZE is quicker to just do inline
+"""
+import eventlet
+from eventlet import tpool
+
+from yateproto import *
+
+pool_ready = False
+
+def offload(size,fn,*args):
+    """ Call fn(*args) and return the result - in an OS thread if size (in bytes) is at least YATE_OFFLOAD_MIN_SIZE
+        Only use this for functions that release the GIL and don't touch anything a greenthread might be changing
+    """
+    global pool_ready
+    if size < YATE_OFFLOAD_MIN_SIZE: return fn(*args)
+    if not pool_ready:
+       tpool.set_num_threads(YATE_OFFLOAD_THREADS) # only does anything before tpool gets going, so somebody else may have beaten us to it
+       pool_ready = True
+    return tpool.execute(fn,*args)
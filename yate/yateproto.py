@@ -2,9 +2,7 @@
     Please note that this protocol does not take security into consideration AT ALL, everything should run on localhost only
 """
 import msgpack
-import random
-import time
-import hashlib
+import itertools
 import sys
 import yatelog
 
@@ -27,11 +25,13 @@ YATE_VOXEL_INTACT      = 0 # totally intact, no effort has been made to destroy
 YATE_VOXEL_PART_INTACT = 1 # partly intact, some effort has been made to destroy
 
 # params for each message type are shown below
-MSGTYPE_CONNECT       = 0 # ()
-MSGTYPE_CONNECT_ACK   = 1 # (msg_id) msg_id is the msg_id from the original keepalive packet
+MSGTYPE_CONNECT       = 0 # (caps)        caps is a dict of transport capabilities, see YATETransport.set_peer_caps()
+MSGTYPE_CONNECT_ACK   = 1 # (msg_id,caps) msg_id is the msg_id from the original connect packet, caps is our own capabilities
 MSGTYPE_UNKNOWN_PEER  = 2 # () signals to the other peer that we don't know who they are
 MSGTYPE_KEEPALIVE     = 3 # ()
-MSGTYPE_KEEPALIVE_ACK = 4 # (msg_id) msg_id is the msg_id from the original keepalive packet
+MSGTYPE_KEEPALIVE_ACK = 4 # (msg_id,recv_time,send_time) msg_id is the msg_id from the original keepalive packet, recv_time and
+                          # send_time are when the keepalive got to us and when we sent this by our clock - see yateclock.py
+                          # older peers only send (msg_id)
 
 # perception related messages
 MSGTYPE_REQUEST_RANGE  = 5  # ()                                                           requests the visual range around the avatar
@@ -44,17 +44,17 @@ MSGTYPE_ENTITY_GONE    = 11 # (entity_id)
 
 # bulk updates
 MSGTYPE_BULK_VOXEL_REQ     = 12 # (voxel,voxel,voxel,...) requests a bulk voxel update - like sending a big pile of MSGTYPE_REQUEST_VOXEL packets all at the same time
-MSGTYPE_BULK_VOXEL_UPDATE  = 13 # (voxel,voxel,voxel,...) updates multiple voxels at once - like sending a big pile of MSGTYPE_VOXEL_UPDATE packets all at the same time
+MSGTYPE_BULK_VOXEL_UPDATE  = 13 # (origin,dims,palette,flags,data) updates a whole box of voxels at once - see voxelbox.py for the encoding
 MSGTYPE_VISIBLE_VOXEL_REQ  = 14 # ()                      requests a bulk update of the visible range of voxels
 
 # spatial queries and movement
 MSGTYPE_REQUEST_POS        = 15 # ()                                        request the avatar location
-MSGTYPE_AVATAR_POS         = 16 # (x,y,z)                                   tells the peer what the avatar position is
+MSGTYPE_AVATAR_POS         = 16 # (x,y,z)                                   tells the peer what the avatar position is, as floats
 MSGTYPE_MOVE_VECTOR        = 17 # (x,y,z)                                   tells the peer to attempt to move in the specified vector
 MSGTYPE_REQ_DIST_TO        = 18 # (x,y,z)                                   requests the distance to specified coordinates
 MSGTYPE_RESP_DIST_TO       = 19 # (x,y,z,dist,msg_id)                       reply for REQ_DIST_TO, msg_id is the msg_id of request
-MSGTYPE_REQ_NEAREST_VOXEL  = 20 # (basic_type,extended_type)                requests the nearest voxel of specified type
-MSGTYPE_RESP_NEAREST_VOXEL = 21 # (basic_type,extended_type,(x,y,z),msg_id) reply for REQ_NEAREST_VOXEL
+MSGTYPE_REQ_NEAREST_VOXEL  = 20 # (basic_type,extended_type)                requests the nearest voxel of specified type, an extended_type of None matches any
+MSGTYPE_RESP_NEAREST_VOXEL = 21 # (basic_type,extended_type,(x,y,z),msg_id) reply for REQ_NEAREST_VOXEL, (x,y,z) is None if there's no such voxel in visual range
 MSGTYPE_WALK_TO_POINT      = 22 # (x,y,z)                                   request to walk to the specified location using pathfinding if possible
 MSGTYPE_LOOK_AT_POINT      = 23 # (x,y,z)                                   request to look at the specified location
 MSGTYPE_WALK_TO_ENTITY     = 24 # (entity_id)                               request to walk to the specified entity once
@@ -65,17 +65,144 @@ MSGTYPE_HALT_MOVEMENT      = 28 # ()                                        requ
 MSGTYPE_REQUEST_VELACC     = 29 # ()                                        request the current velocity and acceleration of the avatar
 MSGTYPE_AVATAR_VELACC      = 30 # ((vel_x,vel_y,vel_z),(acc_x,acc_y,acc_z)) tells the peer the current avatar velocity and acceleration
 
+# interest management
+MSGTYPE_SUBSCRIBE          = 31 # (msg_types,region,max_rate) tells the peer what we want pushed to us, see YATETransport.wants()
+                                #  msg_types is a list of message types or None for everything
+                                #  region is ((x,y,z),(x,y,z)) - the start and end of the area we care about, or None for everywhere
+                                #  max_rate is the most messages of each type per second we want, or 0 for no limit
+MSGTYPE_STREAM             = 32 # (rate)        asks the peer to push avatar position and voxel changes rate times per second, 0 goes back to the default
+MSGTYPE_STREAMING          = 33 # (rate,msg_id) reply for STREAM with the rate the peer is actually going to use
+
+# diagnostics
+MSGTYPE_REQUEST_STATS      = 34 # ()             requests transport stats from the peer
+MSGTYPE_STATS              = 35 # (stats,msg_id) reply for REQUEST_STATS, stats is a dict - see YATETransport.get_stats()
+
 YATE_KEEPALIVE_TIMEOUT = 5 # in seconds
 
+# clock sync - keepalives double as NTP-style clock samples with peers that have the 'time' cap, see yateclock.py
+YATE_CLOCK_SYNC_INTERVAL = 10.0 # a peer gets a keepalive at least this often, even if we're busy sending it other things
+YATE_CLOCK_SYNC_FAST     = 1.0  # or this often until we've got YATE_CLOCK_MIN_SAMPLES samples from it
+YATE_CLOCK_MIN_SAMPLES   = 4
+YATE_CLOCK_SAMPLES       = 8    # how many recent samples to pick the best one out of
+
+# requests that get a reply with the msg_id of the request as the last param - clients use these to match replies to requests
+YATE_REPLY_TYPES     = (MSGTYPE_RESP_DIST_TO,MSGTYPE_RESP_NEAREST_VOXEL,MSGTYPE_FOLLOWING_ENTITY,MSGTYPE_STREAMING,MSGTYPE_STATS)
+YATE_REQUEST_TIMEOUT = 1.0 # seconds to wait for a reply before sending the request again or giving up
+YATE_REQUEST_RETRIES = 2   # how many times to send idempotent queries again if no reply turns up, it's UDP after all
+
+class YATERequestTimeout(Exception):
+   """ Raised when a request never got a reply, even after retrying
+   """
+   pass
+
+class YATEBulkError(Exception):
+   """ Raised when a transfer over the TCP side channel can't be done, see yatebulk.py
+   """
+   pass
+
+# message priorities - YATESocket handles and sends queued messages with lower numbers first
+YATE_PRIORITY_CONTROL  = 0 # connection setup and keepalives, if these wait we time out
+YATE_PRIORITY_REALTIME = 1 # avatar position and movement
+YATE_PRIORITY_DEFAULT  = 2 # everything else
+YATE_PRIORITY_BULK     = 3 # big voxel dumps that take a while to handle anyway
+YATE_MSG_PRIORITY = {MSGTYPE_CONNECT:           YATE_PRIORITY_CONTROL,
+                     MSGTYPE_CONNECT_ACK:       YATE_PRIORITY_CONTROL,
+                     MSGTYPE_UNKNOWN_PEER:      YATE_PRIORITY_CONTROL,
+                     MSGTYPE_KEEPALIVE:         YATE_PRIORITY_CONTROL,
+                     MSGTYPE_KEEPALIVE_ACK:     YATE_PRIORITY_CONTROL,
+                     MSGTYPE_SUBSCRIBE:         YATE_PRIORITY_CONTROL,
+                     MSGTYPE_AVATAR_POS:        YATE_PRIORITY_REALTIME,
+                     MSGTYPE_MOVE_VECTOR:       YATE_PRIORITY_REALTIME,
+                     MSGTYPE_REQUEST_POS:       YATE_PRIORITY_REALTIME,
+                     MSGTYPE_HALT_MOVEMENT:     YATE_PRIORITY_REALTIME,
+                     MSGTYPE_BULK_VOXEL_REQ:    YATE_PRIORITY_BULK,
+                     MSGTYPE_BULK_VOXEL_UPDATE: YATE_PRIORITY_BULK,
+                     MSGTYPE_VISIBLE_VOXEL_REQ: YATE_PRIORITY_BULK}
+YATE_HANDLER_CONCURRENCY = 8 # how many message handlers YATESocket will run at once, anything else waits its turn in priority order
+
+# queue policies - what YATESocket does with a message when too many of the same type are already waiting to be handled or sent
+YATE_QUEUE_KEEP        = 0 # never drop anything, the queue grows as much as it needs to
+YATE_QUEUE_LATEST      = 1 # only the latest message for each peer is kept, it replaces the one already waiting
+YATE_QUEUE_DROP_OLDEST = 2 # once the queue is full, the oldest waiting message is dropped to make room
+YATE_QUEUE_PEER_OLDEST = 3 # same as YATE_QUEUE_DROP_OLDEST but max depth is per peer, so a burst to lots of peers doesn't drop any
+YATE_QUEUE_DEFAULT     = (YATE_QUEUE_DROP_OLDEST,1024) # (policy,max depth) for message types not listed below
+YATE_QUEUE_POLICIES = {MSGTYPE_CONNECT:           (YATE_QUEUE_KEEP,0),
+                       MSGTYPE_CONNECT_ACK:       (YATE_QUEUE_KEEP,0),
+                       MSGTYPE_UNKNOWN_PEER:      (YATE_QUEUE_KEEP,0),
+                       MSGTYPE_KEEPALIVE:         (YATE_QUEUE_KEEP,0),
+                       MSGTYPE_KEEPALIVE_ACK:     (YATE_QUEUE_KEEP,0),
+                       MSGTYPE_SUBSCRIBE:         (YATE_QUEUE_KEEP,0),
+                       MSGTYPE_AVATAR_POS:        (YATE_QUEUE_LATEST,0),
+                       MSGTYPE_VISUAL_RANGE:      (YATE_QUEUE_LATEST,0),
+                       MSGTYPE_AVATAR_VELACC:     (YATE_QUEUE_LATEST,0),
+                       MSGTYPE_BULK_VOXEL_UPDATE: (YATE_QUEUE_PEER_OLDEST,4)} # a stale box is worthless once a newer one turns up
+
+# per-peer QoS - so one greedy or broken peer can't starve everybody else, see yateqos.py
+# control and realtime messages (see YATE_MSG_PRIORITY) never wait for budget or get dropped for going over it, but what they
+# send still counts against it
+YATE_PEER_RATE      = 16*1024*1024 # bytes per second we send each peer, 0 for no limit - messages over budget wait their turn
+YATE_PEER_BURST     = 1024*1024    # how much a peer that's been quiet can get sent in one go
+YATE_PEER_MAX_PACED = 256          # most messages that may be waiting for budget for one peer, the oldest get dropped after that
+YATE_FRAGMENT_WINDOW = 128*1024    # most of the burst the fragments of a big message may use back to back, any more and they overrun
+                                   # the kernel's socket buffers at one end or the other and get silently dropped
+YATE_PEER_MSG_RATE  = 2000         # messages per second we accept from each peer, 0 for no limit - anything more gets dropped
+YATE_PEER_MSG_BURST = 4000
+YATE_ADMISSION_LIMITS = {MSGTYPE_REQ_NEAREST_VOXEL: 4, # most handlers of each of these expensive types that may run at once for a
+                         MSGTYPE_BULK_VOXEL_REQ:    2, # single peer, any more that turn up while they're running get dropped -
+                         MSGTYPE_VISIBLE_VOXEL_REQ: 1, # clients retry queries that go unanswered, and another visible voxel
+                         MSGTYPE_REQUEST_STATS:     1} # request while one is running wouldn't tell them anything new anyway
+
+# encoded message cache - messages sent with YATETransport.send_cached() are kept here once they're encoded and compressed
+YATE_ENCODE_CACHE_BYTES   = 16*1024*1024 # most bytes of encoded messages to keep, the least recently used get thrown away first
+YATE_ENCODE_CACHE_ENTRIES = 4096
+
+# transport framing - every datagram starts with a byte of flags
+# whole messages are framed with YATE_FRAME_HEADER, fragments with YATE_FRAGMENT_HEADER and a slice of a whole frame
+YATE_FLAG_FRAGMENT = 1 # this datagram is one fragment of a message too big for a single datagram
+YATE_FLAG_ZLIB     = 2 # message body is zlib compressed
+YATE_FLAG_ZDICT    = 4 # message body is compressed with a preset dictionary, the first byte of the body is the dictionary version
+YATE_FLAG_BATCH    = 8 # this datagram holds several whole frames, each one prefixed with YATE_BATCH_LENGTH
+YATE_FLAG_TIME     = 16 # the frame header is followed by YATE_FRAME_TIME, when what the message describes was observed by the sender's clock
+
+YATE_FRAME_HEADER           = '!BI'           # (flags,sequence number) sequence numbers are per-peer and start at 1
+YATE_FRAGMENT_HEADER        = '!BIHH'         # (flags,message key,fragment index,fragment count)
+YATE_FRAME_TIME             = '!d'            # observation timestamp, seconds since the epoch - only sent to peers with the 'time' cap
+YATE_SEQ_WINDOW             = 64              # how far back we remember which sequence numbers we've seen, for spotting duplicates
+YATE_BATCH_LENGTH           = '!H'            # length of each frame in a batch
+YATE_BATCH_DELAY            = 0.002           # how long small messages may wait for company before being sent, in seconds
+YATE_MAX_DATAGRAM           = 8192            # biggest datagram we'll ever send or receive
+YATE_SOCK_RCVBUF            = 1024*1024       # kernel receive buffer to ask for so bursts from lots of peers don't get dropped, None leaves the OS default
+YATE_SOCK_SNDBUF            = None            # same for the send buffer - on linux both get capped by net.core.rmem_max/wmem_max
+YATE_FRAGMENT_SIZE          = 8000            # message bytes per fragment, this leaves plenty of room for the header
+YATE_MAX_FRAGMENTS          = 1024            # so no single message can be bigger than about 8MB
+YATE_MAX_MSG_SIZE           = YATE_MAX_FRAGMENTS*YATE_FRAGMENT_SIZE # biggest message there is, compressed ones may not inflate past this
+YATE_FRAGMENT_TIMEOUT       = 2.0             # seconds to wait for the next fragment of a message before giving up on it
+YATE_MAX_PENDING_FRAGMENTS  = 2*YATE_MAX_FRAGMENTS*YATE_FRAGMENT_SIZE # max bytes of incomplete messages to hold onto, the ones we
+                                                                      # heard from longest ago are dropped first - this must fit at
+                                                                      # least one message of YATE_MAX_FRAGMENTS or it can never arrive
+
+# compression - only used with peers that said they support it when connecting
+YATE_COMPRESS_MIN_SIZE  = 128 # messages smaller than this are never worth compressing
+YATE_ZDICT_MIN_SIZE     = 16  # with a preset dictionary, even quite small messages shrink
+YATE_ZDICT_MAX_SIZE     = 4096 # the dictionary only helps with the start of a message, anything bigger just gets plain zlib
+YATE_COMPRESS_GIVE_UP   = 8   # if this many messages of one type in a row come out bigger after compressing, stop trying so hard
+YATE_COMPRESS_RETRY     = 32  # once we've given up on a message type, only try again every this many messages in case it changes
+YATE_ZLIB_LEVEL_DEFAULT = 6
+YATE_ZLIB_LEVELS        = {MSGTYPE_BULK_VOXEL_UPDATE: 1} # per message type zlib levels, bulk updates are already box-encoded so the fastest level gets most of the gain
+YATE_OFFLOAD_MIN_SIZE   = 32*1024 # (de)compressing anything at least this big happens in an OS thread so the hub keeps going, see yateoffload.py
+YATE_OFFLOAD_THREADS    = 4       # how many OS threads to do it in - zlib lets go of the GIL, so they really do run in parallel
+
 # for performance reasons, the below is used instead of strings for keys in the clients dictionary in yateserver.py
 YATE_LAST_ACKED = 0 # a set of message IDs from incoming ACK packets - we use a set cos UDP can be weird
 YATE_SOCK_ADDR  = 1
 
+msg_ids = itertools.count(1)
+
 def gen_msg_id():
-    """ Generate a random-ish message ID integer and return it
-        This is NOT cryptographically secure, it's just meant to be unique enough not to clash
+    """ Generate a message ID integer and return it
+        IDs just count upwards, so they're cheap and won't clash until we wrap around 32 bits
     """
-    return int(hashlib.sha256(str(time.time()+random.randint(1,9999))).hexdigest()[:6],16)
+    return msg_ids.next() & 0xFFFFFFFF
 
 def send_yate_msg(msgtype,params,addr,sock):
     """ Sends a message and returns the message ID
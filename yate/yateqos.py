@@ -0,0 +1,43 @@
+""" This file implements the token buckets YATE sockets use to share out bandwidth and CPU fairly between peers
+    Nothing here knows about time by itself, everything takes the current time as a param so one time.time() call goes a long way
+"""
+
+class YATETokenBucket:
+   """ A token bucket that fills up at rate tokens per second up to burst tokens - a rate of 0 means no limit
+       take() is all or nothing, spend() can push the bucket into debt which then has to be paid back before ready() is True again,
+       that way things bigger than the whole burst still get through eventually
+   """
+   def __init__(self,rate,burst,now):
+       self.rate   = rate
+       self.burst  = burst
+       self.tokens = burst
+       self.last   = now
+   def refill(self,now):
+       if now > self.last:
+          self.tokens = min(self.burst,self.tokens + (now - self.last) * self.rate)
+          self.last   = now
+   def take(self,n,now):
+       """ Take n tokens if there's that many, returns False if there's not
+       """
+       if self.rate <= 0: return True
+       self.refill(now)
+       if self.tokens < n: return False
+       self.tokens -= n
+       return True
+   def spend(self,n,now):
+       """ Take n tokens whether there's enough or not
+       """
+       if self.rate <= 0: return
+       self.refill(now)
+       self.tokens -= n
+   def ready(self,now,reserve=0):
+       """ Returns True if the bucket isn't in debt, or has more than reserve tokens in it if that's given
+       """
+       if self.rate <= 0: return True
+       self.refill(now)
+       return self.tokens > reserve
+   def wait_time(self,now,reserve=0):
+       """ Return how many seconds until ready(now,reserve) will be True
+       """
+       if self.ready(now,reserve): return 0.0
+       return (float(reserve - self.tokens) / self.rate) + 0.0001 # a hair extra so we don't wake up just before it's paid off
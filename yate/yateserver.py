@@ -7,11 +7,70 @@ import time
 import msgpack
 import logging
 
+import itertools
+import math
 import utils # yate utils
+import voxelbox
+import yateshm
+import yatebulk
 from yateproto import *
 
+KEYFRAME_INTERVAL = 5.0  # seconds between full visible voxel updates to each peer, so a lost delta can't leave them out of sync forever
+SHM_UPDATE_DELAY  = 0.05 # seconds between avatar position and visible voxel updates in shared memory, it's cheap so we can do it often
+SHM_VOXEL_REFRESH = 1.0  # the visible voxels go into shared memory again at least this often even if they didn't change, so readers know they're fresh
+STREAM_TICK       = 0.05 # seconds between checks for peers that are due a pushed update
+STREAM_MAX_RATE   = 20   # the most pushed updates per second we'll agree to send a single peer
+VIS_UPDATE_DELAY  = 0.5  # peers that never asked for a stream still get visible voxels pushed this often, but no avatar position
+POS_REFRESH_DELAY = 1.0  # streaming peers get the avatar position at least this often even if it hasn't moved, so they know it's fresh
+VIS_SNAPSHOT_TTL  = STREAM_TICK # how long a visible voxel snapshot is good for when the driver can't tell us if the world changed
+
+vis_serials = itertools.count() # tells snapshots apart when the driver doesn't know its world version
+
+class VisSnapshot:
+   """ One read of the visible box from the driver, shared by everyone who asks for visible voxels until the world moves on
+   """
+   def __init__(self,key,start,end,positions,states,taken):
+       self.key       = key       # (world version,start,end) it was read at, start and end rounded to voxels
+       self.start     = start
+       self.end       = end
+       self.positions = positions
+       self.states    = states
+       self.taken     = taken     # time.time() when we last read it, or found the world version hadn't changed since
+       self.clipped   = {}        # maps regions to what clip() returned for them
+       self.state_at  = None      # maps positions to states, only built if someone wants it
+       if key[0] is None:
+          self.cache_id = key + (vis_serials.next(),) # no version, so nothing else can be relied on to have the same voxels
+       else:
+          self.cache_id = key                          # what the encoded updates made from this snapshot get cached under
+   def clip(self,region):
+       """ Return (start,end,positions,states) for the part of the box inside region, or None if none of it is
+           region is a (start,end) tuple like YATETransport.get_region() returns, None means the whole box
+       """
+       if region is None: return (self.start,self.end,self.positions,self.states)
+       if region in self.clipped: return self.clipped[region]
+       clipped = utils.clip_range(utils.round_vector(self.start),utils.round_vector(self.end),region[0],region[1])
+       if clipped != None:
+          positions,states = [],[]
+          for vox_pos,state in itertools.izip(self.positions,self.states):
+              if all([clipped[0][i] <= vox_pos[i] < clipped[1][i] for i in xrange(3)]):
+                 positions.append(vox_pos)
+                 states.append(state)
+          clipped = (clipped[0],clipped[1],positions,states)
+       self.clipped[region] = clipped
+       return clipped
+   def get_state_at(self):
+       if self.state_at is None: self.state_at = dict(itertools.izip(self.positions,self.states))
+       return self.state_at
+
 class YATEServer:
-   def __init__(self,driver,verbose=False):
+   def __init__(self,driver,verbose=False,shm_path=None,capture=None,rcvbuf=YATE_SOCK_RCVBUF,bulk=True):
+       """ driver is the driver object to use
+           verbose sets logging to DEBUG level
+           shm_path is optional, if specified observations are also published to local readers via shared memory at that path (see yateshm.py)
+           capture is optional, if specified all traffic is recorded to that file for yate_replay.py
+           rcvbuf is the kernel receive buffer size to ask for, raise it if lots of clients are getting their packets dropped
+           bulk turns on the TCP side channel for big transfers, see yatebulk.py
+       """
        self.logger   = yatelog.get_logger()
        if verbose: self.logger.setLevel(logging.DEBUG)
        self.driver   = driver
@@ -20,9 +79,36 @@ class YATEServer:
                         MSGTYPE_REQUEST_RANGE:     self.handle_request_range,
                         MSGTYPE_REQUEST_VOXEL:     self.handle_request_voxel,
                         MSGTYPE_VISIBLE_VOXEL_REQ: self.handle_visible_voxel_req,
+                        MSGTYPE_REQ_DIST_TO:       self.handle_req_dist_to,
+                        MSGTYPE_REQ_NEAREST_VOXEL: self.handle_req_nearest_voxel,
+                        MSGTYPE_STREAM:            self.handle_stream,
                         MSGTYPE_MOVE_VECTOR:   self.handle_move_vector}
-       self.sock              = yatesock.YATESocket(handlers=self.handlers)
+       self.sock              = yatesock.YATESocket(handlers=self.handlers,capture=capture,rcvbuf=rcvbuf)
+       self.sock.drop_handlers[MSGTYPE_BULK_VOXEL_UPDATE] = self.vis_update_dropped
+       self.peer_snapshots    = {} # maps peer addresses to the (VisSnapshot,region) we last sent them visible voxels from,
+                                   # if one of those never went out they're dropped from here so the next update is a keyframe
+       self.peer_keyframes    = {} # maps peer addresses to the time we last sent them a full keyframe
+       self.peer_streams      = {} # maps peer addresses to how often they asked us to push updates, in seconds
+       self.peer_pushes       = {} # maps peer addresses to the time we last pushed them an update
+       self.peer_pos          = {} # maps peer addresses to (position,time) for the last avatar position we pushed them
+       self.vis_pending       = set() # peers that sent MSGTYPE_VISIBLE_VOXEL_REQ since the last tick, answered together
+       self.vis_snapshot      = None
+       self.vis_building      = None  # an event that fires with the new snapshot while one is being read from the driver
+       self.shm               = None
+       self.shm_snapshot      = None  # the VisSnapshot we last published to shared memory
+       self.shm_published     = 0     # and when we did it
+       self.bulk              = None
        self.pool              = eventlet.GreenPool(1000)
+       if bulk:
+          self.bulk = yatebulk.YATEBulkServer(self.sock,{'voxel_strings':  self.driver.get_voxel_strings,
+                                                         'entity_strings': self.driver.get_entity_strings,
+                                                         'item_strings':   self.driver.get_item_strings,
+                                                         'region':         self.get_region},
+                                              bind_ip=self.sock.get_endpoint()[0])
+       if shm_path != None:
+          yatelog.info('YATEServer','Publishing observations to shared memory at %s' % shm_path)
+          self.shm = yateshm.YATEShmWriter(shm_path)
+          self.pool.spawn(self.do_shm_updates)
        self.pool.spawn(self.do_ticks)
        self.pool.spawn(self.do_vis_updates)
    def do_ticks(self):
@@ -33,34 +119,221 @@ class YATEServer:
              d.tick()
           except:
              yatelog.minor_exception('YATEServer','Failed driver tick')
+   def do_shm_updates(self):
+       """ Keep shared memory up to date - this doesn't depend on there being any UDP peers, the readers might be all there is
+       """
+       while True:
+          eventlet.greenthread.sleep(SHM_UPDATE_DELAY)
+          try:
+             self.shm.publish_avatar_pos(self.get_avatar_pos())
+          except:
+             yatelog.minor_exception('YATEServer','Failed publishing avatar position to shared memory')
+          try:
+             self.publish_vis_voxels()
+          except:
+             yatelog.minor_exception('YATEServer','Failed publishing visible voxels to shared memory')
+   def publish_vis_voxels(self):
+       """ Put the visible voxels into shared memory if they changed since last time or it's time for a refresh
+       """
+       snapshot = self.get_vis_snapshot()
+       if snapshot is None: return
+       cur_time = time.time()
+       if snapshot is self.shm_snapshot and cur_time - self.shm_published < SHM_VOXEL_REFRESH: return
+       self.shm.publish_voxel_box(snapshot.start,snapshot.end,snapshot.states,snapshot.taken)
+       self.shm_snapshot  = snapshot
+       self.shm_published = cur_time
    def do_vis_updates(self):
-       visual_range = self.driver.get_vision_range()
+       """ Push updates to every peer that's due one, at whatever rate they asked for with MSGTYPE_STREAM
+       """
        while True:
-          eventlet.greenthread.sleep(0.5)
-          self.update_vis_voxels()
-   def update_vis_voxels(self):
-       visual_range   = self.driver.get_vision_range()
-       avatar_pos     = self.driver.get_pos()
-       bulkdata = []
-       for vox_pos in utils.iter_within(*utils.calc_range(avatar_pos,visual_range)):
-           eventlet.greenthread.sleep(0)
-           bulkdata.append(  (self.driver.get_voxel(vox_pos).as_msgparams())  )
-       self.sock.send_bulk_voxel_update(*bulkdata)
+          eventlet.greenthread.sleep(STREAM_TICK)
+          cur_time = time.time()
+          due      = [peer for peer in self.sock.known_peers.copy() if cur_time - self.peer_pushes.get(peer,0) >= self.peer_streams.get(peer,VIS_UPDATE_DELAY)]
+          for peer in due: self.peer_pushes[peer] = cur_time
+          requested        = self.vis_pending
+          self.vis_pending = set()
+          if not (due or requested): continue
+          try:
+             self.push_avatar_pos([peer for peer in due if peer in self.peer_streams])
+             self.update_vis_voxels(list(requested.union(due)),requested)
+          except:
+             yatelog.minor_exception('YATEServer','Failed pushing updates')
+   def push_avatar_pos(self,peers):
+       """ Send the avatar position to each of the specified peers, if it moved since we last sent it to them or it's getting old
+       """
+       if not peers: return
+       pos      = self.get_avatar_pos()
+       cur_time = time.time()
+       for peer in peers:
+           last = self.peer_pos.get(peer)
+           if last != None and last[0] == pos and cur_time - last[1] < POS_REFRESH_DELAY: continue
+           if not self.sock.wants(peer,MSGTYPE_AVATAR_POS): continue
+           self.peer_pos[peer] = (pos,cur_time)
+           self.sock.send_avatar_pos(pos[0],pos[1],pos[2],to_addr=peer,timestamp=cur_time)
+   def get_vis_snapshot(self):
+       """ Return a VisSnapshot of the visible box, only reading it from the driver again if the world version or the box
+           itself (the avatar moved to another voxel or the vision range changed) is different from last time - if the driver
+           doesn't know its world version the snapshot is only reused for VIS_SNAPSHOT_TTL
+           If a snapshot is already being read, this waits for that one instead of starting another
+       """
+       if self.vis_building != None: return self.vis_building.wait()
+       start,end    = utils.calc_range(self.driver.get_pos(),self.driver.get_vision_range())
+       version      = self.driver.get_world_version()
+       key          = (version,utils.round_vector(start),utils.round_vector(end))
+       cur_time     = time.time()
+       snapshot     = self.vis_snapshot
+       if snapshot != None and snapshot.key == key:
+          if version != None:
+             snapshot.taken = cur_time # still exactly what the driver would tell us
+             return snapshot
+          if cur_time - snapshot.taken < VIS_SNAPSHOT_TTL: return snapshot
+       self.vis_building = eventlet.event.Event()
+       try:
+          positions = []
+          states    = []
+          for vox_pos in utils.iter_within(start,end):
+              eventlet.greenthread.sleep(0)
+              positions.append(vox_pos)
+              states.append(self.driver.get_voxel(vox_pos).get_state())
+          if snapshot != None and snapshot.key == key and snapshot.states == states:
+             snapshot.taken = cur_time # no world version, but nothing changed either - keep using the one everyone already has
+          else:
+             snapshot = VisSnapshot(key,start,end,positions,states,cur_time)
+          self.vis_snapshot = snapshot
+       finally:
+          building,self.vis_building = self.vis_building,None
+          building.send(self.vis_snapshot) # if reading it failed, anyone waiting gets the last good one (or None)
+       return snapshot
+   def update_vis_voxels(self,peers=None,requested=()):
+       """ Send each peer whatever has changed in the visible box since the last update they got
+           peers is a list of peers to update, by default all of them
+           requested is the peers that asked with MSGTYPE_VISIBLE_VOXEL_REQ, they get a keyframe whether anything changed or not
+           and whatever they subscribed to, since they asked
+       """
+       snapshot = self.get_vis_snapshot()
+       if snapshot is None: return
+       cur_time = time.time()
+       if peers is None: peers = self.sock.known_peers.copy()
+       for peer in peers:
+           force = peer in requested
+           if not (force or self.sock.wants(peer,MSGTYPE_BULK_VOXEL_UPDATE)): continue
+           region = self.sock.get_region(peer)
+           if region != None and snapshot.clip(region) is None: continue # nothing they can see is anything they care about
+           self.send_vis_voxels(peer,snapshot,region,cur_time,force)
+       for peer in self.peer_keyframes.keys(): # forget about peers that have gone away
+           if not self.sock.is_connected(peer):
+              self.peer_snapshots.pop(peer,None)
+              del self.peer_keyframes[peer]
+       self.vis_pending.intersection_update(self.sock.known_peers)
+       for peer_dict in (self.peer_streams,self.peer_pushes,self.peer_pos):
+           for peer in peer_dict.keys():
+               if not self.sock.is_connected(peer): del peer_dict[peer]
+   def send_vis_voxels(self,peer,snapshot,region,cur_time,force=False):
+       """ Send a single peer a delta against the voxels we last sent them, or a full keyframe if it's time for one or force is set
+           Everyone who's had the same updates gets sent the same bytes, so they're only encoded once - see YATETransport.send_cached()
+       """
+       last = self.peer_snapshots.get(peer)
+       if force or (last is None) or (cur_time - self.peer_keyframes[peer] >= KEYFRAME_INTERVAL):
+          self.peer_keyframes[peer] = cur_time
+          last = (None,None)
+       elif last[0] is snapshot and last[1] == region:
+          return # nothing changed, so don't bother them
+       self.peer_snapshots[peer] = (snapshot,region)
+       last_snapshot,last_region = last
+       cache_key = (last_snapshot.cache_id if last_snapshot else None,last_region,snapshot.cache_id,region)
+       self.sock.send_cached(MSGTYPE_BULK_VOXEL_UPDATE,cache_key,
+                             lambda: self.encode_vis_voxels(last_snapshot,last_region,snapshot,region),to_addr=peer,timestamp=snapshot.taken)
+   def vis_update_dropped(self,msg_type,peer):
+       """ The transport threw away a visible voxel update for a peer, so every delta after it would be against voxels the peer
+           never got - forget what we think it has and it gets a keyframe on the next tick
+       """
+       self.peer_snapshots.pop(peer,None)
+   def encode_vis_voxels(self,last_snapshot,last_region,snapshot,region):
+       """ Return params for MSGTYPE_BULK_VOXEL_UPDATE with the part of snapshot inside region, as a delta against the part of
+           last_snapshot inside last_region - or a keyframe if last_snapshot is None
+           Returns None if it would be a delta with nothing in it
+       """
+       start,end,positions,states = snapshot.clip(region)
+       if last_snapshot is None: return voxelbox.encode_box(start,end,states)
+       last_start,last_end,last_positions,last_states = last_snapshot.clip(last_region)
+       if last_positions == positions: # same box, so the states line up
+          if last_states == states: return None
+          delta = [None if last_state==state else state for last_state,state in itertools.izip(last_states,states)]
+       else:
+          state_at = last_snapshot.get_state_at()
+          delta    = []
+          for vox_pos,state in itertools.izip(positions,states):
+              if state_at.get(vox_pos) == state and all([last_start[i] <= vox_pos[i] < last_end[i] for i in xrange(3)]):
+                 delta.append(None)
+              else:
+                 delta.append(state)
+          if delta.count(None) == len(delta): return None
+       return voxelbox.encode_box(start,end,delta)
+   def get_avatar_pos(self):
+       """ Return the avatar position as floats whatever the driver uses, so UDP and shared memory readers see the same thing
+       """
+       return tuple([float(c) for c in self.driver.get_pos()])
    def handle_request_pos(self,msg_params,from_addr,msg_id):
-       pos = self.driver.get_pos()
-       self.sock.send_avatar_pos(pos[0],pos[1],pos[2],to_addr=from_addr)
+       pos = self.get_avatar_pos()
+       self.sock.send_avatar_pos(pos[0],pos[1],pos[2],to_addr=from_addr,timestamp=time.time())
    def handle_request_range(self,msg_params,from_addr,msg_id):
        visual_range = self.driver.get_vision_range()
        self.sock.send_visual_range(*visual_range, to_addr=from_addr)
    def handle_request_voxel(self,msg_params,from_addr,msg_id):
        voxel_data = self.driver.get_voxel(msg_params)
-       self.send_voxel_update(voxel_data.as_msgparams())
+       self.sock.send_voxel_update(*voxel_data.as_msgparams(),to_addr=from_addr,timestamp=time.time())
    def handle_visible_voxel_req(self,msg_params,from_addr,msg_id):
-       self.update_vis_voxels()
+       """ Requests are answered together on the next tick of do_vis_updates(), so a peer asking several times in one tick
+           only gets one answer and everyone asking in the same tick shares one read of the driver
+       """
+       self.vis_pending.add(from_addr)
+   def handle_stream(self,msg_params,from_addr,msg_id):
+       rate = min(msg_params[0],STREAM_MAX_RATE)
+       if rate > 0:
+          self.peer_streams[from_addr] = 1.0/rate
+       else:
+          self.peer_streams.pop(from_addr,None)
+       yatelog.info('YATEServer','Pushing updates to %s:%s %s times per second' % (from_addr[0],from_addr[1],rate))
+       self.sock.send_streaming(rate,msg_id,to_addr=from_addr)
+   def handle_req_dist_to(self,msg_params,from_addr,msg_id):
+       pos  = self.driver.get_pos()
+       dist = math.sqrt(sum([(msg_params[i]-pos[i])**2 for i in xrange(3)]))
+       self.sock.send_resp_dist_to(msg_params[0],msg_params[1],msg_params[2],dist,msg_id,to_addr=from_addr)
+   def handle_req_nearest_voxel(self,msg_params,from_addr,msg_id):
+       """ Search the visible range for the nearest voxel of the requested type
+       """
+       basic_type,extended_type = msg_params
+       avatar_pos   = self.driver.get_pos()
+       start,end    = utils.calc_range(avatar_pos,self.driver.get_vision_range())
+       nearest      = None
+       nearest_dist = None
+       for vox_pos in utils.iter_within(start,end):
+           eventlet.greenthread.sleep(0)
+           vox = self.driver.get_voxel(vox_pos)
+           if vox.basic_type != basic_type: continue
+           if extended_type != None and vox.specific_type != extended_type: continue
+           dist = sum([(vox_pos[i]-avatar_pos[i])**2 for i in xrange(3)])
+           if nearest is None or dist < nearest_dist:
+              nearest      = vox_pos
+              nearest_dist = dist
+       self.sock.send_resp_nearest_voxel(basic_type,extended_type,nearest,msg_id,to_addr=from_addr)
    def handle_move_vector(self,msg_params,from_addr,msg_id):
        self.driver.move_vector(msg_params)
-       pos = self.driver.get_pos()
-       self.sock.send_avatar_pos(pos[0],pos[1],pos[2],to_addr=from_addr)
+       pos = self.get_avatar_pos()
+       self.sock.send_avatar_pos(pos[0],pos[1],pos[2],to_addr=from_addr,timestamp=time.time())
+   def get_region(self,start,end):
+       """ Bulk transfer of every voxel in a box as params for MSGTYPE_BULK_VOXEL_UPDATE, voxels the driver can't see come out as unknown
+       """
+       start,end = utils.round_vector(start),utils.round_vector(end)
+       size      = (end[0]-start[0])*(end[1]-start[1])*(end[2]-start[2])
+       if size > yatebulk.YATE_BULK_MAX_VOXELS: raise ValueError('Region too big: %s voxels' % size)
+       unknown   = (YATE_VOXEL_UNKNOWN,0,YATE_VOXEL_INACTIVE,YATE_VOXEL_INTACT)
+       states    = []
+       for vox_pos in utils.iter_within(start,end):
+           if len(states) % 4096 == 0: eventlet.greenthread.sleep(0)
+           vox = self.driver.get_voxel(vox_pos)
+           states.append(unknown if vox is None else vox.get_state())
+       return voxelbox.encode_box(start,end,states,pause=eventlet.greenthread.sleep) # pure python, so offloading it wouldn't help
    def get_port(self):
        return self.sock.get_endpoint()[1]
 
@@ -0,0 +1,195 @@
+""" This file implements an optional shared memory transport for observations
+    When the AI runs on the same machine as the proxy (which the DESIGN doc assumes anyway) there's no need to push every
+    voxel box and avatar position through msgpack, zlib and the loopback UDP stack - the proxy can just write them into an
+    mmap-backed file and any number of local readers can look at them directly
+
+    The file starts with YATE_SHM_HEADER, followed by one YATE_SHM_CHANNEL header per channel and then the slots for each channel
+    Each channel is a ring of fixed-size slots, each slot starting with YATE_SHM_SLOT
+    Slots are protected by a seqlock: the writer makes the slot sequence odd while writing and sets it to twice the frame number once done
+    Readers check the sequence before and after using a slot, if it changed the writer lapped them and the data is garbage
+    A voxel box too big for a slot is cropped down around its middle (where the avatar is) until it fits, see YATEShmWriter.get_stats()
+"""
+import mmap
+import struct
+import time
+
+import utils
+import voxelbox
+
+YATE_SHM_MAGIC   = 'YATESHM1'
+YATE_SHM_HEADER  = '<8sI'  # (magic,channel count)
+YATE_SHM_CHANNEL = '<IIIQ' # (slot count,slot size,offset of first slot,number of the newest frame) frame numbers start at 1
+YATE_SHM_SLOT    = '<QId'  # (sequence,payload length,timestamp of the observation)
+
+# channels
+YATE_SHM_AVATAR_POS = 0 # payload is YATE_SHM_POS
+YATE_SHM_VOXEL_BOX  = 1 # payload is YATE_SHM_BOX followed by the palette and then the index data from voxelbox.encode_box()
+
+YATE_SHM_POS         = '<ddd'       # (x,y,z) - the same floats MSGTYPE_AVATAR_POS carries
+YATE_SHM_BOX         = '<iiiiiiII'  # (origin x,origin y,origin z,width,depth,height,palette length,flags)
+YATE_SHM_BOX_PALETTE = '<iiii'      # (basic_type,specific_type,active_state,intact_state) for each palette entry
+
+YATE_SHM_LAYOUT = ((16,64),       # (slot count,slot size) for each channel - avatar positions are tiny
+                   (4,256*1024))  # and voxel boxes are not
+
+class YATEShmWriter:
+   """ Publishes observations into shared memory - there should only ever be one of these per file
+   """
+   def __init__(self,path,layout=YATE_SHM_LAYOUT):
+       """ path is the file to use, somewhere under /dev/shm is the best idea on linux
+           layout is a tuple of (slot count,slot size) tuples, one for each channel
+       """
+       self.slot_header_size = struct.calcsize(YATE_SHM_SLOT)
+       self.channels         = [] # (slot count,slot size,offset of first slot,offset of channel header) for each channel
+       offset                = struct.calcsize(YATE_SHM_HEADER) + struct.calcsize(YATE_SHM_CHANNEL)*len(layout)
+       for i,(slot_count,slot_size) in enumerate(layout):
+           header_offset = struct.calcsize(YATE_SHM_HEADER) + struct.calcsize(YATE_SHM_CHANNEL)*i
+           self.channels.append((slot_count,slot_size,offset,header_offset))
+           offset += slot_count * (self.slot_header_size + slot_size)
+       self.heads = [0] * len(layout)
+       self.stats = {'frames':0,'cropped':0,'cropped_voxels':0}
+       self.fd    = open(path,'w+b')
+       self.fd.truncate(offset)
+       self.mm    = mmap.mmap(self.fd.fileno(),offset)
+       for slot_count,slot_size,slots_offset,header_offset in self.channels:
+           struct.pack_into(YATE_SHM_CHANNEL,self.mm,header_offset,slot_count,slot_size,slots_offset,0)
+       struct.pack_into(YATE_SHM_HEADER,self.mm,0,YATE_SHM_MAGIC,len(self.channels)) # magic goes in last so readers don't see a half-built file
+   def publish(self,channel,payload,timestamp=None):
+       """ Write a frame into the specified channel, overwriting the oldest one
+       """
+       slot_count,slot_size,slots_offset,header_offset = self.channels[channel]
+       if len(payload) > slot_size: raise ValueError('Frame of %s bytes does not fit into a %s byte slot' % (len(payload),slot_size))
+       if timestamp is None: timestamp = time.time()
+       frame_no = self.heads[channel] + 1
+       slot     = slots_offset + (frame_no % slot_count) * (self.slot_header_size + slot_size)
+       data     = slot + self.slot_header_size
+       struct.pack_into(YATE_SHM_SLOT,self.mm,slot,(frame_no*2)-1,len(payload),timestamp) # odd sequence - keep out, wet paint
+       self.mm[data:data+len(payload)] = payload
+       struct.pack_into('<Q',self.mm,slot,frame_no*2)
+       struct.pack_into('<Q',self.mm,header_offset+struct.calcsize('<III'),frame_no)
+       self.heads[channel] = frame_no
+       self.stats['frames'] += 1
+   def get_stats(self):
+       """ Return a dict of counters:
+            frames         is how many frames were published on all channels
+            cropped        is how many voxel boxes were too big for a slot and had to be cropped
+            cropped_voxels is how many voxels were left out of those
+       """
+       return dict(self.stats)
+   def publish_avatar_pos(self,pos,timestamp=None):
+       self.publish(YATE_SHM_AVATAR_POS,struct.pack(YATE_SHM_POS,*pos),timestamp)
+   def publish_voxel_box(self,start,end,states,timestamp=None):
+       """ The params are the same as for voxelbox.encode_box(), but states must not contain None - readers only ever see full boxes
+           If the box doesn't fit into a slot, the biggest box around its middle that does gets published instead
+       """
+       slot_size = self.channels[YATE_SHM_VOXEL_BOX][1]
+       origin    = utils.round_vector(start)
+       end       = utils.round_vector(end)
+       dims      = tuple([end[i]-origin[i] for i in xrange(3)])
+       payload   = encode_box_payload(origin,dims,states)
+       new_dims  = dims
+       while len(payload) > slot_size:
+          if new_dims == (1,1,1): raise ValueError('Even a single voxel does not fit into a %s byte slot' % slot_size)
+          scale      = min(0.9,(float(slot_size) / len(payload)) ** (1.0/3.0)) # the size goes with the volume, roughly
+          new_dims   = tuple([max(1,int(d*scale)) for d in new_dims])
+          new_origin = tuple([origin[i] + (dims[i]-new_dims[i])/2 for i in xrange(3)])
+          payload    = encode_box_payload(new_origin,new_dims,crop_states(dims,states,new_origin[0]-origin[0],new_origin[1]-origin[1],
+                                                                                  new_origin[2]-origin[2],new_dims))
+       if new_dims != dims:
+          self.stats['cropped']        += 1
+          self.stats['cropped_voxels'] += dims[0]*dims[1]*dims[2] - new_dims[0]*new_dims[1]*new_dims[2]
+       self.publish(YATE_SHM_VOXEL_BOX,payload,timestamp)
+   def close(self):
+       self.mm.close()
+       self.fd.close()
+
+def encode_box_payload(origin,dims,states):
+    """ Return the YATE_SHM_VOXEL_BOX payload for a box
+    """
+    end = (origin[0]+dims[0],origin[1]+dims[1],origin[2]+dims[2])
+    origin,dims,palette,flags,data = voxelbox.encode_box(origin,end,states)
+    payload  = struct.pack(YATE_SHM_BOX,origin[0],origin[1],origin[2],dims[0],dims[1],dims[2],len(palette),flags)
+    payload += ''.join([struct.pack(YATE_SHM_BOX_PALETTE,*state) for state in palette])
+    return payload + data
+
+def crop_states(dims,states,off_x,off_y,off_z,new_dims):
+    """ Return the states for the part of a box of size dims starting at (off_x,off_y,off_z) inside it and new_dims big
+        states is in utils.iter_within() order, so x is the outer loop and z changes fastest
+    """
+    w,d,h  = dims
+    retval = []
+    for x in xrange(off_x,off_x+new_dims[0]):
+        for y in xrange(off_y,off_y+new_dims[1]):
+            row = (x*d + y)*h
+            retval.extend(states[row+off_z:row+off_z+new_dims[2]])
+    return retval
+
+class YATEShmFrame:
+   """ A single frame as seen by a reader - data is a view straight into shared memory, not a copy
+       Once you're done with data, call is_valid() - if it returns False, the writer overwrote the slot while you were looking
+   """
+   def __init__(self,mm,slot,seq,frame_no,timestamp,data):
+       self.mm        = mm
+       self.slot      = slot
+       self.seq       = seq
+       self.frame_no  = frame_no
+       self.timestamp = timestamp
+       self.data      = data
+   def is_valid(self):
+       return struct.unpack_from('<Q',self.mm,self.slot)[0] == self.seq
+   def decode_avatar_pos(self):
+       """ Return the (x,y,z) tuple in a YATE_SHM_AVATAR_POS frame
+       """
+       return struct.unpack_from(YATE_SHM_POS,self.data)
+   def decode_voxel_box(self):
+       """ Return a YATE_SHM_VOXEL_BOX frame as MSGTYPE_BULK_VOXEL_UPDATE params, so voxelbox.iter_box() can be used on it
+           The index data is still a view into shared memory
+       """
+       ox,oy,oz,w,d,h,palette_len,flags = struct.unpack_from(YATE_SHM_BOX,self.data)
+       offset  = struct.calcsize(YATE_SHM_BOX)
+       palette = []
+       for i in xrange(palette_len):
+           palette.append(struct.unpack_from(YATE_SHM_BOX_PALETTE,self.data,offset))
+           offset += struct.calcsize(YATE_SHM_BOX_PALETTE)
+       return ((ox,oy,oz),(w,d,h),tuple(palette),flags,buffer(self.data,offset))
+
+class YATEShmReader:
+   """ Reads frames published by a YATEShmWriter, possibly from another process
+   """
+   def __init__(self,path):
+       self.fd = open(path,'rb')
+       self.mm = mmap.mmap(self.fd.fileno(),0,access=mmap.ACCESS_READ)
+       magic,channel_count = struct.unpack_from(YATE_SHM_HEADER,self.mm)
+       if magic != YATE_SHM_MAGIC: raise ValueError('%s is not a YATE shared memory file' % path)
+       self.slot_header_size = struct.calcsize(YATE_SHM_SLOT)
+       self.channels = []
+       for i in xrange(channel_count):
+           header_offset = struct.calcsize(YATE_SHM_HEADER) + struct.calcsize(YATE_SHM_CHANNEL)*i
+           slot_count,slot_size,slots_offset,head = struct.unpack_from(YATE_SHM_CHANNEL,self.mm,header_offset)
+           self.channels.append((slot_count,slot_size,slots_offset,header_offset))
+   def get_head(self,channel):
+       """ Return the number of the newest frame in the specified channel, or 0 if nothing was published yet
+       """
+       header_offset = self.channels[channel][3]
+       return struct.unpack_from('<Q',self.mm,header_offset+struct.calcsize('<III'))[0]
+   def get_frame(self,channel,frame_no):
+       """ Return the specified frame, or None if it has already been overwritten or is being written right now
+       """
+       slot_count,slot_size,slots_offset,header_offset = self.channels[channel]
+       slot = slots_offset + (frame_no % slot_count) * (self.slot_header_size + slot_size)
+       seq,length,timestamp = struct.unpack_from(YATE_SHM_SLOT,self.mm,slot)
+       if seq != frame_no*2: return None
+       frame = YATEShmFrame(self.mm,slot,seq,frame_no,timestamp,buffer(self.mm,slot+self.slot_header_size,length))
+       if not frame.is_valid(): return None
+       return frame
+   def get_latest(self,channel):
+       """ Return the newest frame in the specified channel, or None if there isn't one
+       """
+       while True:
+          head = self.get_head(channel)
+          if head == 0: return None
+          frame = self.get_frame(channel,head)
+          if frame != None: return frame # if it was None, the writer got there first so just try again with the new head
+   def close(self):
+       self.mm.close()
+       self.fd.close()
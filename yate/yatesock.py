@@ -1,239 +1,211 @@
 import eventlet
-import zlib
 eventlet.monkey_patch()
 
-import gc
 import socket
-import msgpack
+import collections
+import yatestats
 
 from yateproto import *
+from yatetransport import YATETransport,YATESockSendMethod,timed_handler,arrival_handler
 
 import yatelog
-import time
+import yatetimer
+import yateoffload
 
-class YATESockSendMethod:
-   def __init__(self,msg_type,sock):
-       self.msg_type = msg_type
-       self.sock     = sock
-       self.q        = sock.out_queues[msg_type]
-   def __call__(self,*args, **kwargs):
-       to_addr = None
-       if kwargs.has_key('to_addr'): to_addr = kwargs['to_addr']
-       msg_id = gen_msg_id()
-       self.q.put((args,msg_id,to_addr))
-       return msg_id
+class YATERunQueue:
+   """ A queue for each message type, drained in priority order (see YATE_MSG_PRIORITY) by whoever calls get()
+       Within a message type it's first in, first out - unless the queue policy for that type says otherwise (see YATE_QUEUE_POLICIES)
+       Items must be tuples with the peer address last, that's what YATE_QUEUE_LATEST and YATE_QUEUE_PEER_OLDEST go by
+   """
+   def __init__(self,policies={},dropped_cb=None):
+       """ policies maps message type integers to (policy,max depth) tuples and overrides the defaults in YATE_QUEUE_POLICIES
+           dropped_cb is called as dropped_cb(msg_type,item) for every item thrown away or replaced by a newer one
+       """
+       self.dropped_cb = dropped_cb
+       self.queues   = {}
+       self.order    = sorted(msgtype_str.keys(),key=lambda k: (YATE_MSG_PRIORITY.get(k,YATE_PRIORITY_DEFAULT),k))
+       self.pending  = eventlet.semaphore.Semaphore(0) # counts queued items, so get() sleeps properly instead of spinning
+       self.policies = dict(YATE_QUEUE_POLICIES)
+       self.policies.update(policies)
+       self.counters = {} # maps message types to [queued,dropped,conflated]
+       for k in self.order:
+           self.queues[k]   = collections.deque()
+           self.counters[k] = [0,0,0]
+   def put(self,msg_type,item):
+       q        = self.queues[msg_type]
+       counters = self.counters[msg_type]
+       counters[0] += 1
+       policy,max_depth = self.policies.get(msg_type,YATE_QUEUE_DEFAULT)
+       if policy == YATE_QUEUE_LATEST:
+          for i in xrange(len(q)):
+              if q[i][-1] == item[-1]:
+                 self.dropped(msg_type,q[i])
+                 q[i] = item
+                 counters[2] += 1
+                 return
+       elif policy == YATE_QUEUE_DROP_OLDEST and len(q) >= max_depth:
+          self.dropped(msg_type,q.popleft())
+          q.append(item)
+          counters[1] += 1
+          return
+       elif policy == YATE_QUEUE_PEER_OLDEST:
+          waiting = [i for i in xrange(len(q)) if q[i][-1] == item[-1]]
+          if len(waiting) >= max_depth:
+             self.dropped(msg_type,q[waiting[0]])
+             del q[waiting[0]]
+             q.append(item)
+             counters[1] += 1
+             return
+       q.append(item)
+       self.pending.release()
+   def dropped(self,msg_type,item):
+       if self.dropped_cb != None: self.dropped_cb(msg_type,item)
+   def get(self,timeout=None):
+       """ Block until something is queued and then return (msg_type,item) for the highest priority item
+           Returns None if woken by wake() or if timeout seconds pass first
+       """
+       if not self.pending.acquire(timeout=timeout): return None
+       for k in self.order:
+           q = self.queues[k]
+           if q: return (k,q.popleft())
+       return None
+   def wake(self):
+       """ Wake up anyone waiting in get() without giving them anything, used for shutting down
+       """
+       self.pending.release()
+   def qsize(self):
+       return sum([len(q) for q in self.queues.values()])
+   def get_stats(self):
+       """ Return a dict mapping message type strings to dicts of queue depth and counters, only for types that were ever queued
+           queued is how many were put in, dropped is how many were thrown away to make room and conflated is how many replaced an older one
+       """
+       retval = {}
+       for k,v in self.counters.items():
+           if v[0]==0: continue
+           retval[msgtype_str[k]] = {'depth':     len(self.queues[k]),
+                                     'queued':    v[0],
+                                     'dropped':   v[1],
+                                     'conflated': v[2]}
+       return retval
 
-class YATESocket:
+class YATESocket(YATETransport):
    """ implements a UDP socket with message queues and async goodness and stuff
    """
-   def __init__(self,bind_ip='127.0.0.1',bind_port=0,handlers={},enable_null_handle=True):
-       """ handlers is a dict mapping message type integers to functions that take the params (msg_params,msg_id,from_addr,sock)
-           enable_null_handle enables a default "null handler" that does nothing with unhandled message types except logging them to debug
+   def __init__(self,bind_ip='127.0.0.1',bind_port=0,handlers={},enable_null_handle=True,compression=True,compress_levels={},batch_delay=YATE_BATCH_DELAY,queue_policies={},capture=None,
+                rcvbuf=YATE_SOCK_RCVBUF,sndbuf=YATE_SOCK_SNDBUF):
+       """ bind_ip and bind_port are where to listen, the default port of 0 picks any free port
+           queue_policies maps message type integers to (policy,max depth) tuples for the incoming and outgoing queues, see YATE_QUEUE_POLICIES
+           rcvbuf and sndbuf are the kernel socket buffer sizes to ask for, None leaves the OS default
+           everything else is passed to YATETransport, see there for details
        """
        self.sock = socket.socket(socket.AF_INET,socket.SOCK_DGRAM)
        self.sock.bind((bind_ip,bind_port))
        yatelog.info('YATESock','Bound %s:%s' % self.sock.getsockname())
        yatelog.info('YATESock','Setting up handlers and queues')
-       self.pool = eventlet.GreenPool(1000)
-       self.in_queues  = {}                             # packets coming in from remote peer go here after parsing, each message type has an independent queue so we can do QoS-type stuff
-       self.out_queues = {}                             # packets going out to remote peer go here
-       self.parse_q    = eventlet.queue.LightQueue(0)   # to keep up performance, packets go here before parsing
-       self.handlers   = {MSGTYPE_CONNECT:      self.handle_connect,       # a couple of standard message handlers, override by passing in new handlers
-                          MSGTYPE_UNKNOWN_PEER: self.handle_unknown_peer,
-                          MSGTYPE_CONNECT_ACK:  self.handle_connect_ack,
-                          MSGTYPE_KEEPALIVE:    self.handle_keepalive,
-                          MSGTYPE_KEEPALIVE_ACK:self.handle_keepalive_ack}
-       self.handlers.update(handlers)
-       self.enable_null_handle = enable_null_handle
-       self.active     = True
-
-       for x in xrange(10): self.pool.spawn_n(self.parser_thread)
-       for k,v in msgtype_str.items():
-           self.in_queues[k]  = eventlet.queue.LightQueue(0)
-           self.out_queues[k] = eventlet.queue.LightQueue(0)
-           setattr(self,'send_%s' % v[8:].lower(),YATESockSendMethod(k,self)) # black magic
-           for x in xrange(2): self.pool.spawn_n(self.msg_sender_thread,k)
-           for x in xrange(2): self.pool.spawn_n(self.msg_reader_thread,k)
-           if enable_null_handle:
-              if not self.handlers.has_key(k): self.handlers[k] = self.null_handler
-       self.known_peers = set() # if this is a server, this set contains the list of clients, if it's a client this contains only 1 member - the server
-       self.last_pack   = {}    # store the timestamp of the last packet from a particular peer so we can do timeouts
+       self.pool         = eventlet.GreenPool(1000)
+       self.handler_pool = eventlet.GreenPool(YATE_HANDLER_CONCURRENCY) # handlers run in here, when it's full the dispatcher waits
+       self.in_q         = YATERunQueue(queue_policies) # messages coming in from remote peers go here after parsing, waiting for a handler
+       self.out_q        = YATERunQueue(queue_policies,lambda msg_type,item: self.msg_dropped(msg_type,item[-1])) # messages going out to remote peers go here
+       # every datagram is received into the same buffer and parsed straight out of it before the next one comes in, so
+       # there's no allocation per packet - the +1 is so we can tell when the kernel cut one short
+       self.recv_buf     = bytearray(YATE_MAX_DATAGRAM+1)
+       self.recv_view    = memoryview(self.recv_buf)
+       self.recv_stats   = {'datagrams':0,'bytes':0,'truncated':0,'short':0}
+       YATETransport.__init__(self,handlers,enable_null_handle,compression,compress_levels,batch_delay,capture)
+       self.setup_sock_bufs(self.sock,rcvbuf,sndbuf)
        self.pool.spawn_n(self.recv_thread)
-       self.pool.spawn_n(self.timeout_thread) # timeout peers all in a central location, giving plenty of time for them to send packets and not timeout
+       self.pool.spawn_n(self.dispatch_thread)
+       self.pool.spawn_n(self.sender_thread)
+       self.pool.spawn_n(self.timeout_thread) # keepalives and timeouts for all peers happen in one place, see YATETransport.run_timers()
    def stop(self):
        """ terminate threads and close cleanly
        """
        self.active = False
+       self.in_q.wake()
+       self.out_q.wake()
+       self.sock.sendto('',self.sock.getsockname()) # wake up recv_thread
        self.pool.waitall()
-       self.sock.shutdown()
-   def connect_to(self,addr):
-       """ Connect to the specified remote peer - this pretty much only really makes sense for clients
-       """
-       yatelog.info('YATESock','Connecting to peer at %s:%s' % addr)
-       msg_id = self.send_connect(to_addr=addr)
-       self.handle_connect(tuple(),addr,msg_id)
-   def is_connected(self,addr):
-       """ Query if the specified peer is still connected
-       """
-       return (addr in self.known_peers)
+       self.sock.close()
+       self.close_capture()
    def get_endpoint(self):
        """ Return the IP endpoint this socket is bound to
        """
        return self.sock.getsockname()
-   def msg_sender_thread(self, msg_type,delay=0):
-       """ World's simplest QoS implementation is here - just set delay to the number of seconds to wait in between each packet transmission
+   def get_queue_stats(self):
+       """ Return a dict with the stats for the incoming ('in') and outgoing ('out') queues, see YATERunQueue.get_stats()
+       """
+       return {'in':  self.in_q.get_stats(),
+               'out': self.out_q.get_stats()}
+   def get_recv_stats(self):
+       """ Return a dict of receive counters:
+            datagrams and bytes count everything read off the socket
+            truncated is datagrams too big to fit in YATE_MAX_DATAGRAM, short is ones too small to hold a frame - both get thrown away
+            kernel_drops and kernel_queued come from the OS (linux only), drops means the receive buffer overflowed
+       """
+       retval = dict(self.recv_stats)
+       retval.update(yatestats.udp_kernel_stats(self.sock))
+       return retval
+   def transmit(self,dgram,addr):
+       self.sock.sendto(dgram,addr)
+   def queue_msg(self,msg_type,msg_tuple):
+       self.out_q.put(msg_type,msg_tuple)
+   def queue_incoming(self,msg_type,msg_tuple):
+       self.in_q.put(msg_type,msg_tuple)
+   def spawn_handler(self,handler,msg_type,msg_params,from_addr,msg_id,msg_time=None,recv_time=None):
+       self.handler_pool.spawn_n(self.run_handler,handler,msg_type,msg_params,from_addr,msg_id,msg_time,recv_time)
+   def schedule_flush(self,delay):
+       pass # sender_thread takes care of it
+   def offload(self,size,fn,*args):
+       return yateoffload.offload(size,fn,*args)
+   def sender_thread(self):
+       """ Sends everything in the outgoing queue, highest priority first
        """
-       msg_type_s = msgtype_str[msg_type]
        while self.active:
-          eventlet.greenthread.sleep(delay)
-          msg_tuple = None
-          while msg_tuple==None:
-             eventlet.greenthread.sleep(0)
+          queued = self.out_q.get(timeout=self.next_flush_delay())
+          if queued != None:
+             msg_type,msg_tuple = queued
              try:
-                msg_tuple = self.out_queues[msg_type].get()
+                self.send_msg(msg_type,*msg_tuple)
              except:
-                yatelog.minor_exception('YATESock','Error reading packet from queue')
-          if msg_tuple != None:
-             msg_params = msg_tuple[0]
-             msg_id     = msg_tuple[1]
-             to_addr    = msg_tuple[2]
-             msgdata    = msgpack.packb((msg_type,msg_params,msg_id))
-             msgdata    = zlib.compress(msgdata)
-             if to_addr==None:
-                yatelog.debug('YATESock','Broadcasting message %s to all peers: %s' % (msg_type,msg_params))
-                peer_list = self.known_peers.copy()
-                for peer in peer_list:
-                    try:
-                       self.sock.sendto(msgdata,peer)
-                       yatelog.debug('YATESock','Sent broadcast message to %s:%s' % peer)
-                    except:
-                       yatelog.minor_exception('YATESock','Error during broadcast of message')
-             else:
-                try:
-                   self.sock.sendto(msgdata,to_addr)
-                   yatelog.debug('YATESock','Sent message %s to %s:%s: %s' % (msg_type_s,to_addr[0],to_addr[1],msg_params))
-                except:
-                   yatelog.minor_exception('YATESock','Error during transmission of message')
-                    
-   def null_handler(self,msg_params,from_addr,msg_id):
-       """ null handler - just dumps the message to log
-       """
-       yatelog.info('YATESock','Null handler dump: message ID %s from %s:%s: %s' % (msg_id,from_addr[0],from_addr[1],str(msg_params)))
-   def handle_unknown_peer(self,msg_params,from_addr,msg_id):
-       """ Handle the UNKNOWN_PEER message
-       """
-       self.known_peers.discard(from_addr)
-       yatelog.info('YATESock','Peer %s:%s does not know us, perhaps we timed out?' % from_addr)
-   def handle_connect_ack(self,msg_params,from_addr,msg_id):
-       """ Confirmed new peers - only really here to shutup the warning when not overridden
-       """
-       yatelog.debug('YATESock','Confirmed connection to %s:%s' % from_addr)
-   def handle_connect(self,msg_params,from_addr,msg_id):
-       """ Handle new peers - this is also called when we connect outwards, so don't subclass and override it like a fool
-       """
-       self.known_peers.add(from_addr)
-       self.pool.spawn_n(self.do_keepalive,from_addr) # send packets to this peer on a regular basis
-       self.send_connect_ack(msg_id,to_addr=from_addr)
+                yatelog.minor_exception('YATESock','Error sending message %s' % msgtype_str[msg_type])
+          self.flush_batches()
    def timeout_thread(self):
-       """ kill peers that have timed out
+       """ turns the timer wheel, which sends keepalives and kills peers that have timed out
        """
        while self.active:
-          eventlet.greenthread.sleep(YATE_KEEPALIVE_TIMEOUT)
-          cur_time  = time.time()
-          peer_list = self.known_peers.copy() # thread safety bitches
-          for peer in peer_list:
-              if not self.last_pack.has_key(peer):
-                 yatelog.warn('YATESock','Peer %s:%s never actually sent us a single packet after connecting' % peer)
-                 self.known_peers.discard(peer)
-              else:
-                 if cur_time - self.last_pack[peer] > YATE_KEEPALIVE_TIMEOUT:
-                    yatelog.info('YATESock','Peer %s:%s has timed out, bye' % peer)
-                    self.known_peers.discard(peer)
-   def do_keepalive(self,client_addr):
-       """ send keepalive packets to the peer so we don't time out
-       """
-       while self.active and (client_addr in self.known_peers):
-          eventlet.greenthread.sleep(YATE_KEEPALIVE_TIMEOUT/2)
-          if client_addr in self.known_peers: self.send_keepalive(to_addr=client_addr)
-   def handle_keepalive(self,msg_params,from_addr,msg_id):
-       """ Send back KEEPALIVE_ACK so we don't time out
-       """
-       self.send_keepalive_ack(msg_id,to_addr=from_addr)
-   def handle_keepalive_ack(self,msg_params,from_addr,msg_id):
-       """ Do nothing, absolutely nothing, fuck all, zilch, zero - the receive loop tracks stuff for us
-       """
-       pass
-   def msg_reader_thread(self, msg_type):
-       """ This is used internally to handle all messages of the specified type when they come in from the parser thread
+          eventlet.greenthread.sleep(yatetimer.YATE_TIMER_TICK)
+          try:
+             self.run_timers()
+          except:
+             yatelog.minor_exception('YATESock','Error running timers')
+   def dispatch_thread(self):
+       """ Takes parsed messages off the incoming queue in priority order and hands them to the handlers
+           Handlers run in handler_pool so a slow one doesn't hold up everything else - if it's full, we wait here and the queue keeps things in order
        """
-       msg_type_s = msgtype_str[msg_type]
        while self.active:
-          eventlet.greenthread.sleep(0)
-          if not self.handlers.has_key(msg_type): # don't bother wasting CPU time on it, just pull from the queue and then do nothing else
-             yatelog.warn('YATESock','No handler for %s' % msg_type_s)
-             try:
-                self.in_queues[msg_type].get()
-             except:
-                pass
-             continue
-          eventlet.greenthread.sleep(0)
-          msg_tuple = None
-          while msg_tuple==None:
-             eventlet.greenthread.sleep(0)
-             try:
-                msg_tuple = self.in_queues[msg_type].get()
-             except:
-                yatelog.minor_exception('YATESock','Error reading packet from queue')
-          if msg_tuple != None:
-             msg_params = msg_tuple[0]
-             msg_id     = msg_tuple[1]
-             from_addr  = msg_tuple[2]
-             yatelog.debug('YATESock','Got message %s from %s:%s: %s' % (msg_type_s,from_addr[0],from_addr[1],msg_params))
-             if (from_addr in self.known_peers):
-                try:
-                   self.handlers[msg_type](msg_params,from_addr,msg_id)
-                except:
-                   yatelog.minor_exception('YATESock','Error handling message')
-             else:
-                if msg_type == MSGTYPE_CONNECT:
-                   self.handle_connect(msg_params,from_addr,msg_id)
-                else:
-                   self.send_unknown_peer(to_addr=from_addr)
+          queued = self.in_q.get()
+          if queued is None: continue
+          msg_type,msg_tuple = queued
+          msg_params,msg_id,msg_time,recv_time,from_addr = msg_tuple
+          self.dispatch_msg(msg_type,msg_params,msg_id,from_addr,msg_time,recv_time)
    def recv_thread(self):
-       """ receives packets from the socket as fast as possible and shoves them into the parser queue
+       """ receives packets from the socket, parses them and shoves them into the incoming queue
        """
        while self.active:
-          eventlet.greenthread.sleep(0)
-          data,addr = None,None
+          nbytes,addr = 0,None
           try:
-             data,addr = self.sock.recvfrom(8192)
+             nbytes,addr = self.sock.recvfrom_into(self.recv_buf)
           except:
-             pass
-          if data != None:
-             # store the actual time we got the packet here, it's not fair to timeout peers for our slow parsing
-             if addr in self.known_peers: # but don't open up a very silly DDoS vulnerability
-                self.last_pack[addr] = time.time()
-             self.parse_q.put((data,addr))
-
-   def parser_thread(self):
-       while self.active:
-         eventlet.greenthread.sleep(0)
-         data,addr = None,None
-         while data==None:
-            eventlet.greenthread.sleep(0)
-            try:
-               data,addr = self.parse_q.get()
-            except:
-               yatelog.minor_exception('YATESock','Failed during parse receive')
-         if data != None:
-            data = zlib.decompress(data)
-            gc.disable() # performance hack for msgpack
-            try:
-               msg        = msgpack.unpackb(data,use_list = False)
-               msg_type   = msg[0]
-               msg_params = msg[1]
-               msg_id     = msg[2]
-               self.in_queues[msg_type].put((msg_params,msg_id,addr))
-            except:
-               yatelog.minor_exception('YATESock','Error while parsing packet from %s:%s' % addr)
-            gc.enable()
+             if not self.active: return
+             yatelog.minor_exception('YATESock','Error receiving packet')
+          if nbytes==0: continue
+          self.recv_stats['datagrams'] += 1
+          self.recv_stats['bytes']     += nbytes
+          if nbytes > YATE_MAX_DATAGRAM:
+             self.recv_stats['truncated'] += 1
+             yatelog.warn('YATESock','Dropped oversized datagram from %s:%s' % addr)
+             continue
+          if nbytes < self.frame_size:
+             self.recv_stats['short'] += 1
+             continue
+          self.got_datagram(self.recv_view[:nbytes],addr)
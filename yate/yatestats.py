@@ -0,0 +1,141 @@
+""" This file implements the counters and histograms YATE sockets keep about what they're doing
+    Everything here is plain dicts, lists and numbers once turned into a dict with as_dict(), so it can go straight into
+    msgpack for MSGTYPE_STATS or json for dumping to a file
+"""
+import os
+import time
+
+from yateproto import *
+
+YATE_HISTOGRAM_BUCKETS = 24 # bucket n counts durations under 2**n microseconds, so the last one is about 8 seconds and up
+
+class YATEHistogram:
+   """ A log2 histogram of durations in seconds - cheap enough to update for every single message
+   """
+   def __init__(self):
+       self.buckets = [0] * YATE_HISTOGRAM_BUCKETS
+       self.count   = 0
+       self.total   = 0.0
+       self.max     = 0.0
+   def add(self,secs):
+       usecs  = int(secs * 1000000)
+       bucket = min(usecs.bit_length(),YATE_HISTOGRAM_BUCKETS-1) if usecs > 0 else 0
+       self.buckets[bucket] += 1
+       self.count += 1
+       self.total += secs
+       if secs > self.max: self.max = secs
+   def percentile(self,p):
+       """ Return the upper bound in seconds of the bucket the p'th percentile falls into - p is 0 to 100
+       """
+       if self.count == 0: return 0.0
+       wanted = self.count * p / 100.0
+       seen   = 0
+       for i,n in enumerate(self.buckets):
+           seen += n
+           if seen >= wanted: return (2**i) / 1000000.0
+       return self.max
+   def as_dict(self):
+       return {'count':   self.count,
+               'mean':    self.total / self.count if self.count else 0.0,
+               'max':     self.max,
+               'p50':     self.percentile(50),
+               'p90':     self.percentile(90),
+               'p99':     self.percentile(99),
+               'buckets': list(self.buckets)}
+
+def udp_kernel_stats(sock):
+    """ Look up what the kernel says about a UDP socket - on linux this is the drops and receive queue columns of /proc/net/udp
+        Returns an empty dict anywhere else
+    """
+    try:
+       inode = str(os.fstat(sock.fileno()).st_ino)
+       with open('/proc/net/udp','r') as fd:
+          for line in fd.readlines()[1:]:
+              fields = line.split()
+              if fields[9] != inode: continue
+              return {'kernel_drops':  int(fields[-1]),
+                      'kernel_queued': int(fields[4].split(':')[1],16)}
+    except (IOError,OSError,IndexError,ValueError):
+       pass
+    return {}
+
+def peer_str(addr):
+    return '%s:%s' % (addr[0],addr[1])
+
+class YATEStats:
+   """ Counters for each message type and each peer
+   """
+   def __init__(self):
+       self.started = time.time()
+       self.types   = {} # maps message types to dicts of counters, see type_counters()
+       self.peers   = {} # maps peer addresses to dicts of counters, see peer_counters()
+   def type_counters(self,msg_type):
+       counters = self.types.get(msg_type)
+       if counters is None:
+          counters = self.types[msg_type] = {'msgs_in':0,'bytes_in':0,'msgs_out':0,'bytes_out':0,'handler_time':YATEHistogram()}
+       return counters
+   def peer_counters(self,addr):
+       counters = self.peers.get(addr)
+       if counters is None:
+          counters = self.peers[addr] = {'msgs_in':0,'bytes_in':0,'msgs_out':0,'bytes_out':0,
+                                         'datagrams_in':0,'datagrams_out':0,'parse_errors':0,'rtt':YATEHistogram(),
+                                         'handler_time':0.0, # total seconds spent running handlers for this peer
+                                         'throttled':0,      # messages dropped for going over YATE_PEER_MSG_RATE
+                                         'rejected':0,       # messages dropped for going over YATE_ADMISSION_LIMITS
+                                         'paced':0,          # messages that had to wait for budget before going out
+                                         'pace_dropped':0}   # messages dropped while waiting for budget
+       return counters
+   def msg_in(self,msg_type,addr,size):
+       """ A message was parsed, size is the size of its frame - addr is None if it came from a peer we don't know
+       """
+       counters = self.type_counters(msg_type)
+       counters['msgs_in']  += 1
+       counters['bytes_in'] += size
+       if addr is None: return
+       counters = self.peer_counters(addr)
+       counters['msgs_in']  += 1
+       counters['bytes_in'] += size
+   def msg_out(self,msg_type,addr,size):
+       """ A message was framed for sending, size is the size of its frame - addr is None if it's going to a peer we don't know
+       """
+       counters = self.type_counters(msg_type)
+       counters['msgs_out']  += 1
+       counters['bytes_out'] += size
+       if addr is None: return
+       counters = self.peer_counters(addr)
+       counters['msgs_out']  += 1
+       counters['bytes_out'] += size
+   def datagram_in(self,addr):
+       self.peer_counters(addr)['datagrams_in'] += 1
+   def datagram_out(self,addr):
+       self.peer_counters(addr)['datagrams_out'] += 1
+   def parse_error(self,addr):
+       self.peer_counters(addr)['parse_errors'] += 1
+   def handler_time(self,msg_type,secs,addr=None):
+       self.type_counters(msg_type)['handler_time'].add(secs)
+       if addr in self.peers: self.peers[addr]['handler_time'] += secs
+   def count(self,addr,counter):
+       """ Add one to one of the simple per-peer counters
+       """
+       self.peer_counters(addr)[counter] += 1
+   def rtt(self,addr,secs):
+       """ A keepalive to addr was acknowledged after secs seconds
+       """
+       self.peer_counters(addr)['rtt'].add(secs)
+   def forget_peer(self,addr):
+       self.peers.pop(addr,None)
+   def as_dict(self):
+       """ Return everything as a dict keyed by message type names and 'ip:port' strings
+       """
+       retval = {'uptime': time.time() - self.started,
+                 'types':  {},
+                 'peers':  {}}
+       for msg_type,counters in self.types.items():
+           d = dict(counters)
+           d['handler_time'] = counters['handler_time'].as_dict()
+           retval['types'][msgtype_str[msg_type]] = d
+       for addr,counters in self.peers.items():
+           d = dict(counters)
+           d['rtt'] = counters['rtt'].as_dict()
+           retval['peers'][peer_str(addr)] = d
+       return retval
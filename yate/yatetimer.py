@@ -0,0 +1,46 @@
+""" This file implements a hashed timer wheel, used by YATE sockets to keep track of when each peer needs looking at
+    Scheduling and cancelling are O(1) and advancing only looks at the slots for the ticks that passed, so it doesn't matter
+    how many peers there are - nothing in here knows about the event loop, whoever owns the wheel calls advance() every tick
+"""
+import math
+
+YATE_TIMER_TICK  = 0.25 # seconds per slot, timers fire up to this late
+YATE_TIMER_SLOTS = 64   # how many slots in the wheel, anything further away than slots*tick just goes round again
+
+class YATETimerWheel:
+   def __init__(self,now,tick=YATE_TIMER_TICK,slots=YATE_TIMER_SLOTS):
+       self.tick     = tick
+       self.slots    = [{} for i in xrange(slots)] # each slot maps keys to the time they're due
+       self.entries  = {}                          # maps keys to the slot they're in
+       self.cur_tick = int(now / tick)
+   def __len__(self):
+       return len(self.entries)
+   def __contains__(self,key):
+       return key in self.entries
+   def schedule(self,key,when):
+       """ Arrange for key to come out of advance() once it's when o'clock - if it's already scheduled it gets moved
+       """
+       self.cancel(key)
+       due_tick = max(int(math.ceil(when / self.tick)),self.cur_tick+1)
+       slot     = due_tick % len(self.slots)
+       self.slots[slot][key] = when
+       self.entries[key]     = slot
+   def cancel(self,key):
+       slot = self.entries.pop(key,None)
+       if slot != None: del self.slots[slot][key]
+   def advance(self,now):
+       """ Move the wheel along to now and return a list of all the keys that came due, they're no longer scheduled after this
+       """
+       now_tick = int(now / self.tick)
+       expired  = []
+       if now_tick <= self.cur_tick: return expired
+       ticks    = min(now_tick - self.cur_tick,len(self.slots)) # if we fell a long way behind, one lap looks at everything
+       for t in xrange(now_tick - ticks + 1,now_tick + 1):
+           slot = self.slots[t % len(self.slots)]
+           for key,when in slot.items():
+               if when > now: continue # it's on a later lap
+               del slot[key]
+               del self.entries[key]
+               expired.append(key)
+       self.cur_tick = now_tick
+       return expired
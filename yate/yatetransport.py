@@ -0,0 +1,986 @@
+""" This file implements the parts of the YATE transport that don't care what event loop they run under
+    Peer tracking, capability negotiation, compression, framing, fragments, batching and message parsing all live here in
+    YATETransport, while yatesock.py (eventlet) and yateasync.py (asyncio) supply the sockets, queues and timers
+    Nothing in here may import eventlet - it monkey patches everything, which is exactly what the asyncio backend is trying to avoid
+"""
+import gc
+import json
+import zlib
+import struct
+import itertools
+import collections
+import time
+import socket
+import msgpack
+
+from yateproto import *
+
+import yatelog
+import yatezdict
+import yatestats
+import yatecapture
+import yatetimer
+import yateqos
+import yatecache
+import yateclock
+
+def as_bytes(data):
+    """ Turn a memoryview of a receive buffer into a string, for the things that can't read straight out of one (zlib on python 2)
+    """
+    if isinstance(data,memoryview): return data.tobytes()
+    return data
+
+def inflate(data,max_size=YATE_MAX_MSG_SIZE):
+    """ zlib.decompress() that gives up once the output gets bigger than max_size, so a small datagram can't blow up into
+        a huge message on us
+    """
+    d      = zlib.decompressobj()
+    retval = d.decompress(data,max_size)
+    if d.unconsumed_tail: raise ValueError('Compressed message is bigger than %s bytes' % max_size)
+    retval += d.flush()
+    if len(retval) > max_size: raise ValueError('Compressed message is bigger than %s bytes' % max_size)
+    return retval
+
+class YATESockSendMethod:
+   def __init__(self,msg_type,sock):
+       self.msg_type = msg_type
+       self.sock     = sock
+   def __call__(self,*args, **kwargs):
+       to_addr = None
+       if kwargs.has_key('to_addr'): to_addr = kwargs['to_addr']
+       if kwargs.get('timestamp') != None: args = YATEStamped(args,kwargs['timestamp'])
+       msg_id = gen_msg_id()
+       self.sock.queue_msg(self.msg_type,(args,msg_id,to_addr))
+       return msg_id
+
+def timed_handler(handler):
+   """ Use this to decorate message handlers that want to know when what the message describes was observed
+       They get called as handler(msg_params,from_addr,msg_id,msg_time) - msg_time is by our clock, or None if the sender didn't say
+   """
+   handler.timed = True
+   return handler
+
+def arrival_handler(handler):
+   """ Use this to decorate message handlers that want to know when the datagram carrying the message arrived
+       They get called as handler(msg_params,from_addr,msg_id,recv_time) - recv_time is by our clock, noted by got_datagram()
+       before the message sat in any queues
+   """
+   handler.arrival = True
+   return handler
+
+class YATEStamped:
+   """ Wraps the params of a message sent with a timestamp, see YATE_FLAG_TIME - send methods take timestamp as a keyword arg
+   """
+   def __init__(self,params,timestamp):
+       self.params    = params
+       self.timestamp = timestamp
+
+class YATECachedParams:
+   """ Stands in for the params of a message sent with YATETransport.send_cached(), so they only get worked out if they're needed
+   """
+   def __init__(self,cache_key,make_params):
+       self.cache_key   = cache_key
+       self.make_params = make_params
+       self.made        = False
+       self.params      = None
+   def get(self):
+       if not self.made:
+          self.params = self.make_params()
+          self.made   = True
+       return self.params
+
+class YATETransport:
+   """ Base class for YATE sockets, subclasses must implement the methods at the bottom that raise NotImplementedError
+   """
+   def __init__(self,handlers={},enable_null_handle=True,compression=True,compress_levels={},batch_delay=YATE_BATCH_DELAY,capture=None):
+       """ handlers is a dict mapping message type integers to functions that take the params (msg_params,from_addr,msg_id)
+           enable_null_handle enables a default "null handler" that does nothing with unhandled message types except logging them to debug
+           compression sets whether or not we offer zlib compression (and our preset dictionaries) to peers, it's only used if both ends agree on it
+           compress_levels maps message type integers to zlib levels and overrides the defaults in YATE_ZLIB_LEVELS, 0 turns compression off for that type
+           batch_delay is how long small outgoing messages wait to be packed into one datagram with others to the same peer, 0 sends everything right away
+           capture is the filename to record all incoming and outgoing messages to, see yatecapture.py - None means don't bother
+       """
+       self.handlers   = {MSGTYPE_CONNECT:      self.handle_connect,       # a couple of standard message handlers, override by passing in new handlers
+                          MSGTYPE_UNKNOWN_PEER: self.handle_unknown_peer,
+                          MSGTYPE_CONNECT_ACK:  self.handle_connect_ack,
+                          MSGTYPE_KEEPALIVE:    self.handle_keepalive,
+                          MSGTYPE_KEEPALIVE_ACK:self.handle_keepalive_ack,
+                          MSGTYPE_SUBSCRIBE:    self.handle_subscribe,
+                          MSGTYPE_REQUEST_STATS:self.handle_request_stats}
+       self.handlers.update(handlers)
+       self.enable_null_handle = enable_null_handle
+       self.active     = True
+
+       for k,v in msgtype_str.items():
+           setattr(self,'send_%s' % v[8:].lower(),YATESockSendMethod(k,self)) # black magic
+           if enable_null_handle:
+              if not self.handlers.has_key(k): self.handlers[k] = self.null_handler
+       self.known_peers = set() # if this is a server, this set contains the list of clients, if it's a client this contains only 1 member - the server
+       self.last_pack   = {}    # store the timestamp of the last packet from a particular peer so we can do timeouts
+       self.last_sent   = {}    # and the last one we sent them, so we only need keepalives when there's nothing else going on
+       self.timers      = yatetimer.YATETimerWheel(time.time()) # every peer is in here, due when it either needs a keepalive or has timed out
+       self.next_housekeeping = time.time() + YATE_KEEPALIVE_TIMEOUT
+       self.frag_keys      = itertools.count() # used to tag all the fragments of one outgoing message
+       self.fragments      = {}                # incomplete incoming messages: maps (addr,key) to [last_seen,count,{index:data}]
+       self.fragment_bytes = 0                 # total size of everything in self.fragments
+       self.caps            = {'zlib':  compression,                                              # what we offer peers when connecting
+                               'zdict': yatezdict.YATE_ZDICT_VERSIONS.keys() if compression else [],
+                               'time':  True}
+       self.peer_caps       = {}                   # what we agreed on with each peer, until we hear from them we assume nothing
+       self.peer_cap_fns    = {}                   # maps cap names to functions of the peer address, for caps we send in
+                                                   # MSGTYPE_CONNECT_ACK that are different for each peer - see handle_connect()
+       self.compress_levels = dict(YATE_ZLIB_LEVELS)
+       self.compress_levels.update(compress_levels)
+       self.compress_stats  = {}                   # maps message types to [messages,compressed messages,raw bytes,sent bytes,cpu seconds,
+                                                   #                        messages that went with the preset dictionary]
+       self.compress_misses = {}                   # maps message types to how many in a row didn't shrink when compressed
+       self.compress_codecs = {}                   # maps message types to whichever of YATE_FLAG_ZLIB or YATE_FLAG_ZDICT did better
+                                                   # the last time both were tried, see compress_msg()
+       self.peer_seq_out    = {}                   # maps peers to the sequence number of the last message we sent them
+       self.peer_seq_stats  = {}                   # maps peers to dicts of counters for what we've received from them, see track_seq()
+       self.frame_size      = struct.calcsize(YATE_FRAME_HEADER)
+       self.time_size       = struct.calcsize(YATE_FRAME_TIME)
+       self.batch_delay     = batch_delay
+       self.batches         = {}                   # maps peers to [deadline,frames,size] for messages waiting to be sent together
+       self.batch_len_size  = struct.calcsize(YATE_BATCH_LENGTH)
+       self.send_counts     = [0,0]                # [datagrams sent,messages sent] - the difference is what batching saved us
+       self.peer_subs       = {}                   # maps peers to what they subscribed to, see handle_subscribe()
+       self.pings           = {}                   # maps msg_ids of keepalives we sent to (peer,time sent), so the ACK tells us the round trip time
+       self.last_ping       = {}                   # maps peers to when we last sent them a keepalive
+       self.clocks          = {}                   # maps peers to a YATEClock for turning their timestamps into our time
+       self.stats           = yatestats.YATEStats()
+       self.peer_rates      = {}                   # maps peers to (rate,burst) for sending to them, if it's not the default - see set_peer_rate()
+       self.out_buckets     = {}                   # maps peers to the YATETokenBucket for what we send them
+       self.in_buckets      = {}                   # maps peers to the YATETokenBucket for how many messages they send us
+       self.paced           = {}                   # maps peers to a deque of [msg_type,datagrams,how many sent] waiting for budget, see pace_msg()
+       self.in_flight       = {}                   # maps (peer,msg_type) to how many handlers are running, see YATE_ADMISSION_LIMITS
+       self.drop_handlers   = {}                   # maps message types to functions called as fn(msg_type,peer) when one we were asked to
+                                                   # send a peer gets thrown away before it went out, see msg_dropped()
+       self.encode_cache    = yatecache.YATELRUCache(YATE_ENCODE_CACHE_BYTES,YATE_ENCODE_CACHE_ENTRIES) # see send_cached()
+       self.capture         = None
+       if capture != None:
+          yatelog.info('YATESock','Recording traffic to %s' % capture)
+          self.capture = yatecapture.YATECaptureWriter(capture)
+   def close_capture(self):
+       if self.capture is None: return
+       self.capture.close()
+       self.capture = None
+   def connect_to(self,addr):
+       """ Connect to the specified remote peer - this pretty much only really makes sense for clients
+       """
+       yatelog.info('YATESock','Connecting to peer at %s:%s' % addr)
+       msg_id = self.send_connect(self.caps,to_addr=addr)
+       self.pings[msg_id] = (addr,time.time()) # the CONNECT_ACK doubles as our first clock sample
+       self.handle_connect(tuple(),addr,msg_id)
+   def forget_peer(self,addr):
+       """ Drop a peer and everything we know about it
+       """
+       self.known_peers.discard(addr)
+       self.last_pack.pop(addr,None)
+       self.last_sent.pop(addr,None)
+       self.timers.cancel(addr)
+       self.batches.pop(addr,None)
+       for ping_id,sent in self.pings.items():
+           if sent[0]==addr: del self.pings[ping_id]
+       self.peer_caps.pop(addr,None)
+       self.last_ping.pop(addr,None)
+       self.clocks.pop(addr,None)
+       self.peer_seq_out.pop(addr,None)
+       self.peer_seq_stats.pop(addr,None)
+       self.peer_subs.pop(addr,None)
+       self.peer_rates.pop(addr,None)
+       self.out_buckets.pop(addr,None)
+       self.in_buckets.pop(addr,None)
+       self.paced.pop(addr,None)
+       for k in self.in_flight.keys():
+           if k[0]==addr: del self.in_flight[k]
+       self.stats.forget_peer(addr)
+   def set_peer_caps(self,addr,caps):
+       """ Work out what transport features to use with a peer from the caps dict it sent us
+            'zlib' is a boolean indicating if the peer can decompress messages
+            'zdict' is a list of the preset dictionary versions the peer has, we use the newest one we both have
+            'tcp' is the port the peer serves bulk transfers on if it has the TCP side channel, see yatebulk.py
+            'tcp_token' is what we have to send with every bulk transfer request so the peer knows it's really us
+            'time' is true if the peer understands YATE_FLAG_TIME and sends clock samples in keepalive ACKs - in the caps that
+                   come with MSGTYPE_CONNECT_ACK it's (recv_time,send_time) for the CONNECT, like a keepalive ACK
+       """
+       if not isinstance(caps,dict): return
+       agreed = {'zlib': bool(self.caps['zlib'] and caps.get('zlib',False)),
+                 'zdict':0,
+                 'tcp':  caps.get('tcp'),
+                 'tcp_token': caps.get('tcp_token'),
+                 'time': bool(caps.get('time',False))}
+       common_zdicts = set(self.caps['zdict']) & set(caps.get('zdict',()))
+       if agreed['zlib'] and common_zdicts: agreed['zdict'] = max(common_zdicts)
+       yatelog.debug('YATESock','Agreed capabilities with %s:%s: %s' % (addr[0],addr[1],agreed))
+       self.peer_caps[addr] = agreed
+   def next_seq(self,addr):
+       """ Return the next outgoing sequence number for a peer
+       """
+       seq = (self.peer_seq_out.get(addr,0) + 1) & 0xFFFFFFFF
+       self.peer_seq_out[addr] = seq
+       return seq
+   def track_seq(self,addr,seq):
+       """ Update the counters for a peer with the sequence number of a message we just got from them
+           received   is the number of messages received
+           lost       is the number of gaps in the sequence that have not been filled in by late messages
+           duplicates is the number of messages we got more than once
+           reordered  is the number of messages that turned up after a message with a higher sequence number
+       """
+       stats = self.peer_seq_stats.get(addr)
+       if stats is None:
+          self.peer_seq_stats[addr] = {'received':1,'lost':0,'duplicates':0,'reordered':0,'highest':seq,'window':1}
+          return
+       stats['received'] += 1
+       delta = (seq - stats['highest']) & 0xFFFFFFFF
+       if delta & 0x80000000: delta -= 0x100000000 # sequence numbers wrap, so anything more than halfway round is in the past
+       if delta > 0:
+          stats['lost']    += delta - 1
+          stats['window']   = ((stats['window'] << delta) | 1) & ((1 << YATE_SEQ_WINDOW) - 1)
+          stats['highest']  = seq
+       elif delta == 0:
+          stats['duplicates'] += 1
+       elif -delta >= YATE_SEQ_WINDOW: # too old to know if we've seen it, so assume it's just very late
+          stats['reordered'] += 1
+          if stats['lost'] > 0: stats['lost'] -= 1
+       elif stats['window'] & (1 << -delta):
+          stats['duplicates'] += 1
+       else:
+          stats['window']    |= (1 << -delta)
+          stats['reordered'] += 1
+          if stats['lost'] > 0: stats['lost'] -= 1
+   def get_seq_stats(self):
+       """ Return a dict mapping peer addresses to dicts of loss, duplicate and reordering counters - see track_seq()
+       """
+       retval = {}
+       for addr,stats in self.peer_seq_stats.items():
+           retval[addr] = {'received':   stats['received'],
+                           'lost':       stats['lost'],
+                           'duplicates': stats['duplicates'],
+                           'reordered':  stats['reordered']}
+       return retval
+   def get_compress_stats(self):
+       """ Return a dict mapping message type strings to dicts of compression stats
+       """
+       retval = {}
+       for k,v in self.compress_stats.items():
+           messages,compressed,raw_bytes,sent_bytes,cpu,zdict = v
+           retval[msgtype_str[k]] = {'messages':   messages,
+                                     'compressed': compressed,
+                                     'zdict':      zdict,
+                                     'raw_bytes':  raw_bytes,
+                                     'sent_bytes': sent_bytes,
+                                     'ratio':      float(sent_bytes) / float(raw_bytes) if raw_bytes else 1.0,
+                                     'cpu':        cpu}
+       return retval
+   def get_queue_stats(self):
+       """ Return a dict of queue stats, subclasses that have queues override this
+       """
+       return {}
+   def get_recv_stats(self):
+       """ Return a dict of receive path stats, subclasses that read the socket themselves override this
+       """
+       return {}
+   def setup_sock_bufs(self,sock,rcvbuf,sndbuf):
+       """ Ask the kernel for the specified socket buffer sizes, None leaves them alone - the kernel may not give us all we asked for
+       """
+       for opt,size,name in ((socket.SO_RCVBUF,rcvbuf,'receive'),(socket.SO_SNDBUF,sndbuf,'send')):
+           if size is None: continue
+           try:
+              sock.setsockopt(socket.SOL_SOCKET,opt,size)
+           except:
+              yatelog.minor_exception('YATESock','Could not set %s buffer size' % name)
+           yatelog.info('YATESock','Kernel %s buffer is %s bytes, asked for %s' % (name,sock.getsockopt(socket.SOL_SOCKET,opt),size))
+   def get_stats(self):
+       """ Return everything we know about how the transport is doing as a dict of plain types
+            types       maps message type names to message and byte counts in each direction, and a histogram of handler execution times
+            peers       maps 'ip:port' strings to message, byte and datagram counts, parse errors and a histogram of keepalive round trip times
+            compression is the same as get_compress_stats()
+            seq         is the same as get_seq_stats() but keyed by 'ip:port' strings
+            queues      is the same as get_queue_stats()
+            recv        is the same as get_recv_stats()
+            batching    is the total number of datagrams and messages sent
+            encode_cache is how full the cache for send_cached() is and how often it saved us encoding something
+            clocks      maps 'ip:port' strings to how far ahead of ours we think each peer's clock is, see yateclock.py
+       """
+       retval = self.stats.as_dict()
+       retval['compression'] = self.get_compress_stats()
+       retval['seq']         = dict([(yatestats.peer_str(k),v) for k,v in self.get_seq_stats().items()])
+       retval['queues']      = self.get_queue_stats()
+       retval['recv']        = self.get_recv_stats()
+       retval['batching']    = {'datagrams': self.send_counts[0],
+                                'messages':  self.send_counts[1]}
+       retval['encode_cache'] = self.encode_cache.get_stats()
+       retval['clocks']       = dict([(yatestats.peer_str(k),v.as_dict()) for k,v in self.clocks.items()])
+       return retval
+   def dump_stats(self,filename):
+       """ Write get_stats() out to a file as json
+       """
+       with open(filename,'w') as fd:
+          json.dump(self.get_stats(),fd,indent=1,sort_keys=True)
+   def compress_msg(self,msg_type,msgdata,zdict_version=0):
+       """ Compress an encoded message if it's worth it - returns (flags,body)
+           if zdict_version is not 0, the specified preset dictionary may be used instead of plain zlib - for messages small enough
+           for both, both are only tried every YATE_COMPRESS_RETRY messages of a type and in between the one that came out
+           smaller last time is used alone, so picking doesn't cost double the CPU - the message goes as it is if it doesn't shrink
+       """
+       stats = self.compress_stats.get(msg_type)
+       if stats is None: stats = self.compress_stats[msg_type] = [0,0,0,0,0.0,0]
+       stats[0] += 1
+       stats[2] += len(msgdata)
+       level  = self.compress_levels.get(msg_type,YATE_ZLIB_LEVEL_DEFAULT)
+       misses = self.compress_misses.get(msg_type,0)
+       if misses >= YATE_COMPRESS_GIVE_UP: # this type never seems to shrink, so only try again every now and then
+          self.compress_misses[msg_type] = misses+1
+          if misses % YATE_COMPRESS_RETRY: level = 0
+       use_zlib  = len(msgdata) >= YATE_COMPRESS_MIN_SIZE
+       use_zdict = zdict_version and YATE_ZDICT_MIN_SIZE <= len(msgdata) <= YATE_ZDICT_MAX_SIZE
+       probe     = False
+       if use_zlib and use_zdict:
+          codec = self.compress_codecs.get(msg_type)
+          probe = codec is None or stats[0] % YATE_COMPRESS_RETRY == 0 # see if the other one does better now and then
+          if not probe:
+             use_zlib  = codec == YATE_FLAG_ZLIB
+             use_zdict = codec == YATE_FLAG_ZDICT
+       if level == 0 or not (use_zlib or use_zdict):
+          stats[3] += len(msgdata)
+          return (0,msgdata)
+       start_time = time.clock()
+       flags,body = (0,msgdata)
+       if use_zlib:
+          compressed = self.offload(len(msgdata),zlib.compress,msgdata,level)
+          zlib_size  = len(compressed)
+          if len(compressed) < len(body): flags,body = (YATE_FLAG_ZLIB,compressed)
+       if use_zdict:
+          compressed = chr(zdict_version) + yatezdict.get_zdict(zdict_version).compress(msgdata,level) # never big enough to offload
+          if probe: self.compress_codecs[msg_type] = YATE_FLAG_ZDICT if len(compressed) < zlib_size else YATE_FLAG_ZLIB
+          if len(compressed) < len(body): flags,body = (YATE_FLAG_ZDICT,compressed)
+       stats[4]  += time.clock() - start_time
+       stats[3]  += len(body)
+       if flags == 0:
+          self.compress_misses[msg_type] = misses+1
+          return (0,msgdata)
+       self.compress_misses[msg_type] = 0
+       stats[1] += 1
+       if flags == YATE_FLAG_ZDICT: stats[5] += 1
+       return (flags,body)
+   def wants(self,addr,msg_type,pos=None):
+       """ Check if a peer wants to be sent a message it didn't ask for, according to what it subscribed to
+           pos is the (x,y,z) position the message is about, if it's about a particular place
+           This doesn't use up any of the peer's max_rate, only messages that actually get sent do - see count_sent()
+           Peers that never subscribed get everything, and control messages always get through
+       """
+       subs = self.peer_subs.get(addr)
+       if subs is None: return True
+       if YATE_MSG_PRIORITY.get(msg_type,YATE_PRIORITY_DEFAULT) == YATE_PRIORITY_CONTROL: return True
+       if subs['types'] != None and not (msg_type in subs['types']): return False
+       if subs['region'] != None and pos != None:
+          start,end = subs['region']
+          for i in xrange(3):
+              if pos[i] < start[i] or pos[i] >= end[i]: return False
+       if subs['interval'] > 0:
+          if time.time() - subs['last_sent'].get(msg_type,0) < subs['interval']: return False
+       return True
+   def count_sent(self,addr,msg_type):
+       """ Remember that a message went out to a peer, so wants() can hold back the next one if they asked for a max_rate
+       """
+       subs = self.peer_subs.get(addr)
+       if subs != None and subs['interval'] > 0: subs['last_sent'][msg_type] = time.time()
+   def get_region(self,addr):
+       """ Return the (start,end) region a peer subscribed to, or None if it wants everywhere
+       """
+       subs = self.peer_subs.get(addr)
+       if subs is None: return None
+       return subs['region']
+   def is_connected(self,addr):
+       """ Query if the specified peer is still connected
+       """
+       return (addr in self.known_peers)
+   def next_flush_delay(self):
+       """ Return how long until the next batch is due to be sent or a peer has the budget for the next paced message,
+           or None if nothing is waiting
+       """
+       if not (self.batches or self.paced): return None
+       cur_time = time.time()
+       delays   = [b[0] - cur_time for b in self.batches.values()]
+       for peer in self.paced.keys():
+           bucket  = self.out_bucket(peer,cur_time)
+           delays.append(bucket.wait_time(cur_time,self.pace_reserve(peer,bucket)))
+       return max(0,min(delays))
+   def flush_batches(self,force=False):
+       """ Send any batches that are due, or all of them if force is True - and any paced messages there's budget for now
+       """
+       cur_time = time.time()
+       self.drain_paced(cur_time)
+       for peer,batch in self.batches.items():
+           if force or batch[0] <= cur_time: self.flush_batch(peer)
+   def flush_batch(self,peer):
+       """ Send whatever is waiting for the specified peer
+       """
+       deadline,frames,size = self.batches.pop(peer)
+       if len(frames)==1:
+          dgram = frames[0]
+       else:
+          dgram = chr(YATE_FLAG_BATCH) + ''.join([struct.pack(YATE_BATCH_LENGTH,len(f)) + f for f in frames])
+       try:
+          self.send_datagram(dgram,peer)
+       except:
+          yatelog.minor_exception('YATESock','Error sending to %s:%s' % peer)
+   def send_datagrams(self,peer,datagrams):
+       """ Send a message that's been framed, small messages get batched up with others to the same peer
+       """
+       self.send_counts[1] += 1
+       if len(datagrams) > 1 or self.batch_delay <= 0: # fragments are already as big as they can be, so don't wait for anything
+          if peer in self.batches: self.flush_batch(peer) # keep things in order
+          for dgram in datagrams: self.send_datagram(dgram,peer)
+          return
+       frame = datagrams[0]
+       batch = self.batches.get(peer)
+       if batch != None and (batch[2] + len(frame) + self.batch_len_size > YATE_MAX_DATAGRAM):
+          self.flush_batch(peer)
+          batch = None
+       if batch is None:
+          batch = self.batches[peer] = [time.time() + self.batch_delay,[],1]
+          self.schedule_flush(self.batch_delay)
+       batch[1].append(frame)
+       batch[2] += len(frame) + self.batch_len_size
+   def send_datagram(self,dgram,peer):
+       self.transmit(dgram,peer)
+       self.send_counts[0] += 1
+       if peer in self.known_peers:
+          self.last_sent[peer] = time.time()
+          self.stats.datagram_out(peer)
+   def send_cached(self,msg_type,cache_key,make_params,to_addr=None,timestamp=None):
+       """ Send a message that's likely to be sent again and again with exactly the same params, returns the msg_id
+           cache_key is anything hashable that's only ever used for messages of this type with the same params, make_params is
+           a function that returns those params and only gets called if what we need isn't cached already - it may return None
+           if there turns out to be nothing worth sending, and then nothing is sent
+           The encoded and compressed message is kept in self.encode_cache, so next time it's just framed and sent - this means
+           the msg_id it's sent with is whatever it was the first time, so don't use this for anything that gets replied to
+           timestamp works the same as for the send methods and isn't part of what's cached
+       """
+       msg_id = gen_msg_id()
+       params = YATECachedParams(cache_key,make_params)
+       if timestamp != None: params = YATEStamped(params,timestamp)
+       self.queue_msg(msg_type,(params,msg_id,to_addr))
+       return msg_id
+   def encode_msg(self,msg_type,msgdata,encoding):
+       """ Return (flags,body) for an encoded message to go to peers that agreed on encoding, which is (zlib,zdict version)
+       """
+       if encoding[0]: return self.compress_msg(msg_type,msgdata,encoding[1])
+       return (0,msgdata)
+   def send_msg(self,msg_type,msg_params,msg_id,to_addr):
+       """ Encode a message and transmit it to the specified peer, or all peers if to_addr is None
+           If msg_params is a YATECachedParams, see send_cached()
+           If msg_params is a YATEStamped, the timestamp goes to every peer with the 'time' cap - see YATE_FLAG_TIME
+       """
+       msg_type_s = msgtype_str[msg_type]
+       cached     = None
+       msgdata    = None
+       timestamp  = None
+       if isinstance(msg_params,YATEStamped): timestamp,msg_params = msg_params.timestamp,msg_params.params
+       if isinstance(msg_params,YATECachedParams):
+          cached     = msg_params
+          msg_params = cached.cache_key # only for the debug messages, the real params might never be needed
+          if self.capture != None and cached.get() != None: self.capture.write(yatecapture.YATE_CAPTURE_OUT,to_addr,msg_type,cached.get(),msg_id)
+       else:
+          msgdata = msgpack.packb((msg_type,msg_params,msg_id),use_bin_type=True)
+          if self.capture != None: self.capture.write(yatecapture.YATE_CAPTURE_OUT,to_addr,msg_type,msg_params,msg_id)
+       if to_addr==None:
+          yatelog.debug('YATESock','Broadcasting message %s to all peers: %s' % (msg_type,msg_params))
+          peer_list = [peer for peer in self.known_peers.copy() if self.wants(peer,msg_type)]
+       else:
+          peer_list = [to_addr]
+       encoded = {} # peers that agreed on the same caps get the same bytes, so only encode once for each
+       for peer in peer_list:
+           try:
+              caps     = self.peer_caps.get(peer,{})
+              encoding = (caps.get('zlib',False),caps.get('zdict',0))
+              if not (encoding in encoded):
+                 if cached is None:
+                    encoded[encoding] = self.encode_msg(msg_type,msgdata,encoding)
+                 else:
+                    encoded[encoding] = self.encode_cached(msg_type,cached,msg_id,encoding)
+              if encoded[encoding] is None: continue # send_cached() said there's nothing to send
+              flags,body = encoded[encoding]
+              if timestamp != None and caps.get('time',False):
+                 flags,body = flags | YATE_FLAG_TIME,struct.pack(YATE_FRAME_TIME,timestamp) + body
+              self.stats.msg_out(msg_type,peer if peer in self.known_peers else None,self.frame_size+len(body))
+              self.count_sent(peer,msg_type)
+              self.pace_msg(peer,msg_type,self.frame_msg(flags,self.next_seq(peer),body))
+              yatelog.debug('YATESock','Sent message %s to %s:%s: %s' % (msg_type_s,peer[0],peer[1],msg_params))
+           except:
+              yatelog.minor_exception('YATESock','Error during transmission of message %s' % msg_type_s)
+              self.msg_dropped(msg_type,peer)
+   def msg_dropped(self,msg_type,peer):
+       """ Called when a message for a peer (or everyone if peer is None) got thrown away instead of sent - by a queue policy,
+           pacing or an error - so whoever sent it can find out, see self.drop_handlers
+       """
+       handler = self.drop_handlers.get(msg_type)
+       if handler is None: return
+       peers = self.known_peers.copy() if peer is None else [peer]
+       for peer in peers:
+           try:
+              handler(msg_type,peer)
+           except:
+              yatelog.minor_exception('YATESock','Error in drop handler for %s' % msgtype_str[msg_type])
+   def encode_cached(self,msg_type,cached,msg_id,encoding):
+       """ Look up (flags,body) for a message from send_cached() in self.encode_cache, or encode it and cache it if it isn't there
+           Returns None if there's nothing to send
+       """
+       cache_key = (msg_type,cached.cache_key,encoding)
+       retval    = self.encode_cache.get(cache_key,False)
+       if retval is not False: return retval
+       msg_params = cached.get()
+       if msg_params is None:
+          self.encode_cache.put(cache_key,None,1)
+          return None
+       msgdata = msgpack.packb((msg_type,msg_params,msg_id),use_bin_type=True)
+       retval  = self.encode_msg(msg_type,msgdata,encoding)
+       self.encode_cache.put(cache_key,retval,len(retval[1]))
+       return retval
+   def set_peer_rate(self,addr,rate,burst=YATE_PEER_BURST):
+       """ Change how many bytes per second we send a peer, 0 for no limit - the default is YATE_PEER_RATE
+       """
+       self.peer_rates[addr] = (rate,burst)
+       self.out_buckets.pop(addr,None)
+   def out_bucket(self,peer,cur_time):
+       bucket = self.out_buckets.get(peer)
+       if bucket is None:
+          rate,burst = self.peer_rates.get(peer,(YATE_PEER_RATE,YATE_PEER_BURST))
+          bucket     = self.out_buckets[peer] = yateqos.YATETokenBucket(rate,burst,cur_time)
+       return bucket
+   def pace_msg(self,peer,msg_type,datagrams):
+       """ Send a framed message to a peer if it's within its budget, otherwise hold onto it until it is
+           Control and realtime messages always go straight out, everything else waits behind whatever's already waiting
+           Fragmented messages always go through the paced queue, so their datagrams get charged and sent one at a time
+       """
+       if not (peer in self.known_peers): # nothing to account it to, and it's probably a CONNECT or UNKNOWN_PEER anyway
+          self.send_datagrams(peer,datagrams)
+          return
+       cur_time = time.time()
+       bucket   = self.out_bucket(peer,cur_time)
+       paced    = self.paced.get(peer)
+       if YATE_MSG_PRIORITY.get(msg_type,YATE_PRIORITY_DEFAULT) <= YATE_PRIORITY_REALTIME or (not paced and len(datagrams)==1 and bucket.ready(cur_time)):
+          bucket.spend(sum([len(d) for d in datagrams]),cur_time)
+          self.send_datagrams(peer,datagrams)
+          return
+       if paced is None: paced = self.paced[peer] = collections.deque()
+       if len(paced) >= YATE_PEER_MAX_PACED: # drop the oldest message that hasn't started going out yet
+          i = 1 if paced[0][2] > 0 else 0
+          self.msg_dropped(paced[i][0],peer)
+          del paced[i]
+          self.stats.count(peer,'pace_dropped')
+       entry = [msg_type,datagrams,0]
+       paced.append(entry)
+       self.drain_peer(peer,cur_time)
+       if entry[2] < len(datagrams): # it has to wait for at least some of it
+          self.stats.count(peer,'paced')
+          self.schedule_flush(bucket.wait_time(cur_time,self.pace_reserve(peer,bucket)))
+   def pace_reserve(self,peer,bucket):
+       """ How much a peer's bucket has to hold onto before the front of its paced queue can go - fragments only get to use
+           YATE_FRAGMENT_WINDOW of the burst, so a big message trickles out at the peer's rate instead of in one lump
+       """
+       paced = self.paced.get(peer)
+       if paced and len(paced[0][1]) > 1: return max(0,bucket.burst - YATE_FRAGMENT_WINDOW)
+       return 0
+   def drain_paced(self,cur_time):
+       """ Send paced messages for every peer that has the budget for them now
+       """
+       for peer in self.paced.keys(): self.drain_peer(peer,cur_time)
+   def drain_peer(self,peer,cur_time):
+       """ Send as much off the front of a peer's paced queue as its budget allows right now
+           Each datagram of a fragmented message is charged and sent by itself, no more than YATE_FRAGMENT_WINDOW of them back
+           to back, so a big message goes out at the peer's rate instead of landing in its receive buffer all at once
+       """
+       paced  = self.paced[peer]
+       bucket = self.out_bucket(peer,cur_time)
+       while paced and bucket.ready(cur_time,self.pace_reserve(peer,bucket)):
+          entry = paced[0]
+          msg_type,datagrams,sent = entry
+          try:
+             if len(datagrams)==1:
+                paced.popleft()
+                bucket.spend(len(datagrams[0]),cur_time)
+                self.send_datagrams(peer,datagrams)
+                continue
+             if sent==0:
+                self.send_counts[1] += 1
+                if peer in self.batches: self.flush_batch(peer) # keep things in order
+             bucket.spend(len(datagrams[sent]),cur_time)
+             entry[2] += 1
+             if entry[2] == len(datagrams): paced.popleft()
+             self.send_datagram(datagrams[sent],peer)
+          except:
+             yatelog.minor_exception('YATESock','Error sending to %s:%s' % peer)
+             if paced and paced[0] is entry: paced.popleft()
+             self.msg_dropped(msg_type,peer)
+       if not paced: del self.paced[peer]
+   def admit_msg(self,addr,msg_type,cur_time):
+       """ Check a message from a known peer is within what it's allowed to send us, see YATE_PEER_MSG_RATE
+       """
+       if YATE_MSG_PRIORITY.get(msg_type,YATE_PRIORITY_DEFAULT) <= YATE_PRIORITY_REALTIME: return True
+       bucket = self.in_buckets.get(addr)
+       if bucket is None: bucket = self.in_buckets[addr] = yateqos.YATETokenBucket(YATE_PEER_MSG_RATE,YATE_PEER_MSG_BURST,cur_time)
+       return bucket.take(1,cur_time)
+   def frame_msg(self,flags,seq,body):
+       """ Turn an encoded message into a list of datagrams ready to send, splitting it into fragments if it won't fit into one
+       """
+       frame = struct.pack(YATE_FRAME_HEADER,flags,seq) + body
+       if len(frame) <= YATE_MAX_DATAGRAM: return [frame]
+       frag_count = (len(frame) + YATE_FRAGMENT_SIZE - 1) / YATE_FRAGMENT_SIZE
+       if frag_count > YATE_MAX_FRAGMENTS: raise ValueError('Message is too big to send even in fragments: %s bytes' % len(frame))
+       frag_key   = self.frag_keys.next() & 0xFFFFFFFF
+       datagrams  = []
+       for i in xrange(frag_count):
+           header = struct.pack(YATE_FRAGMENT_HEADER,YATE_FLAG_FRAGMENT,frag_key,i,frag_count)
+           datagrams.append(header + frame[i*YATE_FRAGMENT_SIZE:(i+1)*YATE_FRAGMENT_SIZE])
+       return datagrams
+   def defragment(self,data,addr):
+       """ Handle a fragment datagram - returns the whole message if this was the last missing piece, otherwise None
+       """
+       flags,frag_key,frag_index,frag_count = struct.unpack_from(YATE_FRAGMENT_HEADER,data)
+       if frag_count > YATE_MAX_FRAGMENTS or frag_index >= frag_count:
+          yatelog.warn('YATESock','Bogus fragment %s/%s from %s:%s' % (frag_index,frag_count,addr[0],addr[1]))
+          return None
+       cur_time = time.time()
+       self.expire_fragments(cur_time)
+       k = (addr,frag_key)
+       if not (k in self.fragments): self.fragments[k] = [cur_time,frag_count,{}]
+       self.fragments[k][0] = cur_time # it's still coming in, so it only times out once it stalls
+       pending = self.fragments[k][2]
+       if frag_index in pending: return None # duplicated datagram
+       pending[frag_index]  = as_bytes(data[struct.calcsize(YATE_FRAGMENT_HEADER):]) # copy it, the receive buffer gets reused
+       self.fragment_bytes += len(pending[frag_index])
+       if len(pending) < frag_count:
+          while self.fragment_bytes > YATE_MAX_PENDING_FRAGMENTS and len(self.fragments) > 1:
+             # drop the incomplete messages we heard from longest ago until we're back under the limit - never this one, it's
+             # the one that's actually arriving and YATE_MAX_PENDING_FRAGMENTS always has room for it on its own
+             stalest = min([x for x in self.fragments.keys() if x != k],key=lambda x: self.fragments[x][0])
+             yatelog.warn('YATESock','Too many incomplete messages, dropping one from %s:%s' % stalest[0])
+             self.drop_fragments(stalest)
+          return None
+       self.drop_fragments(k)
+       return ''.join([pending[i] for i in xrange(frag_count)])
+   def drop_fragments(self,k):
+       """ Forget about an incomplete message
+       """
+       for frag in self.fragments[k][2].values(): self.fragment_bytes -= len(frag)
+       del self.fragments[k]
+   def expire_fragments(self,cur_time):
+       """ Drop incomplete messages we've been waiting on for too long
+       """
+       for k,v in self.fragments.items():
+           if cur_time - v[0] > YATE_FRAGMENT_TIMEOUT:
+              yatelog.debug('YATESock','Timed out incomplete message from %s:%s' % k[0])
+              self.drop_fragments(k)
+
+   def null_handler(self,msg_params,from_addr,msg_id):
+       """ null handler - just dumps the message to log
+       """
+       yatelog.info('YATESock','Null handler dump: message ID %s from %s:%s: %s' % (msg_id,from_addr[0],from_addr[1],str(msg_params)))
+   def handle_unknown_peer(self,msg_params,from_addr,msg_id):
+       """ Handle the UNKNOWN_PEER message
+       """
+       self.forget_peer(from_addr)
+       yatelog.info('YATESock','Peer %s:%s does not know us, perhaps we timed out?' % from_addr)
+   def handle_connect_ack(self,msg_params,from_addr,msg_id):
+       """ Confirmed new peers - only really here to shutup the warning when not overridden
+       """
+       yatelog.debug('YATESock','Confirmed connection to %s:%s' % from_addr)
+   def handle_connect(self,msg_params,from_addr,msg_id):
+       """ Handle new peers - this is also called when we connect outwards, so don't subclass and override it like a fool
+       """
+       recv_time = time.time()
+       self.known_peers.add(from_addr)
+       if msg_params:
+          self.set_peer_caps(from_addr,msg_params[0])
+          self.peer_seq_stats.pop(from_addr,None) # a new connection starts counting from scratch
+       self.start_keepalive(from_addr) # make sure we send packets to this peer on a regular basis
+       caps = dict(self.caps)
+       for k,fn in self.peer_cap_fns.items(): caps[k] = fn(from_addr)
+       if caps['time']: caps['time'] = (recv_time,time.time())
+       self.send_connect_ack(msg_id,caps,to_addr=from_addr)
+   def start_keepalive(self,addr):
+       """ Put a new peer on the timer wheel, it gets a keepalive whenever we've sent it nothing for YATE_KEEPALIVE_TIMEOUT/2 seconds
+           It gets the full timeout from now to say something before we give up on it
+       """
+       cur_time = time.time()
+       self.last_pack.setdefault(addr,cur_time)
+       self.last_sent.setdefault(addr,cur_time)
+       self.timers.schedule(addr,cur_time + YATE_CLOCK_SYNC_FAST) # early, in case we can sync clocks with it
+   def handle_subscribe(self,msg_params,from_addr,msg_id):
+       """ Remember what a peer wants us to push to it - see MSGTYPE_SUBSCRIBE
+       """
+       msg_types,region,max_rate = msg_params
+       if region != None: region = (tuple(region[0]),tuple(region[1]))
+       self.peer_subs[from_addr] = {'types':     None if msg_types is None else set(msg_types),
+                                    'region':    region,
+                                    'interval':  1.0/max_rate if max_rate > 0 else 0,
+                                    'last_sent': {}} # maps message types to when we last sent one, see count_sent()
+       yatelog.debug('YATESock','Peer %s:%s subscribed to %s' % (from_addr[0],from_addr[1],msg_params))
+   def run_timers(self):
+       """ Deal with any peers that are due a keepalive or a timeout, this should be called every yatetimer.YATE_TIMER_TICK seconds
+           Peers that are busy cost nothing here, when they come due we just notice they've been active and move them along
+       """
+       cur_time = time.time()
+       for peer in self.timers.advance(cur_time): self.check_peer(peer,cur_time)
+       if cur_time >= self.next_housekeeping:
+          self.next_housekeeping = cur_time + YATE_KEEPALIVE_TIMEOUT
+          self.check_timeouts()
+   def check_peer(self,peer,cur_time):
+       """ Time out a peer if we haven't heard from it, send it a keepalive if we haven't sent it anything, and work out when to look again
+       """
+       if not (peer in self.known_peers): return
+       last_in = self.last_pack.get(peer,0)
+       if cur_time - last_in >= YATE_KEEPALIVE_TIMEOUT:
+          if self.stats.peer_counters(peer)['datagrams_in'] == 0:
+             yatelog.warn('YATESock','Peer %s:%s never actually sent us a single packet after connecting' % peer)
+          else:
+             yatelog.info('YATESock','Peer %s:%s has timed out, bye' % peer)
+          self.forget_peer(peer)
+          return
+       next_sync = self.next_clock_sync(peer)
+       if cur_time - self.last_sent.get(peer,0) >= YATE_KEEPALIVE_TIMEOUT/2.0 or cur_time >= next_sync:
+          self.ping(peer)
+          self.last_sent[peer] = cur_time # it's only queued so far, but don't send another one next tick
+          next_sync = self.next_clock_sync(peer)
+       self.timers.schedule(peer,min(last_in + YATE_KEEPALIVE_TIMEOUT,self.last_sent[peer] + YATE_KEEPALIVE_TIMEOUT/2.0,next_sync))
+   def next_clock_sync(self,peer):
+       """ Return when a peer is next due a keepalive for clock sync, even if we've been sending it plenty of other things
+       """
+       if not self.peer_caps.get(peer,{}).get('time',False): return float('inf')
+       clock = self.clocks.get(peer)
+       if clock is None or len(clock) < YATE_CLOCK_MIN_SAMPLES:
+          return self.last_ping.get(peer,0) + YATE_CLOCK_SYNC_FAST
+       return self.last_ping.get(peer,0) + YATE_CLOCK_SYNC_INTERVAL
+   def check_timeouts(self):
+       """ Throw away fragments and keepalives we're never going to hear the rest of, run_timers() calls this every YATE_KEEPALIVE_TIMEOUT seconds
+       """
+       cur_time  = time.time()
+       self.expire_fragments(cur_time)
+       if self.capture != None: self.capture.flush()
+       for ping_id,sent in self.pings.items():
+           if cur_time - sent[1] > YATE_KEEPALIVE_TIMEOUT: del self.pings[ping_id] # never going to hear back about that one
+   @arrival_handler
+   def handle_keepalive(self,msg_params,from_addr,msg_id,recv_time):
+       """ Send back KEEPALIVE_ACK so we don't time out, with when the keepalive arrived and when we answered it for clock sync
+       """
+       self.send_keepalive_ack(msg_id,recv_time or time.time(),time.time(),to_addr=from_addr)
+   @arrival_handler
+   def handle_keepalive_ack(self,msg_params,from_addr,msg_id,recv_time):
+       """ The receive loop tracks timeouts for us, so all that's left is keeping track of the round trip time and the clock offset
+       """
+       sent = self.pop_ping(msg_params[0],from_addr) if msg_params else None
+       if sent is None: return
+       self.stats.rtt(from_addr,time.time() - sent[1])
+       if len(msg_params) >= 3: self.add_clock_sample(from_addr,sent[1],msg_params[1],msg_params[2],recv_time) # older peers don't send these
+   def handle_connect_times(self,msg_params,from_addr,recv_time=None):
+       """ Get a clock sample out of a MSGTYPE_CONNECT_ACK, if it's for a CONNECT we sent and the peer does clock sync
+       """
+       caps = msg_params[1]
+       sent = self.pop_ping(msg_params[0],from_addr)
+       if sent is None: return
+       if not (isinstance(caps,dict) and isinstance(caps.get('time'),tuple)): return
+       self.add_clock_sample(from_addr,sent[1],caps['time'][0],caps['time'][1],recv_time)
+   def pop_ping(self,ping_id,addr):
+       """ Forget about a ping we sent and return (peer,time sent) - but only if it went to addr, otherwise returns None and leaves it
+           so one peer can't throw away pings we sent another
+       """
+       sent = self.pings.get(ping_id)
+       if sent is None or sent[0] != addr: return None
+       del self.pings[ping_id]
+       return sent
+   def add_clock_sample(self,addr,sent_time,peer_recv_time,peer_send_time,recv_time=None):
+       """ A peer answered something we sent at sent_time and told us when it got it and when it answered, by its clock
+           recv_time is when the datagram with the answer arrived, if it's not given it's taken to be now
+       """
+       cur_time  = time.time()
+       recv_time = max(sent_time,min(cur_time,recv_time or cur_time))
+       clock     = self.clocks.get(addr)
+       if clock is None: clock = self.clocks[addr] = yateclock.YATEClock()
+       clock.add_sample(sent_time,peer_recv_time,peer_send_time,recv_time)
+   def ping(self,addr):
+       """ Send a keepalive to a peer and remember when we did it
+       """
+       msg_id = self.send_keepalive(to_addr=addr)
+       self.pings[msg_id]   = (addr,time.time())
+       self.last_ping[addr] = time.time()
+   def get_clock_offset(self,addr):
+       """ Return how many seconds a peer's clock is ahead of ours, or None if we haven't managed to sync with it yet
+       """
+       clock = self.clocks.get(addr)
+       if clock is None: return None
+       return clock.get_offset()
+   def to_local_time(self,addr,timestamp):
+       """ Turn a timestamp from a peer into our time, if we haven't synced with it yet we just assume our clocks agree
+       """
+       clock = self.clocks.get(addr)
+       if clock is None: return timestamp
+       return clock.to_local(timestamp)
+   def handle_request_stats(self,msg_params,from_addr,msg_id):
+       self.send_stats(self.get_stats(),msg_id,to_addr=from_addr)
+   def dispatch_msg(self,msg_type,msg_params,msg_id,from_addr,msg_time=None,recv_time=None):
+       """ Hand a parsed message to its handler, msg_time is the timestamp the sender put on it by its clock if it did (see timed_handler())
+           recv_time is when the datagram it came in arrived (see arrival_handler())
+       """
+       yatelog.debug('YATESock','Got message %s from %s:%s: %s' % (msgtype_str[msg_type],from_addr[0],from_addr[1],msg_params))
+       if not (from_addr in self.known_peers):
+          if msg_type == MSGTYPE_CONNECT: # this runs right here so the peer is known before we look at anything else they sent
+             self.run_handler(self.handle_connect,msg_type,msg_params,from_addr,msg_id)
+          else:
+             self.send_unknown_peer(to_addr=from_addr)
+          return
+       if not self.handlers.has_key(msg_type): # don't bother wasting CPU time on it
+          yatelog.warn('YATESock','No handler for %s' % msgtype_str[msg_type])
+          return
+       if msg_type == MSGTYPE_CONNECT_ACK and len(msg_params) > 1:
+          self.set_peer_caps(from_addr,msg_params[1])
+          self.handle_connect_times(msg_params,from_addr,recv_time)
+       if msg_time != None: msg_time = self.to_local_time(from_addr,msg_time) # the CONNECT_ACK is handled first, so this is synced from the start
+       if msg_type in YATE_ADMISSION_LIMITS:
+          k = (from_addr,msg_type)
+          if self.in_flight.get(k,0) >= YATE_ADMISSION_LIMITS[msg_type]:
+             yatelog.debug('YATESock','Too many %s from %s:%s at once, dropping one' % (msgtype_str[msg_type],from_addr[0],from_addr[1]))
+             self.stats.count(from_addr,'rejected')
+             return
+          self.in_flight[k] = self.in_flight.get(k,0) + 1
+       self.spawn_handler(self.handlers[msg_type],msg_type,msg_params,from_addr,msg_id,msg_time,recv_time)
+   def run_handler(self,handler,msg_type,msg_params,from_addr,msg_id,msg_time=None,recv_time=None):
+       start_time = time.time()
+       retval     = None
+       try:
+          if getattr(handler,'timed',False):
+             retval = handler(msg_params,from_addr,msg_id,msg_time)
+          elif getattr(handler,'arrival',False):
+             retval = handler(msg_params,from_addr,msg_id,recv_time)
+          else:
+             retval = handler(msg_params,from_addr,msg_id)
+          return retval
+       except:
+          yatelog.minor_exception('YATESock','Error handling message %s' % msgtype_str[msg_type])
+       finally:
+          self.stats.handler_time(msg_type,time.time() - start_time,from_addr)
+          if msg_type in YATE_ADMISSION_LIMITS and not self.still_running(retval): self.release_msg(from_addr,msg_type)
+   def still_running(self,retval):
+       """ Return True if what a handler returned is going to carry on running after it returned, like a coroutine
+           Whoever runs it is then responsible for calling release_msg() once it's finished, see YATEAsyncSocket.spawn_handler()
+       """
+       return False
+   def release_msg(self,addr,msg_type):
+       """ A handler for one of YATE_ADMISSION_LIMITS finished
+       """
+       k = (addr,msg_type)
+       n = self.in_flight.get(k,0) - 1
+       if n > 0:
+          self.in_flight[k] = n
+       else:
+          self.in_flight.pop(k,None)
+   def got_datagram(self,data,addr):
+       """ Call this with every datagram that arrives
+           data may be a memoryview of a receive buffer that gets reused as soon as this returns, so nothing may hang onto it
+       """
+       if not data: return
+       # store the actual time we got the packet here, it's not fair to timeout peers for our slow parsing - and it goes along
+       # with every message in it, so clock sync isn't thrown off by how long they sit in queues either
+       recv_time = time.time()
+       if addr in self.known_peers: # but don't open up a very silly DDoS vulnerability
+          self.last_pack[addr] = recv_time
+          self.stats.datagram_in(addr)
+       self.parse_datagram(data,addr,recv_time)
+   def parse_datagram(self,data,addr,recv_time=None):
+       """ Decode a datagram and queue up the messages inside it, if there are any whole messages yet
+       """
+       flags = ord(data[0])
+       if flags & YATE_FLAG_BATCH:
+          offset = 1
+          try:
+             while offset < len(data):
+                frame_len = struct.unpack_from(YATE_BATCH_LENGTH,data,offset)[0]
+                offset   += self.batch_len_size
+                self.parse_frame(data[offset:offset+frame_len],addr,recv_time)
+                offset   += frame_len
+          except:
+             self.count_parse_error(addr)
+             yatelog.minor_exception('YATESock','Error while unpacking batch from %s:%s' % addr)
+          return
+       if flags & YATE_FLAG_FRAGMENT:
+          if not (addr in self.known_peers): return # a CONNECT never needs fragmenting, so don't hold onto anything for strangers
+          try:
+             data = self.defragment(data,addr)
+          except:
+             data = None
+             self.count_parse_error(addr)
+             yatelog.minor_exception('YATESock','Error while reassembling packet from %s:%s' % addr)
+          if data is None: return
+       self.parse_frame(data,addr,recv_time)
+   def parse_frame(self,data,addr,recv_time=None):
+       """ Decode a single whole frame and queue up the message, recv_time is when the datagram it came in arrived
+       """
+       if (ord(data[0]) & (YATE_FLAG_ZLIB|YATE_FLAG_ZDICT)) and not (addr in self.known_peers):
+          return # nobody compresses anything for us before connecting, and inflating things for strangers is asking for trouble
+       gc.disable() # performance hack for msgpack
+       try:
+          flags,seq  = struct.unpack_from(YATE_FRAME_HEADER,data)
+          frame_len  = len(data)
+          data       = data[self.frame_size:]
+          msg_time   = None
+          if flags & YATE_FLAG_TIME:
+             msg_time = struct.unpack_from(YATE_FRAME_TIME,data)[0]
+             data     = data[self.time_size:]
+          if flags & YATE_FLAG_ZLIB:  data = self.offload(len(data),inflate,as_bytes(data))
+          if flags & YATE_FLAG_ZDICT: data = self.offload(len(data),yatezdict.get_zdict(ord(data[0])).decompress,as_bytes(data[1:]),YATE_MAX_MSG_SIZE)
+          msg        = msgpack.unpackb(data,use_list = False)
+          msg_type   = msg[0]
+          msg_params = msg[1]
+          msg_id     = msg[2]
+          if not (msg_type in msgtype_str): raise ValueError('Unknown message type %s' % msg_type)
+          if self.capture != None: self.capture.write(yatecapture.YATE_CAPTURE_IN,addr,msg_type,msg_params,msg_id)
+          if addr in self.known_peers:
+             self.track_seq(addr,seq)
+             self.stats.msg_in(msg_type,addr,frame_len)
+             admitted = self.admit_msg(addr,msg_type,time.time())
+          else:
+             self.stats.msg_in(msg_type,None,frame_len)
+             admitted = True # it'll only get an UNKNOWN_PEER unless it's a CONNECT
+          if admitted:
+             self.queue_incoming(msg_type,(msg_params,msg_id,msg_time,recv_time,addr))
+          else:
+             self.stats.count(addr,'throttled')
+       except:
+          self.count_parse_error(addr)
+          yatelog.minor_exception('YATESock','Error while parsing packet from %s:%s' % addr)
+       gc.enable()
+   def count_parse_error(self,addr):
+       if addr in self.known_peers: self.stats.parse_error(addr)
+
+   # the rest is up to the event loop specific subclasses
+   def get_endpoint(self):
+       """ Return the IP endpoint this socket is bound to
+       """
+       raise NotImplementedError()
+   def transmit(self,dgram,addr):
+       """ Actually send a datagram
+       """
+       raise NotImplementedError()
+   def queue_msg(self,msg_type,msg_tuple):
+       """ Queue up a message to send, msg_tuple is (msg_params,msg_id,to_addr) - it should end up in send_msg() at some point
+       """
+       raise NotImplementedError()
+   def queue_incoming(self,msg_type,msg_tuple):
+       """ Queue up a parsed message, msg_tuple is (msg_params,msg_id,msg_time,recv_time,from_addr) - it should end up in dispatch_msg() at some point
+       """
+       raise NotImplementedError()
+   def spawn_handler(self,handler,msg_type,msg_params,from_addr,msg_id,msg_time=None,recv_time=None):
+       """ Arrange for run_handler() to be called with these params
+       """
+       raise NotImplementedError()
+   def schedule_flush(self,delay):
+       """ Called when a new batch is started, flush_batches() should be called in delay seconds
+       """
+       raise NotImplementedError()
+   def offload(self,size,fn,*args):
+       """ Call fn(*args) and return the result, size is how many bytes it's chewing on - this is for (de)compression
+           Subclasses that can run it somewhere other than the event loop without it noticing should, see yateoffload.py
+       """
+       return fn(*args)
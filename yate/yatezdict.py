@@ -0,0 +1,117 @@
+""" This file implements preset dictionaries for compressing YATE messages
+    YATE messages are tiny and look very much alike, so plain zlib has nothing to work with - a dictionary of commonly seen
+    byte strings gives it something to refer back to without ever sending those strings over the wire
+    Python 2's zlib has no zdict support, so we get the same effect by priming a raw deflate stream with the dictionary and
+    then copying the primed state for every message - only the output after the dictionary is ever sent
+
+    To build a new dictionary from captured traffic:
+      python yatezdict.py -o zdict_v2.bin capture1.msgs capture2.msgs
+    Each input file is either a capture file from yate_proxy.py --capture, or just a stream of msgpack-encoded (msg_type,msg_params,msg_id) tuples
+    Dictionaries are selected by version during the connect handshake, so once a version is shipped it must never change
+"""
+import os
+import zlib
+import msgpack
+
+YATE_ZDICT_VERSIONS = {1: 'zdict_v1.bin', 2: 'zdict_v2.bin'} # maps dictionary versions to filenames in this directory
+YATE_ZDICT_SIZE     = 8192                # default size for new dictionaries, zlib can only use the last 32KB anyway
+YATE_ZDICT_MIN_LEN  = 4                   # shortest substring worth putting in a dictionary
+YATE_ZDICT_MAX_LEN  = 32                  # longest substring we bother counting
+
+zdict_cache = {}
+
+def get_zdict(version):
+    """ Return a YATEZDict for the specified dictionary version, loading it if needed
+    """
+    if not (version in zdict_cache):
+       zdict_path = os.path.join(os.path.dirname(os.path.realpath(__file__)),YATE_ZDICT_VERSIONS[version])
+       with open(zdict_path,'rb') as fd:
+          zdict_cache[version] = YATEZDict(fd.read())
+    return zdict_cache[version]
+
+class YATEZDict:
+   """ A primed compressor and decompressor for one dictionary
+   """
+   def __init__(self,data):
+       self.data          = data
+       self.compressors   = {} # primed compressobj for each zlib level, created as needed
+       self.decompressor  = zlib.decompressobj(-zlib.MAX_WBITS)
+       self.decompressor.decompress(self.prime(zlib.Z_DEFAULT_COMPRESSION)[1])
+   def prime(self,level):
+       """ Feed the dictionary into a new raw deflate stream - returns the compressobj and the output it produced
+       """
+       c    = zlib.compressobj(level,zlib.DEFLATED,-zlib.MAX_WBITS)
+       data = c.compress(self.data) + c.flush(zlib.Z_SYNC_FLUSH)
+       return (c,data)
+   def compress(self,msgdata,level=zlib.Z_DEFAULT_COMPRESSION):
+       """ Compress a message against the dictionary
+       """
+       if not (level in self.compressors): self.compressors[level] = self.prime(level)[0]
+       c = self.compressors[level].copy()
+       return c.compress(msgdata) + c.flush()
+   def decompress(self,body,max_size=0):
+       """ Decompress a message that was compressed against the dictionary
+           If max_size isn't 0, ValueError gets raised if it comes out any bigger than that
+       """
+       d      = self.decompressor.copy()
+       retval = d.decompress(body,max_size)
+       if d.unconsumed_tail: raise ValueError('Compressed message is bigger than %s bytes' % max_size)
+       retval += d.flush()
+       if max_size and len(retval) > max_size: raise ValueError('Compressed message is bigger than %s bytes' % max_size)
+       return retval
+
+def build_zdict(samples,size=YATE_ZDICT_SIZE):
+    """ Build a dictionary from a list of encoded messages
+        Substrings are scored by how many messages they appear in and how long they are, then the best ones are packed
+        into the dictionary with the most valuable last because zlib encodes short distances more cheaply
+    """
+    counts = {}
+    for sample in samples:
+        seen = set()
+        for start in xrange(len(sample)):
+            for length in xrange(YATE_ZDICT_MIN_LEN,min(YATE_ZDICT_MAX_LEN,len(sample)-start)+1):
+                seen.add(sample[start:start+length])
+        for s in seen: counts[s] = counts.get(s,0) + 1
+    scored = sorted([s for s in counts.keys() if counts[s] > 1],key=lambda s: counts[s]*(len(s)-3),reverse=True)
+    chosen = []
+    used   = 0
+    for s in scored:
+        if used + len(s) > size: continue
+        if any(s in c for c in chosen): continue
+        chosen.append(s)
+        used += len(s)
+    chosen.reverse()
+    return ''.join(chosen)
+
+def read_samples(filename):
+    """ Read a file of msgpack-encoded messages and return a list of them, re-encoded the same way YATESocket does it
+        Capture file records are (timestamp,direction,peer,msg_type,msg_params,msg_id), so only the last 3 fields are used
+    """
+    samples = []
+    with open(filename,'rb') as fd:
+       for msg in msgpack.Unpacker(fd,use_list=False):
+           if len(msg)==2: continue # capture file magic
+           samples.append(msgpack.packb(msg[-3:],use_bin_type=True))
+    return samples
+
+if __name__=='__main__':
+   import argparse
+   parser = argparse.ArgumentParser(description='Build a preset zlib dictionary from captured YATE traffic')
+   parser.add_argument('-o','--output',type=str,help='Where to write the new dictionary',required=True)
+   parser.add_argument('-s','--size',type=int,help='Maximum size of the dictionary in bytes',default=YATE_ZDICT_SIZE)
+   parser.add_argument('captures',nargs='+',help='Files of msgpack-encoded messages')
+   args = parser.parse_args()
+   samples = []
+   for filename in args.captures: samples += read_samples(filename)
+   zdict_data = build_zdict(samples,args.size)
+   with open(args.output,'wb') as fd:
+      fd.write(zdict_data)
+   zdict = YATEZDict(zdict_data)
+   plain = sum([len(zlib.compress(s)) for s in samples])
+   preset = sum([len(zdict.compress(s)) for s in samples])
+   print 'Built %s byte dictionary from %s messages: %s bytes with plain zlib, %s bytes with the dictionary' % (len(zdict_data),len(samples),plain,preset)
+   by_type = {}
+   for s in samples: by_type.setdefault(msgpack.unpackb(s)[0],[]).append(s)
+   print '%8s %8s %10s %10s %10s' % ('type','messages','raw','zlib','dictionary')
+   for msg_type,msgs in sorted(by_type.items()):
+       print '%8s %8s %10s %10s %10s' % (msg_type,len(msgs),sum(map(len,msgs)),sum([len(zlib.compress(s)) for s in msgs]),sum([len(zdict.compress(s)) for s in msgs]))
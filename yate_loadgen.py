@@ -0,0 +1,211 @@
+import eventlet
+eventlet.monkey_patch()
+from yate import yatelog
+from yate import yateclient
+from yate import yatestats
+from yate.yateproto import *
+import logging
+import argparse
+import random
+import time
+
+# what each client does and how often relative to the rest, see the --mix option
+DEFAULT_MIX = 'move_vector=1,visible_voxel_req=2,request_pos=2,dist_to=2,nearest_voxel=1'
+QUERY_OPS   = ('dist_to','nearest_voxel') # these get replies we can match up, so they're what latency and timeouts are measured on
+
+logger = yatelog.get_logger()
+
+parser = argparse.ArgumentParser(description='Throw simulated clients at a running yate_proxy.py and see how it copes')
+parser.add_argument('-a','--addr',type=str,help='The ip:port of the proxy',required=True)
+parser.add_argument('-n','--clients',type=str,help='Comma seperated list of how many clients to run at each step',default='1,2,4,8,16,32')
+parser.add_argument('-d','--duration',type=float,help='How many seconds to run each step for',default=10.0)
+parser.add_argument('-r','--rate',type=float,help='How many messages per second each client sends on average',default=10.0)
+parser.add_argument('-m','--mix',type=str,help='Comma seperated op=weight pairs for the mix of messages each client sends (default: %s)' % DEFAULT_MIX,default=DEFAULT_MIX)
+parser.add_argument('-t','--timeout',type=float,help='How long to wait for a reply to a query before counting it as timed out',default=YATE_REQUEST_TIMEOUT)
+parser.add_argument('-s','--stream-rate',type=int,help='Updates per second each client asks the proxy to push, 0 makes them poll',default=yateclient.STREAM_RATE)
+parser.add_argument('-p','--plot',type=str,help='Plot the results against the number of clients to this image file (needs matplotlib)',default=None)
+parser.add_argument('-v','--verbose',action='store_true',help='Verbose mode: sets logging to DEBUG level')
+args = parser.parse_args()
+
+if args.verbose:
+   logger.setLevel(logging.DEBUG)
+else:
+   logger.setLevel(logging.WARN) # with lots of clients the info messages get silly
+
+addr = args.addr.split(':')
+addr = (addr[0],int(addr[1]))
+
+mix = []
+for item in args.mix.split(','):
+    op,weight = item.split('=')
+    mix.append((op.strip(),float(weight)))
+mix_total = sum([w for op,w in mix])
+
+def percentile(values,p):
+    """ values must be sorted already, p is 0 to 100
+    """
+    if len(values)==0: return 0.0
+    return values[min(int(len(values) * p / 100.0),len(values)-1)]
+
+class LoadStep:
+   """ Counters for one step of the test, every op and reply is recorded against the step it was sent in
+   """
+   def __init__(self,num_clients):
+       self.num_clients = num_clients
+       self.ops         = dict([(op,0) for op,w in mix])
+       self.latencies   = []
+       self.timeouts    = 0
+       self.started     = None
+       self.duration    = None
+       self.msgs_in     = 0
+       self.seq_in      = 0 # messages from the proxy that carried a sequence number, and how many sequence numbers never showed up
+       self.lost        = 0
+       self.server_drop = 0
+   def queries(self):
+       return sum([self.ops[op] for op in QUERY_OPS if op in self.ops])
+   def result(self):
+       latencies = sorted(self.latencies)
+       sent      = sum(self.ops.values())
+       queries   = self.queries()
+       return {'clients':    self.num_clients,
+               'sent':       sent,
+               'throughput': sent / self.duration,
+               'recv_rate':  self.msgs_in / self.duration,
+               'p50':        percentile(latencies,50) * 1000.0,
+               'p99':        percentile(latencies,99) * 1000.0,
+               'timeouts':   (float(self.timeouts) / queries) if queries else 0.0,
+               'loss':       (float(self.lost) / (self.seq_in + self.lost)) if self.seq_in + self.lost else 0.0,
+               'server_drop':self.server_drop}
+
+class LoadClient:
+   """ One simulated client, wraps a YATEClient and sends it a random mix of messages
+   """
+   def __init__(self,server_addr):
+       self.client = yateclient.YATEClient(stream_rate=args.stream_rate)
+       self.client.connect_to(server_addr)
+       self.step   = None
+       self.ops    = {'move_vector':       self.do_move_vector,
+                      'visible_voxel_req': self.do_visible_voxel_req,
+                      'request_pos':       self.do_request_pos,
+                      'dist_to':           self.do_dist_to,
+                      'nearest_voxel':     self.do_nearest_voxel}
+   def pick_op(self):
+       n = random.uniform(0,mix_total)
+       for op,weight in mix:
+           n -= weight
+           if n <= 0: return op
+       return mix[-1][0]
+   def counters(self):
+       """ Return (messages received,messages with sequence numbers received,sequence numbers lost) from the proxy so far
+       """
+       stats = self.client.sock.get_stats()
+       seq   = stats['seq'].get(yatestats.peer_str(self.client.server_addr),{})
+       return (sum([v['msgs_in'] for v in stats['types'].values()]),seq.get('received',0),seq.get('lost',0))
+   def do_move_vector(self):
+       self.client.move_vector((random.randint(-1,1),0,random.randint(-1,1)))
+   def do_visible_voxel_req(self):
+       self.client.sock.send_visible_voxel_req(to_addr=self.client.server_addr)
+   def do_request_pos(self):
+       self.client.sock.send_request_pos(to_addr=self.client.server_addr)
+   def do_dist_to(self):
+       pos = self.client.avatar_pos or (0,0,0)
+       pos = tuple([pos[i] + random.randint(-10,10) for i in xrange(3)])
+       return self.client.request(MSGTYPE_REQ_DIST_TO,pos,timeout=args.timeout)
+   def do_nearest_voxel(self):
+       return self.client.request(MSGTYPE_REQ_NEAREST_VOXEL,(random.randint(YATE_VOXEL_EMPTY,YATE_VOXEL_HARD_OBSTACLE),None),timeout=args.timeout)
+   def wait_reply(self,step,req,sent_time):
+       try:
+          req.wait()
+          step.latencies.append(time.time() - sent_time)
+       except YATERequestTimeout:
+          step.timeouts += 1
+   def run(self,step):
+       """ Keep sending until the step is over - the gaps between messages are random so the clients don't all fire in lockstep
+       """
+       self.step = step
+       while self.step is step:
+          eventlet.greenthread.sleep(random.expovariate(args.rate))
+          if self.step is not step: break
+          op  = self.pick_op()
+          req = self.ops[op]()
+          step.ops[op] += 1
+          if req != None: eventlet.spawn_n(self.wait_reply,step,req,time.time())
+   def stop(self):
+       self.step = None
+       self.client.stop()
+
+def get_server_drops(client):
+    """ Ask the proxy how many messages its queues have thrown away so far
+    """
+    try:
+       stats = client.client.get_server_stats().wait()
+    except YATERequestTimeout:
+       return 0
+    retval = 0
+    for queue in stats.get('queues',{}).values():
+        retval += sum([v['dropped'] for v in queue.values()])
+    return retval
+
+def run_step(clients,num_clients):
+    while len(clients) < num_clients: clients.append(LoadClient(addr))
+    wait_until = time.time() + YATE_KEEPALIVE_TIMEOUT
+    while time.time() < wait_until and not all([c.client.is_connected() for c in clients]): eventlet.greenthread.sleep(0.1)
+    connected = [c for c in clients if c.client.is_connected()]
+    if len(connected) < num_clients: print 'Only %s of %s clients connected' % (len(connected),num_clients)
+
+    step          = LoadStep(num_clients)
+    server_drops  = get_server_drops(clients[0])
+    counters      = [c.counters() for c in clients]
+    step.started  = time.time()
+    for c in clients: eventlet.spawn_n(c.run,step)
+    eventlet.greenthread.sleep(args.duration)
+    for c in clients: c.step = None
+    step.duration = time.time() - step.started
+    eventlet.greenthread.sleep(args.timeout + 0.1) # let the stragglers either turn up or time out
+    for c,before in zip(clients,counters):
+        after         = c.counters()
+        step.msgs_in += after[0] - before[0]
+        step.seq_in  += after[1] - before[1]
+        step.lost    += after[2] - before[2]
+    step.server_drop = get_server_drops(clients[0]) - server_drops
+    return step.result()
+
+def plot_results(results,filename):
+    try:
+       import matplotlib
+       matplotlib.use('Agg')
+       import matplotlib.pyplot as plt
+    except ImportError:
+       print 'matplotlib is not installed, not plotting'
+       return
+    x = [r['clients'] for r in results]
+    fig,(ax_rate,ax_lat,ax_drop) = plt.subplots(3,1,sharex=True,figsize=(8,10))
+    ax_rate.plot(x,[r['throughput'] for r in results],'o-',label='sent')
+    ax_rate.plot(x,[r['recv_rate'] for r in results],'o-',label='received')
+    ax_rate.set_ylabel('messages/sec')
+    ax_rate.legend(loc='upper left')
+    ax_lat.plot(x,[r['p50'] for r in results],'o-',label='p50')
+    ax_lat.plot(x,[r['p99'] for r in results],'o-',label='p99')
+    ax_lat.set_ylabel('query round trip (ms)')
+    ax_lat.legend(loc='upper left')
+    ax_drop.plot(x,[r['timeouts']*100.0 for r in results],'o-',label='queries timed out')
+    ax_drop.plot(x,[r['loss']*100.0 for r in results],'o-',label='messages lost')
+    ax_drop.set_ylabel('%')
+    ax_drop.legend(loc='upper left')
+    ax_drop.set_xlabel('clients')
+    fig.suptitle('yate_proxy at %s:%s, %s msgs/sec per client' % (addr[0],addr[1],args.rate))
+    fig.savefig(filename)
+    print 'Saved plot to %s' % filename
+
+clients = []
+results = []
+print '%8s %10s %10s %10s %10s %10s %9s %8s %8s' % ('clients','sent','sent/s','recv/s','p50 ms','p99 ms','timeout %','loss %','srv drop')
+for num_clients in [int(n) for n in args.clients.split(',')]:
+    r = run_step(clients,num_clients)
+    results.append(r)
+    print '%8d %10d %10.1f %10.1f %10.2f %10.2f %9.2f %8.2f %8d' % (r['clients'],r['sent'],r['throughput'],r['recv_rate'],r['p50'],r['p99'],r['timeouts']*100.0,r['loss']*100.0,r['server_drop'])
+
+if args.plot != None: plot_results(results,args.plot)
+pool = eventlet.GreenPool(len(clients))
+for c in clients: pool.spawn_n(c.stop)
+pool.waitall()
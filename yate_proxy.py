@@ -2,18 +2,26 @@ import eventlet
 from yate import yatelog
 from yate import drivers
 from yate import yateserver
+from yate import yateproto
 from yate.drivers import base
 import logging
 import argparse
 
 logger = yatelog.get_logger()
 
+STATS_DUMP_INTERVAL = 10
+
 parser = argparse.ArgumentParser(description='Start a YATE proxy server')
 parser.add_argument('-d','--driver',type=str,help='The driver to use for this session',choices=drivers.available_drivers.keys(),required=True)
 parser.add_argument('-v','--verbose',action='store_true',help='Verbose mode: sets logging to DEBUG level')
 parser.add_argument('-s','--server',type=str,help='The game server to tell the driver to connect to',default=None)
 parser.add_argument('-u','--username',type=str,help='The username to pass to the driver',default='YATEBot')
 parser.add_argument('-p','--password',type=str,help='The password to pass to the driver',default=None)
+parser.add_argument('--shm',type=str,help='Also publish observations to local AIs via shared memory at this path (e.g /dev/shm/yate)',default=None)
+parser.add_argument('--capture',type=str,help='Record all traffic to this file, it can be played back with yate_replay.py',default=None)
+parser.add_argument('--no-bulk',action='store_true',help='Do not serve big transfers (string tables, region snapshots) over TCP')
+parser.add_argument('--rcvbuf',type=int,help='Kernel receive buffer size for the socket in bytes (default: %s)' % yateproto.YATE_SOCK_RCVBUF,default=yateproto.YATE_SOCK_RCVBUF)
+parser.add_argument('--stats',type=str,help='Dump transport stats to this file as json every %s seconds' % STATS_DUMP_INTERVAL,default=None)
 parser.add_argument('--all-fatal',action='store_true',help='All warnings are fatal: dies on the first warning')
 parser.add_argument('--no-minor',action='store_true',help='No such thing as minor exceptions: all exceptions are critical') 
 args = parser.parse_args()
@@ -29,15 +37,21 @@ if args.no_minor:
 
 yatelog.info('yate_proxy', 'Trying to load driver: %s' % args.driver)
 try:
-   drivermod = drivers.available_drivers[args.driver]
+   drivermod = drivers.load_driver(args.driver)
 except Exception,e:
    yatelog.fatal_exception('yate_proxy','Could not load driver')
 params_dict = {'server':args.server,'username':args.username,'password':args.password}
 yatelog.info('yate_proxy','Loaded driver, starting server with driver params: %s' % str(params_dict))
 try:
    driver = drivermod.driver(**params_dict)
-   server = yateserver.YATEServer(driver,verbose=args.verbose)
+   server = yateserver.YATEServer(driver,verbose=args.verbose,shm_path=args.shm,capture=args.capture,rcvbuf=args.rcvbuf,bulk=not args.no_bulk)
 except Exception,e:
    yatelog.fatal_exception('yate_proxy','Could not start server')
 yatelog.info('yate_proxy','Server running on port %s' % server.get_port())
-while True: eventlet.greenthread.sleep(10)
+while True:
+   eventlet.greenthread.sleep(STATS_DUMP_INTERVAL)
+   if args.stats != None:
+      try:
+         server.sock.dump_stats(args.stats)
+      except:
+         yatelog.minor_exception('yate_proxy','Could not dump stats')
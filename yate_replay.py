@@ -0,0 +1,82 @@
+import eventlet
+eventlet.monkey_patch()
+from yate import yatelog
+from yate import yatesock
+from yate import yatecapture
+from yate.yateproto import *
+import logging
+import argparse
+import time
+
+# these are handled by the sockets doing the replay, replaying the recorded ones would just confuse things
+SKIP_TYPES = (MSGTYPE_CONNECT,MSGTYPE_CONNECT_ACK,MSGTYPE_UNKNOWN_PEER,MSGTYPE_KEEPALIVE,MSGTYPE_KEEPALIVE_ACK)
+
+logger = yatelog.get_logger()
+
+parser = argparse.ArgumentParser(description='Play back traffic recorded with yate_proxy.py --capture')
+parser.add_argument('capture',type=str,help='The capture file to play back')
+parser.add_argument('-t','--target',type=str,choices=('server','client'),required=True,
+                    help='server: connect to a proxy and send it what its clients sent, client: wait for clients to connect and send them what the proxy sent')
+parser.add_argument('-a','--addr',type=str,help='The ip:port of the proxy when the target is a server, or where to listen for clients when the target is a client',default='127.0.0.1:0')
+parser.add_argument('-d','--direction',type=str,choices=('in','out'),default=None,
+                    help='Which recorded messages to play back - by default it is the ones that went in when the target is a server and out when the target is a client, which is right for captures made on the proxy')
+parser.add_argument('-s','--speed',type=float,help='Playback speed - 1 is the speed it was recorded at, 0 is as fast as possible',default=1.0)
+parser.add_argument('-c','--clients',type=int,help='When the target is a client, wait for this many clients to connect before starting',default=1)
+parser.add_argument('-v','--verbose',action='store_true',help='Verbose mode: sets logging to DEBUG level')
+args = parser.parse_args()
+
+if args.verbose:
+   logger.setLevel(logging.DEBUG)
+else:
+   logger.setLevel(logging.WARN) # otherwise the null handler logs everything the target sends back
+
+addr = args.addr.split(':')
+addr = (addr[0],int(addr[1]))
+if args.direction is None: args.direction = 'in' if args.target=='server' else 'out'
+direction = {'in':yatecapture.YATE_CAPTURE_IN,'out':yatecapture.YATE_CAPTURE_OUT}[args.direction]
+
+def connect_peer(server_addr):
+    """ Create a new socket to pretend to be a recorded client, and wait until the server knows about it
+    """
+    connected = eventlet.event.Event()
+    sock = yatesock.YATESocket(handlers={MSGTYPE_CONNECT_ACK: lambda msg_params,from_addr,msg_id: connected.ready() or connected.send(True)})
+    sock.connect_to(server_addr)
+    connected.wait()
+    return sock
+
+def replay(records,send_fn):
+    """ Call send_fn(peer,msg_type,msg_params) for each record, spaced out in time according to args.speed
+    """
+    start_time = time.time()
+    first_ts   = None
+    sent       = 0
+    for timestamp,record_dir,peer,msg_type,msg_params,msg_id in records:
+        if msg_type in SKIP_TYPES: continue
+        if first_ts is None: first_ts = timestamp
+        if args.speed > 0:
+           delay = ((timestamp - first_ts) / args.speed) - (time.time() - start_time)
+           if delay > 0: eventlet.greenthread.sleep(delay)
+        else:
+           eventlet.greenthread.sleep(0) # let the sockets get on with it
+        send_fn(peer,msg_type,msg_params)
+        sent += 1
+    return (sent,time.time() - start_time)
+
+socks = {}
+if args.target == 'server':
+   def send_fn(peer,msg_type,msg_params):
+       if not (peer in socks): socks[peer] = connect_peer(addr) # one socket per recorded client, so the server sees the same number of peers
+       sock = socks[peer]
+       sock.queue_msg(msg_type,(msg_params,gen_msg_id(),addr))
+else:
+   sock = yatesock.YATESocket(bind_ip=addr[0],bind_port=addr[1])
+   socks[None] = sock
+   print 'Waiting for %s clients on %s:%s' % ((args.clients,) + sock.get_endpoint())
+   while len(sock.known_peers) < args.clients: eventlet.greenthread.sleep(0.1)
+   def send_fn(peer,msg_type,msg_params):
+       sock.queue_msg(msg_type,(msg_params,gen_msg_id(),None)) # there's no telling which recorded peer is which live one, so everyone gets everything
+
+sent,duration = replay(yatecapture.read_capture(args.capture,direction),send_fn)
+eventlet.greenthread.sleep(0.5) # give the queues a chance to drain
+print 'Sent %s messages in %.3f seconds (%.1f per second)' % (sent,duration,sent/duration if duration else 0)
+for sock in socks.values(): sock.stop()